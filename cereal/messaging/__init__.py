@@ -7,11 +7,14 @@ import msgq
 
 import os
 import capnp
+import numpy as np
 import time
+from collections.abc import MutableMapping
 
-from typing import Optional, List, Union, Dict
+from typing import Optional, List, Tuple, Union, Dict
 
 from cereal import log
+from cereal.serialized import event_header
 from cereal.services import SERVICE_LIST
 from openpilot.common.util import MovingAverage
 
@@ -92,22 +95,25 @@ def recv_one_retry(sock: SubSocket) -> capnp.lib.capnp._DynamicStructReader:
       return log_from_bytes(dat)
 
 
-class FrequencyTracker:
-  def __init__(self, service_freq: float, update_freq: float, is_poll: bool):
-    freq = max(min(service_freq, update_freq), 1.)
-    if is_poll:
-      min_freq = max_freq = freq
+def frequency_limits(service_freq: float, update_freq: float, is_poll: bool) -> Tuple[float, float, float]:
+  """(expected frequency, min frequency, max frequency) of a service received at update_freq"""
+  freq = max(min(service_freq, update_freq), 1.)
+  if is_poll:
+    min_freq = max_freq = freq
+  else:
+    max_freq = min(freq, update_freq)
+    if service_freq >= 2 * update_freq:
+      min_freq = update_freq
+    elif update_freq >= 2* service_freq:
+      min_freq = freq
     else:
-      max_freq = min(freq, update_freq)
-      if service_freq >= 2 * update_freq:
-        min_freq = update_freq
-      elif update_freq >= 2* service_freq:
-        min_freq = freq
-      else:
-        min_freq = min(freq, freq / 2.)
+      min_freq = min(freq, freq / 2.)
+  return freq, min_freq * 0.8, max_freq * 1.2
 
-    self.min_freq = min_freq * 0.8
-    self.max_freq = max_freq * 1.2
+
+class FrequencyTracker:
+  def __init__(self, service_freq: float, update_freq: float, is_poll: bool):
+    freq, self.min_freq, self.max_freq = frequency_limits(service_freq, update_freq, is_poll)
     self.avg_dt = MovingAverage(int(10 * freq))
     self.recent_avg_dt = MovingAverage(int(freq))
     self.prev_time = 0.0
@@ -135,28 +141,75 @@ class FrequencyTracker:
     return self.min_freq <= avg_freq_recent <= self.max_freq
 
 
+class ServiceArrayView(MutableMapping):
+  """dict of service -> value, backed by one of SubMaster's arrays"""
+  __slots__ = ('_index', '_array')
+
+  def __init__(self, index: Dict[str, int], array: np.ndarray):
+    self._index = index
+    self._array = array
+
+  def __getitem__(self, s: str):
+    return self._array[self._index[s]].item()
+
+  def __setitem__(self, s: str, value) -> None:
+    self._array[self._index[s]] = value
+
+  def __delitem__(self, s: str) -> None:
+    raise TypeError("services can't be removed from a SubMaster")
+
+  def __iter__(self):
+    return iter(self._index)
+
+  def __len__(self) -> int:
+    return len(self._index)
+
+  def __repr__(self) -> str:
+    return repr(dict(zip(self._index, self._array.tolist(), strict=True)))
+
+
 class SubMaster:
   def __init__(self, services: List[str], poll: Optional[str] = None,
                ignore_alive: Optional[List[str]] = None, ignore_avg_freq: Optional[List[str]] = None,
-               ignore_valid: Optional[List[str]] = None, addr: str = "127.0.0.1", frequency: Optional[float] = None):
+               ignore_valid: Optional[List[str]] = None, addr: str = "127.0.0.1", frequency: Optional[float] = None,
+               lazy: bool = False):
     self.frame = -1
     self.services = services
-    self.seen = {s: False for s in services}
-    self.updated = {s: False for s in services}
-    self.recv_time = {s: 0. for s in services}
-    self.recv_frame = {s: 0 for s in services}
     self.sock = {}
-    self.data = {}
-    self.logMonoTime = {s: 0 for s in services}
+    self._data = {}
+
+    # the state of every service is kept in arrays indexed by service, so update_msgs sets it in bulk.
+    # the dicts (sm.updated['carState'], ...) are views of the arrays
+    self.index = {s: i for i, s in enumerate(services)}
+    n = len(services)
+    self._seen = np.zeros(n, dtype=bool)
+    self._updated = np.zeros(n, dtype=bool)
+    self._recv_time = np.zeros(n)
+    self._recv_frame = np.zeros(n, dtype=np.int64)
+    self._log_mono_time = np.zeros(n, dtype=np.uint64)
+    self.seen = ServiceArrayView(self.index, self._seen)
+    self.updated = ServiceArrayView(self.index, self._updated)
+    self.recv_time = ServiceArrayView(self.index, self._recv_time)
+    self.recv_frame = ServiceArrayView(self.index, self._recv_frame)
+    self.logMonoTime = ServiceArrayView(self.index, self._log_mono_time)
+
+    # lazy keeps the messages serialized until they're read with sm[s], services that aren't read aren't decoded.
+    # _data only has the messages that were decoded, sm[s] is the latest one
+    self.lazy = lazy
+    self.raw: Dict[str, bytes] = {}
 
     # zero-frequency / on-demand services are always alive and presumed valid; all others must pass checks
-    on_demand = {s: SERVICE_LIST[s].frequency <= 1e-5 for s in services}
-    self.static_freq_services = set(s for s in services if not on_demand[s])
-    self.alive = {s: on_demand[s] for s in services}
-    self.freq_ok = {s: on_demand[s] for s in services}
-    self.valid = {s: on_demand[s] for s in services}
+    service_freq = np.array([SERVICE_LIST[s].frequency for s in services], dtype=np.float64)
+    on_demand = service_freq <= 1e-5
+    self.static_freq_services = set(s for s, od in zip(services, on_demand, strict=True) if not od)
+    self._static_freq = ~on_demand
+    self._alive = on_demand.copy()
+    self._freq_ok = on_demand.copy()
+    self._valid = on_demand.copy()
+    self.alive = ServiceArrayView(self.index, self._alive)
+    self.freq_ok = ServiceArrayView(self.index, self._freq_ok)
+    self.valid = ServiceArrayView(self.index, self._valid)
 
-    self.freq_tracker: Dict[str, FrequencyTracker] = {}
     self.poller = Poller()
     polled_services = set([poll, ] if poll is not None else services)
     self.non_polled_services = set(services) - polled_services
@@ -171,6 +224,21 @@ class SubMaster:
     assert frequency is None or poll is None, "Do not specify 'frequency' - frequency of the polled service will be used."
     self.update_freq = frequency or max([SERVICE_LIST[s].frequency for s in polled_services])
 
+    # FrequencyTracker for all services at once: the intervals between messages of each service are kept
+    # in a ring the length of its average window, its recent window is the newest part of that ring.
+    # they're updated one message at a time, plain lists are quicker for that than arrays
+    limits = np.array([frequency_limits(SERVICE_LIST[s].frequency, self.update_freq, s == poll) for s in services]).reshape(n, 3)
+    self._min_freq, self._max_freq = limits[:, 1].tolist(), limits[:, 2].tolist()
+    self._avg_window = (10 * limits[:, 0]).astype(np.int64).tolist()
+    self._recent_window = limits[:, 0].astype(np.int64).tolist()
+    self._tracked = (~on_demand).tolist()
+    self._dts = [[0.0] * w for w in self._avg_window]
+    self._dt_count = [0] * n
+    self._avg_sum = [0.0] * n
+    self._recent_sum = [0.0] * n
+    self._prev_time = [0.0] * n
+    self._alive_time = np.divide(10., service_freq, out=np.full(n, np.inf), where=~on_demand)
+
     for s in services:
       p = self.poller if s not in self.non_polled_services else None
       self.sock[s] = sub_sock(s, poller=p, addr=addr, conflate=True)
@@ -180,47 +248,102 @@ class SubMaster:
       except capnp.lib.capnp.KjException:
         data = new_message(s, 0) # lists
 
-      self.data[s] = getattr(data.as_reader(), s)
-      self.freq_tracker[s] = FrequencyTracker(SERVICE_LIST[s].frequency, self.update_freq, s == poll)
+      self._data[s] = getattr(data.as_reader(), s)
 
   def __getitem__(self, s: str) -> capnp.lib.capnp._DynamicStructReader:
-    return self.data[s]
+    if s in self.raw:
+      self._data[s] = getattr(log_from_bytes(self.raw.pop(s)), s)
+    return self._data[s]
 
   def _check_avg_freq(self, s: str) -> bool:
     return SERVICE_LIST[s].frequency > 0.99 and (s not in self.ignore_average_freq) and (s not in self.ignore_alive)
 
   def update(self, timeout: int = 100) -> None:
-    msgs = []
+    msgs: List[Union[bytes, capnp.lib.capnp._DynamicStructReader, None]] = []
+    recv = (lambda sock: sock.receive(non_blocking=True)) if self.lazy else recv_one_or_none
     for sock in self.poller.poll(timeout):
-      msgs.append(recv_one_or_none(sock))
+      msgs.append(recv(sock))
 
     # non-blocking receive for non-polled sockets
     for s in self.non_polled_services:
-      msgs.append(recv_one_or_none(self.sock[s]))
+      msgs.append(recv(self.sock[s]))
     self.update_msgs(time.monotonic(), msgs)
 
-  def update_msgs(self, cur_time: float, msgs: List[capnp.lib.capnp._DynamicStructReader]) -> None:
+  def update_msgs(self, cur_time: float, msgs: List[Union[bytes, capnp.lib.capnp._DynamicStructReader, None]]) -> None:
+    """msgs are events, or serialized events which are only decoded when they're read"""
     self.frame += 1
-    self.updated = dict.fromkeys(self.services, False)
+    # a service received twice keeps its last message, like the dicts did
+    last: Dict[int, Tuple[int, bool]] = {}
     for msg in msgs:
       if msg is None:
         continue
 
-      s = msg.which()
-      self.seen[s] = True
-      self.updated[s] = True
-
-      self.freq_tracker[s].record_recv_time(cur_time)
-      self.recv_time[s] = cur_time
-      self.recv_frame[s] = self.frame
-      self.data[s] = getattr(msg, s)
-      self.logMonoTime[s] = msg.logMonoTime
-      self.valid[s] = msg.valid
-
-    for s in self.static_freq_services:
-      # alive if delay is within 10x the expected frequency; checks relaxed in simulator
-      self.alive[s] = (cur_time - self.recv_time[s]) < (10. / SERVICE_LIST[s].frequency) or (self.seen[s] and self.simulation)
-      self.freq_ok[s] = self.freq_tracker[s].valid or self.simulation
+      header = event_header(msg) if isinstance(msg, bytes) else None
+      if header is not None:
+        s, log_mono_time, valid = header
+        self.raw[s] = msg
+      else:
+        if isinstance(msg, bytes):
+          msg = log_from_bytes(msg)
+        s, log_mono_time, valid = msg.which(), msg.logMonoTime, msg.valid
+        self.raw.pop(s, None)
+        self._data[s] = getattr(msg, s)
+
+      i = self.index[s]
+      last[i] = (log_mono_time, valid)
+      self._record_recv_time(i, cur_time)
+
+    self._updated[:] = False
+    if len(last) == 1:
+      (i, (log_mono_time, valid)), = last.items()
+      self._seen[i] = self._updated[i] = True
+      self._recv_time[i] = cur_time
+      self._recv_frame[i] = self.frame
+      self._log_mono_time[i] = log_mono_time
+      self._valid[i] = valid
+    elif last:
+      # the indices are unique, so each element is assigned once
+      idx = list(last)
+      log_mono_times, valids = zip(*last.values(), strict=True)
+      self._seen[idx] = True
+      self._updated[idx] = True
+      self._recv_time[idx] = cur_time
+      self._recv_frame[idx] = self.frame
+      self._log_mono_time[idx] = log_mono_times
+      self._valid[idx] = valids
+
+    # alive if delay is within 10x the expected frequency; checks relaxed in simulator.
+    # services without a frequency are never too late, they stay alive
+    np.less(cur_time - self._recv_time, self._alive_time, out=self._alive)
+    if self.simulation:
+      self._alive |= self._seen
+      self._freq_ok[self._static_freq] = True
+
+  def _record_recv_time(self, i: int, cur_time: float) -> None:
+    # FrequencyTracker.record_recv_time of service i, freq_ok only changes with it
+    # TODO: Handle case where cur_time is less than prev_time
+    prev_time = self._prev_time[i]
+    self._prev_time[i] = cur_time
+    if prev_time <= 1e-5 or not self._tracked[i]:
+      return  # on-demand services don't need one, they're always freq_ok
+
+    dt = cur_time - prev_time
+    count, avg_window, recent_window = self._dt_count[i], self._avg_window[i], self._recent_window[i]
+    dts = self._dts[i]
+    pos = count % avg_window
+    # the oldest interval of each window leaves it, the slots of ones that haven't been added are still 0
+    recent_sum = self._recent_sum[i] + dt - dts[(count - recent_window) % avg_window]
+    avg_sum = self._avg_sum[i] + dt - dts[pos]
+    dts[pos] = dt
+    self._recent_sum[i], self._avg_sum[i] = recent_sum, avg_sum
+    self._dt_count[i] = count = count + 1
+
+    if not self.simulation:
+      # FrequencyTracker.valid, min_freq <= count / sum <= max_freq without dividing by a sum that can be 0
+      min_freq, max_freq = self._min_freq[i], self._max_freq[i]
+      avg_count, recent_count = min(count, avg_window), min(count, recent_window)
+      self._freq_ok[i] = ((min_freq * avg_sum <= avg_count <= max_freq * avg_sum) or
+                          (min_freq * recent_sum <= recent_count <= max_freq * recent_sum))
 
   def all_alive(self, service_list: Optional[List[str]] = None) -> bool:
     return all(self.alive[s] for s in (service_list or self.services) if s not in self.ignore_alive)
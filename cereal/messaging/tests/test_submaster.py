@@ -0,0 +1,184 @@
+import random
+
+import numpy as np
+import pytest
+
+import cereal.messaging as messaging
+from cereal.services import SERVICE_LIST
+
+SERVICES = ["carState", "controlsState", "roadCameraState", "deviceState", "can", "userFlag"]
+
+
+class FakeSocket:
+  def __init__(self):
+    self.msgs: list[bytes] = []
+
+  def receive(self, non_blocking: bool = False) -> bytes | None:
+    return self.msgs.pop(0) if self.msgs else None
+
+
+class FakePoller:
+  def __init__(self):
+    self.socks: list[FakeSocket] = []
+
+  def registerSocket(self, sock: FakeSocket) -> None:
+    self.socks.append(sock)
+
+  def poll(self, timeout: int) -> list[FakeSocket]:
+    return [sock for sock in self.socks if sock.msgs]
+
+
+@pytest.fixture(autouse=True)
+def socks(monkeypatch):
+  socks: dict[str, FakeSocket] = {}
+
+  def sub_sock(s, poller=None, addr="127.0.0.1", conflate=False):
+    socks[s] = FakeSocket()
+    if poller is not None:
+      poller.registerSocket(socks[s])
+    return socks[s]
+
+  monkeypatch.setattr(messaging, "sub_sock", sub_sock)
+  monkeypatch.setattr(messaging, "Poller", FakePoller)
+  return socks
+
+
+def event(s: str, log_mono_time: int, valid: bool = True, value: float = 0.) -> bytes:
+  msg = messaging.new_message(s, 2 if s == "can" else None, logMonoTime=log_mono_time, valid=valid)
+  if s == "can":
+    msg.can[1].address = int(value)
+  elif s == "carState":
+    msg.carState.vEgo = value
+  return msg.to_bytes()
+
+
+def far_event(dat: bytes) -> bytes:
+  # the same event, with its root as a far pointer to a landing pad in the second segment
+  return b"".join([(1).to_bytes(4, "little"), (1).to_bytes(4, "little"), dat[4:8], b"\0" * 4,
+                   (2 | (1 << 32)).to_bytes(8, "little"), dat[8:]])
+
+
+def state(sm: messaging.SubMaster) -> dict:
+  return {name: dict(getattr(sm, name)) for name in ("seen", "updated", "recv_time", "recv_frame", "logMonoTime", "valid", "alive", "freq_ok")}
+
+
+def tracker_valid(tracker: messaging.FrequencyTracker) -> bool:
+  try:
+    return tracker.valid
+  except ZeroDivisionError:
+    return False  # every interval in a window is 0, that's not a frequency
+
+
+class TestSubMaster:
+  def test_lazy(self):
+    rng = random.Random(0)
+    eager, lazy = messaging.SubMaster(SERVICES), messaging.SubMaster(SERVICES, lazy=True)
+    for frame in range(300):
+      msgs = []
+      for s in rng.sample(SERVICES, rng.randint(0, len(SERVICES))) + rng.sample(SERVICES, rng.randint(0, 2)):
+        dat = event(s, frame * 100 + len(msgs), rng.random() < 0.8, rng.randint(0, 1000))
+        msgs.append(far_event(dat) if rng.random() < 0.1 else dat)
+      rng.shuffle(msgs)
+
+      eager.update_msgs(frame * 0.01, [messaging.log_from_bytes(m) for m in msgs])
+      lazy.update_msgs(frame * 0.01, msgs)
+      assert state(lazy) == state(eager)
+      # some services aren't read every frame
+      for s in rng.sample(SERVICES, 3):
+        assert str(lazy[s]) == str(eager[s])
+
+  def test_lazy_decodes_on_read(self, socks, mocker):
+    sm = messaging.SubMaster(["carState", "controlsState"], lazy=True)
+    decode = mocker.spy(messaging, "log_from_bytes")
+    socks["carState"].msgs.append(event("carState", 1, value=1.))
+    sm.update(0)
+    assert sm.updated["carState"] and sm.logMonoTime["carState"] == 1
+    assert decode.call_count == 0
+
+    assert sm["carState"].vEgo == 1.
+    assert sm["carState"].vEgo == 1.
+    assert decode.call_count == 1
+
+    # a message that's read after a later update is the new one, whether the old one was read or not
+    for value in (2., 3.):
+      socks["carState"].msgs.append(event("carState", int(value), value=value))
+      sm.update(0)
+    assert sm["carState"].vEgo == 3. and decode.call_count == 2
+    sm.update(0)
+    assert not sm.updated["carState"] and sm["carState"].vEgo == 3.
+    assert decode.call_count == 2
+
+    # events that can't be read without decoding them are decoded right away
+    socks["carState"].msgs.append(far_event(event("carState", 4, value=4.)))
+    sm.update(0)
+    assert decode.call_count == 3 and sm.logMonoTime["carState"] == 4
+    assert sm["carState"].vEgo == 4. and decode.call_count == 3
+
+  def test_duplicates(self):
+    sm = messaging.SubMaster(SERVICES, lazy=True)
+    sm.update_msgs(1., [event("carState", 1, True, 1.), event("controlsState", 2), event("carState", 3, False, 3.)])
+    assert sm.logMonoTime["carState"] == 3 and not sm.valid["carState"] and sm["carState"].vEgo == 3.
+    assert sm.updated["controlsState"] and sm.logMonoTime["controlsState"] == 2
+
+  def test_freq_ok_alive(self):
+    # the baseline: a FrequencyTracker per service, checked every frame
+    rng = random.Random(1)
+    sm = messaging.SubMaster(SERVICES)
+    trackers = {s: messaging.FrequencyTracker(SERVICE_LIST[s].frequency, sm.update_freq, False) for s in SERVICES}
+    recv_time = dict.fromkeys(SERVICES, 0.)
+    due = dict.fromkeys(SERVICES, 0.)
+    t = 1.
+    for frame in range(3000):
+      # phases of updates on time, too slow, and with gaps. some frames have dt=0
+      phase = frame // 250 % 3
+      if rng.random() < 0.03:
+        dt = 0.
+      elif phase == 2 and rng.random() < 0.02:
+        dt = rng.choice([0.3, 2.])
+      else:
+        dt = (0.03 if phase == 1 else 0.01) + rng.uniform(0, 1e-4)
+      t += dt
+
+      msgs = []
+      for s in SERVICES:
+        # and some services stop for a while
+        if t < due[s] or (phase == 2 and frame % 250 < 100 and s in ("carState", "roadCameraState")):
+          continue
+        due[s] = t + 1 / max(SERVICE_LIST[s].frequency, 1.) - 0.005
+        # sometimes twice in an update
+        for _ in range(2 if rng.random() < 0.02 else 1):
+          msgs.append(event(s, frame))
+          trackers[s].record_recv_time(t)
+          recv_time[s] = t
+      rng.shuffle(msgs)
+      sm.update_msgs(t, [messaging.log_from_bytes(m) for m in msgs])
+
+      for s in SERVICES:
+        freq = SERVICE_LIST[s].frequency
+        on_demand = freq <= 1e-5
+        assert sm.freq_ok[s] == (on_demand or tracker_valid(trackers[s])), (frame, s)
+        assert sm.alive[s] == (on_demand or t - recv_time[s] < 10. / freq), (frame, s)
+
+  def test_freq_ok_zero_dt(self):
+    sm = messaging.SubMaster(["carState"])
+    sm.update_msgs(1., [event("carState", 0)])
+    sm.update_msgs(1., [event("carState", 1)])
+    # the only interval is 0, not a frequency
+    assert not sm.freq_ok["carState"] and sm.alive["carState"]
+    for i in range(1, 20):
+      sm.update_msgs(1. + i * 0.01, [event("carState", i + 1)])
+    assert sm.freq_ok["carState"]
+
+    # twice in one update is an interval of 0 too
+    sm = messaging.SubMaster(["carState"])
+    sm.update_msgs(1., [event("carState", 0), event("carState", 1)])
+    assert not sm.freq_ok["carState"] and sm.recv_frame["carState"] == 0
+
+  def test_views(self):
+    sm = messaging.SubMaster(SERVICES)
+    sm.update_msgs(1., [event("carState", 5)])
+    assert dict(sm.updated) == {s: s == "carState" for s in SERVICES}
+    assert isinstance(sm.logMonoTime["carState"], (int, np.integer)) and sm.logMonoTime["carState"] == 5
+    sm.valid["carState"] = False
+    assert not sm.all_valid(["carState"])
+    assert sm.all_valid(["userFlag"])
@@ -0,0 +1,70 @@
+"""Fields of serialized Events, read from their bytes without decoding them.
+https://capnproto.org/encoding.html"""
+import struct
+from typing import Optional, Tuple
+
+from cereal import log
+
+# the Event union discriminant of each service
+EVENT_WHICH = {name: log.Event.schema.fields[name].proto.discriminantValue for name in log.Event.schema.union_fields}
+EVENT_WHICH_NAMES = {which: name for name, which in EVENT_WHICH.items()}
+
+# where the fields are in the Event's data section, in bytes (bits for valid)
+EVENT_WHICH_OFFSET = log.Event.schema.node.struct.discriminantOffset * 2
+EVENT_MONO_TIME_OFFSET = log.Event.schema.fields['logMonoTime'].proto.slot.offset * 8
+EVENT_VALID_BIT = log.Event.schema.fields['valid'].proto.slot.offset
+EVENT_VALID_DEFAULT = log.Event.schema.fields['valid'].proto.slot.defaultValue.bool
+
+SEGMENT_TABLE_START = struct.Struct("<II")  # segment count - 1, size of the first segment in words
+ROOT_POINTER = struct.Struct("<Q")
+WHICH_FIELD = struct.Struct("<H")
+MONO_TIME_FIELD = struct.Struct("<Q")
+
+
+def event_root(dat: bytes, offset: int = 0) -> Tuple[int, int]:
+  """Start and size of the root struct's data section of the message serialized at offset.
+  (-1, 0) if it can't be read without decoding: the message is cut short, or its root is a far pointer
+  or points outside of the first segment."""
+  if len(dat) - offset < SEGMENT_TABLE_START.size:
+    return -1, 0
+  num_segments, segment_words = SEGMENT_TABLE_START.unpack_from(dat, offset)
+  segment_start = offset + 8 * ((num_segments + 3) // 2)
+  segment_end = min(segment_start + 8 * segment_words, len(dat))
+  if segment_start + ROOT_POINTER.size > segment_end:
+    return -1, 0
+
+  pointer = ROOT_POINTER.unpack_from(dat, segment_start)[0]
+  if pointer & 3 != 0:
+    return -1, 0
+  # signed 30 bit offset in words, from the end of the pointer
+  data_offset = (pointer & 0xFFFFFFFF) >> 2
+  if data_offset & (1 << 29):
+    data_offset -= 1 << 30
+  data_start, data_size = segment_start + 8 * (1 + data_offset), 8 * ((pointer >> 32) & 0xFFFF)
+  if data_start < segment_start or data_start + data_size > segment_end:
+    return -1, 0
+  return data_start, data_size
+
+
+def event_fields(dat: bytes, data_start: int, data_size: int) -> Tuple[int, int, bool]:
+  """Union discriminant, logMonoTime and valid from the Event's data section at data_start.
+  Fields past the end of the data section have their default."""
+  which = WHICH_FIELD.unpack_from(dat, data_start + EVENT_WHICH_OFFSET)[0] if EVENT_WHICH_OFFSET + 2 <= data_size else 0
+  log_mono_time = MONO_TIME_FIELD.unpack_from(dat, data_start + EVENT_MONO_TIME_OFFSET)[0] if EVENT_MONO_TIME_OFFSET + 8 <= data_size else 0
+  valid = EVENT_VALID_DEFAULT
+  if EVENT_VALID_BIT // 8 < data_size:
+    # fields are stored XORed with their default
+    valid = bool((dat[data_start + EVENT_VALID_BIT // 8] >> (EVENT_VALID_BIT % 8)) & 1) != EVENT_VALID_DEFAULT
+  return which, log_mono_time, valid
+
+
+
+def event_header(dat: bytes) -> Optional[Tuple[str, int, bool]]:
+  """Service, logMonoTime and valid of a single serialized Event.
+  None if they can't be read without decoding it, or the event isn't one of the services."""
+  data_start, data_size = event_root(dat)
+  if data_start == -1:
+    return None
+  which, log_mono_time, valid = event_fields(dat, data_start, data_size)
+  service = EVENT_WHICH_NAMES.get(which)
+  return None if service is None else (service, log_mono_time, valid)
@@ -42,7 +42,7 @@ class Controls:
                                    'liveCalibration', 'livePose', 'longitudinalPlan', 'carState', 'carOutput',
                                    'driverMonitoringState', 'onroadEvents', 'driverAssistance',
                                    'radarState', 'lateralPlan', 'liveDelay'
-                                   ], poll='selfdriveState')
+                                   ], poll='selfdriveState', lazy=True)
     self.pm = messaging.PubMaster(['carControl', 'controlsState'])
 
     self.steer_limited_by_controls = False
@@ -22,7 +22,7 @@ def main():
   longitudinal_planner = LongitudinalPlanner(CP)
   pm = messaging.PubMaster(['longitudinalPlan', 'driverAssistance', 'lateralPlan'])
   sm = messaging.SubMaster(['carControl', 'carState', 'controlsState', 'liveParameters', 'radarState', 'modelV2', 'selfdriveState', 'naviObstacles'],
-                           poll='modelV2')
+                           poll='modelV2', lazy=True)
 
   while True:
     sm.update()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from cereal import log
+from openpilot.tools.lib.logreader import decompress_bz2, decompress_stream, save_log
+
+N_MESSAGES = 100_000
+FRAME_SIZE = 4 * 1024 * 1024
+
+
+def generate_log(num_msgs: int) -> list:
+  # can data is random, so it compresses about as badly as the real thing
+  rng = random.Random(0)
+  msgs = []
+  for i in range(num_msgs):
+    msg = log.Event.new_message(logMonoTime=i * 10_000_000)
+    for j, c in enumerate(msg.init("can", 8)):
+      c.address = (i + j) % 2048
+      c.dat = rng.randbytes(8)
+    msgs.append(msg.as_reader())
+  return msgs
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Decompression throughput of logs in one or many zstd frames and bz2 streams")
+  parser.add_argument("--messages", type=int, default=N_MESSAGES)
+  parser.add_argument("--threads", type=int, nargs="+", default=[1, 4])
+  args = parser.parse_args()
+
+  msgs = generate_log(args.messages)
+  print(f'{args.messages} messages, MB/s of decompressed data')
+  print(f'{"log":>12} {"MB":>6} ' + ' '.join(f'{f"{t} threads":>10}' for t in args.threads))
+  for name, ext, frame_size in (("zst", ".zst", None), ("zst_frames", ".zst", FRAME_SIZE), ("bz2", ".bz2", None), ("bz2_streams", ".bz2", FRAME_SIZE)):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fn = os.path.join(tmpdir, "rlog" + ext)
+      save_log(fn, msgs, frame_size=frame_size)
+      with open(fn, "rb") as f:
+        dat = f.read()
+
+    decompress = decompress_stream if ext == ".zst" else decompress_bz2
+    speeds, expected = [], None
+    for threads in args.threads:
+      # wall time, the frames are decompressed in parallel
+      start_t = time.monotonic()
+      out = decompress(dat, threads=threads)
+      speeds.append(len(out) / 1e6 / (time.monotonic() - start_t))
+      assert expected is None or out == expected, f"{name} differs with {threads} threads"
+      expected = out
+    print(f'{name:>12} {len(dat) / 1e6:>6.1f} ' + ' '.join(f'{s:>10.1f}' for s in speeds))
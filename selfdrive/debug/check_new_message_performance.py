@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+import cereal.messaging as messaging
+from cereal import log
+
+N_MESSAGES = 20000
+SEGMENT = bytearray(8 * 1024)
+
+# pycapnp can't reset a message in place: a reused message either keeps the fields of its last publish,
+# or grows by a new root struct every cycle. Building into a reused, zeroed segment is the only way to
+# reuse memory and start from defaults, and it's no quicker than a new message, so new_message doesn't pool
+
+
+def new_message(s: str, size: int | None) -> bytes:
+  return messaging.new_message(s, size).to_bytes()
+
+
+def reused_segment(s: str, size: int | None) -> bytes:
+  def allocate(words: int) -> bytearray:
+    if 8 * words > len(SEGMENT):
+      return bytearray(8 * words)
+    SEGMENT[:] = bytes(len(SEGMENT))
+    return SEGMENT
+
+  dat = log.Event.new_message(allocate_seg_callable=allocate, valid=False, logMonoTime=int(time.monotonic() * 1e9))
+  if size is None:
+    dat.init(s)
+  else:
+    dat.init(s, size)
+  return dat.to_bytes()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Cost of building and serializing a message, new or in a reused segment")
+  parser.add_argument("--services", nargs="+", default=["carState", "controlsState", "can:64"], help="service, or service:list size")
+  args = parser.parse_args()
+
+  print(f'{N_MESSAGES} messages per case, us per message')
+  print(f'{"service":>16} {"new":>8} {"reused":>8}')
+  for service in args.services:
+    s, _, size = service.partition(":")
+    times = []
+    for build in (new_message, reused_segment):
+      start_t = time.process_time_ns()
+      for _ in range(N_MESSAGES):
+        build(s, int(size) if size else None)
+      times.append((time.process_time_ns() - start_t) * 1e-3 / N_MESSAGES)
+    print(f'{service:>16} ' + ' '.join(f'{t:>8.2f}' for t in times))
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+import cereal.messaging as messaging
+from cereal.services import SERVICE_LIST
+
+N_UPDATES = 10000
+
+
+def new_message(s: str) -> bytes:
+  try:
+    return messaging.new_message(s).to_bytes()
+  except Exception:
+    return messaging.new_message(s, 0).to_bytes()  # lists
+
+
+def time_update(services: list[str], n_updated: int, lazy: bool) -> float:
+  """us per SubMaster.update_msgs with n_updated of the services receiving a message"""
+  sm = messaging.SubMaster(services, lazy=lazy)
+  msgs = [new_message(s) for s in services[:n_updated]]
+  # SubMaster.update receives readers unless it's lazy
+  msgs = msgs if lazy else [messaging.log_from_bytes(m) for m in msgs]
+
+  start_t = time.process_time_ns()
+  for i in range(N_UPDATES):
+    sm.update_msgs(i * 0.01, msgs)
+  return (time.process_time_ns() - start_t) * 1e-3 / N_UPDATES
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Cost of SubMaster.update_msgs by the number of services")
+  parser.add_argument("--services", type=int, nargs="+", default=[1, 5, 10, 20, 40])
+  args = parser.parse_args()
+
+  all_services = [s for s in SERVICE_LIST if SERVICE_LIST[s].frequency > 0]
+  print(f'{N_UPDATES} updates per case, us per update')
+  print(f'{"services":>8} {"one updated":>12} {"all updated":>12} {"one, lazy":>12} {"all, lazy":>12}')
+  for n in args.services:
+    services = all_services[:n]
+    times = [time_update(services, n_updated, lazy) for lazy in (False, True) for n_updated in (1, n)]
+    print(f'{n:>8} ' + ' '.join(f'{t:>12.2f}' for t in times))
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+import numpy as np
+import requests
+
+from openpilot.tools.lib.vidindex import hevc_index_data, hevc_index_reference
+
+VIDEO_URL = "https://github.com/commaai/comma2k19/blob/master/Example_1/b0c9d2329ad1606b%7C2018-08-02--08-34-47/40/video.hevc?raw=true"
+N_RUNS = 5
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Time the numpy hevc indexer against the reference one")
+  parser.add_argument("video", nargs="?", default=VIDEO_URL, help="path or url of an hevc video, the comma2k19 example by default")
+  parser.add_argument("--runs", type=int, default=N_RUNS)
+  args = parser.parse_args()
+
+  if args.video.startswith(("http://", "https://")):
+    dat = requests.get(args.video, timeout=30).content
+  else:
+    with open(args.video, "rb") as f:
+      dat = f.read()
+
+  result = hevc_index_data(dat)
+  assert result == hevc_index_reference(dat), "the numpy index differs from the reference"
+  print(f'{len(result[0])} frames, {len(dat) / 1e6:.1f} MB, {args.runs} runs')
+  for name, index in (("reference", hevc_index_reference), ("numpy", hevc_index_data)):
+    ets = []
+    for _ in range(args.runs):
+      start_t = time.process_time_ns()
+      index(dat)
+      ets.append((time.process_time_ns() - start_t) * 1e-6)
+    print(f'{name:>9}: {np.mean(ets):.2f} mean ms, {min(ets):.2f} min ms')
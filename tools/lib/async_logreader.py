@@ -0,0 +1,61 @@
+import asyncio
+import itertools
+from collections.abc import AsyncIterator, Iterable
+
+import aiohttp
+
+from openpilot.tools.lib.async_url_file import new_session, read_file
+from openpilot.tools.lib.logreader import _LogFileReader
+
+MAX_IN_FLIGHT = 100  # logs downloaded, parsed or waiting to be iterated over at once
+
+
+def _parse_log(fn: str, dat: bytes, reader_kwargs: dict) -> _LogFileReader:
+  lr = _LogFileReader(fn, dat=dat, **reader_kwargs)
+  if not reader_kwargs.get("stream"):
+    lr._get_ents()
+  return lr
+
+
+async def iter_logs(fns: Iterable[str], max_in_flight: int = MAX_IN_FLIGHT, ordered: bool = False,
+                    session: aiohttp.ClientSession | None = None, cache: bool | None = None,
+                    **reader_kwargs) -> AsyncIterator[tuple[str, _LogFileReader]]:
+  """
+    Downloads and parses the logs fns concurrently, yielding (fn, reader) as each one is ready, or in
+    the order of fns if ordered. Decompressing and parsing run in threads, off the event loop.
+
+      async for fn, lr in iter_logs(qlog_paths):
+        ...
+  """
+  assert max_in_flight > 0
+  own_session = session is None
+  session = new_session() if session is None else session
+
+  async def load(fn: str) -> tuple[str, _LogFileReader]:
+    dat = await read_file(fn, session, cache=cache)
+    return fn, await asyncio.to_thread(_parse_log, fn, dat, reader_kwargs)
+
+  fns = iter(fns)
+  pending: list[asyncio.Task] = []
+  try:
+    while True:
+      # new downloads start as soon as a log is handed out, up to max_in_flight
+      pending.extend(asyncio.create_task(load(fn)) for fn in itertools.islice(fns, max_in_flight - len(pending)))
+      if not pending:
+        break
+      if ordered:
+        done = [pending.pop(0)]
+        await done[0]
+      else:
+        finished, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        done = [t for t in pending if t in finished]
+        pending = [t for t in pending if t not in finished]
+      for task in done:
+        yield task.result()
+  finally:
+    for task in pending:
+      task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    if own_session:
+      await session.close()
+
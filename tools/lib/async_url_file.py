@@ -0,0 +1,153 @@
+import asyncio
+import os
+import aiohttp
+from collections.abc import Mapping
+
+from openpilot.system.hardware.hw import Paths
+from openpilot.tools.lib.filereader import resolve_name
+from openpilot.tools.lib.url_file import CHUNK_SIZE, RETRIES, RETRY_BACKOFF, RETRY_STATUSES, DownloadCacheIndex, check_response
+
+MAX_CONNECTIONS = int(os.getenv("ASYNC_URLFILE_CONNECTIONS", "100"))  # connections a session keeps open at once, across all hosts
+
+
+def new_session(max_connections: int = MAX_CONNECTIONS, timeout: int = 10) -> aiohttp.ClientSession:
+  """A session for AsyncURLFiles, its pool of connections is shared by all of them and limits the requests in flight"""
+  connector = aiohttp.TCPConnector(limit=max_connections, limit_per_host=0, keepalive_timeout=30)
+  return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout))
+
+
+class AsyncURLFile:
+  """
+    URLFile for asyncio, reads are awaited so one thread can have many in flight.
+    The download cache is shared with URLFile, chunks cached by one are read by the other.
+  """
+  def __init__(self, url: str, session: aiohttp.ClientSession, cache: bool|None = None):
+    self._url = url
+    self._session = session
+    self._pos = 0
+    self._length: int|None = None
+    #  True by default, false if FILEREADER_CACHE is defined, but can be overwritten by the cache input
+    self._force_download = not int(os.environ.get("FILEREADER_CACHE", "0"))
+    if cache is not None:
+      self._force_download = not cache
+    self._cache_index: DownloadCacheIndex|None = None
+
+    if not self._force_download:
+      os.makedirs(Paths.download_cache_root(), exist_ok=True)
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+    pass
+
+  async def _request(self, method: str, headers: dict[str, str]|None = None) -> tuple[int, Mapping[str, str], bytes]:
+    # (status, headers, body), retried like URLFile's requests
+    attempt = 0
+    while True:
+      try:
+        async with self._session.request(method, self._url, headers=headers) as response:
+          if attempt >= RETRIES or response.status not in RETRY_STATUSES:
+            return response.status, response.headers.copy(), await response.read()
+      except (TimeoutError, aiohttp.ClientError):
+        if attempt >= RETRIES:
+          raise
+      await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+      attempt += 1
+
+  @property
+  def _cache(self) -> DownloadCacheIndex:
+    if self._cache_index is None:
+      self._cache_index = DownloadCacheIndex(self._url)
+    return self._cache_index
+
+  async def get_length_online(self) -> int:
+    status, headers, _ = await self._request('HEAD')
+    if not (200 <= status <= 299):
+      return -1
+    return int(headers.get('Content-Length', 0))
+
+  async def get_length(self) -> int:
+    if self._length is not None:
+      return self._length
+
+    if not self._force_download and self._cache.length is not None:
+      self._length = self._cache.length
+      return self._length
+
+    self._length = await self.get_length_online()
+    if not self._force_download and self._length != -1:
+      await asyncio.to_thread(self._cache.set_length, self._length)
+    return self._length
+
+  async def _get(self, headers: dict[str, str], download_range: bool) -> bytes:
+    status, _, ret = await self._request('GET', headers)
+    check_response(self._url, status, headers, download_range, ret)
+    return ret
+
+  async def _download_range(self, start: int, end: int) -> bytes:
+    if start >= end:
+      return b""
+    return await self._get({'Range': f"bytes={start}-{end - 1}"}, True)
+
+  async def _load_chunk(self, chunk: int) -> bytes:
+    # the cache's files are read and written in threads, so they don't hold up other downloads
+    if not self._force_download and (data := await asyncio.to_thread(self._cache.get, chunk)) is not None:
+      return data
+
+    start = chunk * CHUNK_SIZE
+    data = await self._download_range(start, min(start + CHUNK_SIZE, await self.get_length()))
+    if not self._force_download:
+      await asyncio.to_thread(self._cache.put, chunk, data)
+    return data
+
+  async def read(self, ll: int|None = None) -> bytes:
+    if self._force_download and ll is None and self._pos == 0:
+      # one GET streams the whole file without any round trips in between
+      ret = await self._get({}, False)
+      self._pos += len(ret)
+      return ret
+
+    file_begin = self._pos
+    length = await self.get_length()
+    assert length != -1, f"Remote file is empty or doesn't exist: {self._url}"
+    file_end = length if ll is None else min(file_begin + ll, length)
+    if file_begin >= file_end:
+      return b""
+    if not self._force_download:
+      await asyncio.to_thread(self._cache.touch)
+
+    # the chunks are fetched concurrently, without the cache only the bytes that are read are downloaded
+    pieces = []
+    for chunk in range(file_begin // CHUNK_SIZE, (file_end - 1) // CHUNK_SIZE + 1):
+      start, end = max(file_begin, chunk * CHUNK_SIZE), min(file_end, (chunk + 1) * CHUNK_SIZE)
+      if self._force_download:
+        pieces.append((self._download_range(start, end), 0, end - start))
+      else:
+        pieces.append((self._load_chunk(chunk), start - chunk * CHUNK_SIZE, end - chunk * CHUNK_SIZE))
+    chunks = await asyncio.gather(*(p for p, _, _ in pieces))
+    self._pos = file_end
+    return b"".join(dat[a:b] for dat, (_, a, b) in zip(chunks, pieces, strict=True))
+
+  def seek(self, pos: int) -> None:
+    self._pos = pos
+
+  def tell(self) -> int:
+    return self._pos
+
+  @property
+  def name(self) -> str:
+    return self._url
+
+
+async def read_file(fn: str, session: aiohttp.ClientSession, cache: bool|None = None) -> bytes:
+  """The contents of fn, a url or a local file like FileReader opens"""
+  fn = resolve_name(fn)
+  if fn.startswith(("http://", "https://")):
+    async with AsyncURLFile(fn, session, cache=cache) as f:
+      return await f.read()
+
+  def read_local() -> bytes:
+    with open(fn, "rb") as f:
+      return f.read()
+  return await asyncio.to_thread(read_local)
@@ -0,0 +1,80 @@
+from collections.abc import Sequence
+
+import numpy as np
+
+from openpilot.tools.lib.framereader import FrameReader
+from openpilot.tools.lib.logreader import LogReader
+from openpilot.tools.lib.route import Route, SegmentRange
+
+# camera: (encode index service, Route method listing its videos)
+CAMERAS = {
+  "road": ("roadEncodeIdx", "camera_paths"),
+  "driver": ("driverEncodeIdx", "dcamera_paths"),
+  "wide": ("wideRoadEncodeIdx", "ecamera_paths"),
+}
+
+
+class CameraReader:
+  """
+    Frames of one camera across the segments of a route, looked up by time.
+
+    The frame timestamps come from the camera's *EncodeIdx events, which are read once through the
+    time series cache, so looking up a frame is a binary search instead of a scan of the logs.
+    Frames are decoded by a FrameReader per segment, created on first use with frame_reader_kwargs.
+  """
+  def __init__(self, identifier: str | list[str], camera: str = "road", video_paths: Sequence[str | None] | dict[int, str] | None = None,
+               timestamp: str = "timestampEof", **frame_reader_kwargs):
+    if camera not in CAMERAS:
+      raise ValueError(f"unknown camera {camera!r}, expected one of {sorted(CAMERAS)}")
+    self.service, paths_method = CAMERAS[camera]
+
+    if video_paths is None:
+      video_paths = getattr(Route(SegmentRange(identifier).route_name), paths_method)()
+    self.video_paths = dict(video_paths) if isinstance(video_paths, dict) else dict(enumerate(video_paths))
+    self.frame_reader_kwargs = frame_reader_kwargs
+    self._frame_readers: dict[int, FrameReader] = {}
+
+    # (timestamp, segment, frame) of every encoded frame, sorted by timestamp
+    # timestamp is a field of the encode index (when the frame was captured), or the logMonoTime of its event
+    fields = [f"{self.service}/{name}" for name in ("segmentNum", "segmentId", timestamp) if name != "logMonoTime"]
+    ts = LogReader(identifier, services=[self.service]).get_time_series(fields, cache=True).get(self.service, {})
+    if timestamp == "logMonoTime":
+      timestamps = np.round(np.asarray(ts.get("t", []), dtype=np.float64) * 1e9).astype(np.int64)
+    else:
+      timestamps = np.asarray(ts.get(timestamp, []), dtype=np.int64)
+    order = np.argsort(timestamps, kind='stable')
+    self.timestamps = timestamps[order]
+    self.segments = np.asarray(ts.get("segmentNum", []), dtype=np.int64)[order]
+    self.frame_ids = np.asarray(ts.get("segmentId", []), dtype=np.int64)[order]
+
+  def __len__(self) -> int:
+    return len(self.timestamps)
+
+  def frame_index(self, mono_time: int) -> tuple[int, int] | None:
+    """(segment, frame index) of the last frame at or before mono_time"""
+    i = int(np.searchsorted(self.timestamps, mono_time, side="right")) - 1
+    if i < 0:
+      return None
+    return int(self.segments[i]), int(self.frame_ids[i])
+
+  def frame_reader(self, segment: int) -> FrameReader:
+    if segment not in self._frame_readers:
+      if self.video_paths.get(segment) is None:
+        raise FileNotFoundError(f"no {self.service} video for segment {segment}")
+      self._frame_readers[segment] = FrameReader(self.video_paths[segment], **self.frame_reader_kwargs)
+    return self._frame_readers[segment]
+
+  def get(self, segment: int, fidx: int) -> np.ndarray:
+    return self.frame_reader(segment).get(fidx)
+
+  def frame_at(self, mono_time: int) -> np.ndarray | None:
+    """The frame that was the camera's latest at mono_time, None before the first frame"""
+    idx = self.frame_index(mono_time)
+    if idx is None:
+      return None
+    return self.get(*idx)
+
+  def close(self) -> None:
+    for fr in self._frame_readers.values():
+      fr.close()
+    self._frame_readers.clear()
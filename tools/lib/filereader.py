@@ -3,7 +3,7 @@ import posixpath
 import socket
 from urllib.parse import urlparse
 
-from openpilot.tools.lib.url_file import URLFile
+from openpilot.tools.lib.url_file import URLFile, hash_256
 
 DATA_ENDPOINT = os.getenv("DATA_ENDPOINT", "http://data-raw.comma.internal/")
 
@@ -30,6 +30,17 @@ def resolve_name(fn):
   return fn
 
 
+def file_cache_key(fn: str) -> str:
+  """Key for caching what's derived from the file, local files are keyed on their size and mtime too"""
+  fn = resolve_name(fn)
+  key = fn
+  if os.path.isfile(fn):
+    # local files can be replaced, make sure a stale cache isn't picked up
+    st = os.stat(fn)
+    key = f"{os.path.abspath(fn)}:{st.st_size}:{st.st_mtime_ns}"
+  return hash_256(key)
+
+
 def file_exists(fn):
   fn = resolve_name(fn)
   if fn.startswith(("http://", "https://")):
@@ -37,6 +48,22 @@ def file_exists(fn):
   return os.path.exists(fn)
 
 
+def read_all(f) -> bytes | bytearray:
+  """The rest of the open file f, read straight into one buffer of its size"""
+  if isinstance(f, URLFile) and f.tell() == 0 and not f.cache_enabled:
+    # the body of a single GET is already the only copy, and it doesn't need the length first
+    return f.read()
+  size = (f.get_length() if isinstance(f, URLFile) else os.fstat(f.fileno()).st_size) - f.tell()
+  buf = bytearray(max(size, 0))
+  view, pos = memoryview(buf), 0
+  while pos < len(buf) and (n := f.readinto(view[pos:])):
+    pos += n
+  del view
+  if pos < len(buf):
+    del buf[pos:]
+  return buf
+
+
 def FileReader(fn, debug=False):
   fn = resolve_name(fn)
   if fn.startswith(("http://", "https://")):
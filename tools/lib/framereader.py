@@ -1,11 +1,21 @@
 import os
 import subprocess
 import json
+import fcntl
+import hashlib
+import itertools
+import tempfile
+import threading
 from collections.abc import Iterator
+from fractions import Fraction
 from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
 
 import numpy as np
-from openpilot.tools.lib.filereader import FileReader, resolve_name
+from openpilot.common.file_helpers import atomic_write_in_dir
+from openpilot.system.hardware.hw import Paths
+from openpilot.tools.lib.filereader import FileReader, file_cache_key, resolve_name
 from openpilot.tools.lib.exceptions import DataUnreadableError
 from openpilot.tools.lib.vidindex import hevc_index
 
@@ -14,6 +24,14 @@ HEVC_SLICE_B = 0
 HEVC_SLICE_P = 1
 HEVC_SLICE_I = 2
 
+DECODE_READ_SIZE = 1024 * 1024  # bytes of video read from the source and fed to the decoder at once
+
+Crop = tuple[int, int, int, int]  # x, y, width, height
+
+# end of sequence and access unit delimiter NAL units, fed after each read to an ffmpeg that's kept running.
+# the delimiter ends the access unit of the last frame, so ffmpeg decodes it without waiting for more video
+HEVC_READ_END = b"\x00\x00\x01\x48\x01" + b"\x00\x00\x01\x46\x01\x50"
+
 
 class LRUCache:
   def __init__(self, capacity: int):
@@ -33,6 +51,133 @@ class LRUCache:
     return key in self._cache
 
 
+class SharedFrameCache:
+  """Ring of decoded frames in shared memory, frame fidx lives in slot fidx % capacity.
+
+  The process that creates the ring writes to it (frames are decoded straight into their slot),
+  other processes attach to it by name and read copies of the frames from it. Each slot has a sequence number that's odd
+  while the slot is being written, so readers never return a frame that was overwritten mid-copy. Between processes each
+  slot is also locked while it's written or read, which orders the writes to the shared memory before the reads"""
+  MAGIC = 0x4652414d45524e47
+  HEADER = 128  # padded to cache lines
+  # what the frames are, a crop of (0, 0, 0, 0) is no crop
+  HEADER_DTYPE = np.dtype([("magic", "<i8"), ("capacity", "<i8"), ("frame_size", "<i8"),
+                           ("pix_fmt", "S16"), ("crop", "<i8", 4), ("scale", "<f8")])
+
+  def __init__(self, shape: tuple[int, ...], capacity: int = 0, name: str | None = None, create: bool = True,
+               pix_fmt: str = "rgb24", crop: Crop | None = None, scale: float = 1.0):
+    self.shape = shape
+    self.pix_fmt, self.crop, self.scale = pix_fmt, None if crop is None else tuple(int(v) for v in crop), float(scale)
+    frame_size = int(np.prod(shape))
+    if create:
+      slots_size = self.HEADER * (-(-capacity * 16 // self.HEADER))
+      self.shm = shared_memory.SharedMemory(name, create=True, size=self.HEADER + slots_size + capacity * frame_size)
+      np.ndarray((), self.HEADER_DTYPE, self.shm.buf)[()] = (self.MAGIC, capacity, frame_size, pix_fmt, self.crop or (0, 0, 0, 0), scale)
+    else:
+      self.shm = shared_memory.SharedMemory(name)
+      # only the creator unlinks the memory, the resource tracker would remove it when a reader exits.
+      # it's tracked by its POSIX name, which has a leading slash
+      resource_tracker.unregister(f"/{self.shm.name}", "shared_memory")
+      header = np.ndarray((), self.HEADER_DTYPE, self.shm.buf)[()].copy()
+      if (header["magic"] != self.MAGIC or header["frame_size"] != frame_size or header["pix_fmt"].decode() != pix_fmt or
+          tuple(header["crop"]) != (self.crop or (0, 0, 0, 0)) or header["scale"] != scale):
+        self.shm.close()
+        raise ValueError(f"{name!r} is not a shared frame cache for {pix_fmt} frames of shape {shape}, cropped to {crop} and scaled by {scale}")
+      capacity = int(header["capacity"])
+      slots_size = self.HEADER * (-(-capacity * 16 // self.HEADER))
+    self.name = self.shm.name
+    self.capacity = int(capacity)
+    self.writable = create
+    # byte i of the lock file locks slot i
+    self._lock_path = os.path.join(tempfile.gettempdir(), f"{self.name}.lock")
+    self._lock_fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o600) if create else os.open(self._lock_path, os.O_RDONLY)
+    # per slot: the sequence number and the index of the frame in it
+    self._slots = np.ndarray((self.capacity, 2), np.int64, self.shm.buf, self.HEADER)
+    self._frames = np.ndarray((self.capacity, *shape), np.uint8, self.shm.buf, self.HEADER + slots_size)
+    if create:
+      self._slots[:] = (0, -1)
+    else:
+      self._frames.flags.writeable = False
+
+  def _lock_read(self, slot: int) -> bool:
+    # False while the writer has the slot. locks only exclude other processes, threads check the sequence number
+    try:
+      fcntl.lockf(self._lock_fd, fcntl.LOCK_SH | fcntl.LOCK_NB, 1, slot)
+    except (BlockingIOError, PermissionError):
+      return False
+    return True
+
+  def _unlock(self, slot: int) -> None:
+    fcntl.lockf(self._lock_fd, fcntl.LOCK_UN, 1, slot)
+
+  def __contains__(self, fidx: int) -> bool:
+    slot = fidx % self.capacity
+    if not self._lock_read(slot):
+      return False
+    try:
+      seq, tag = self._slots[slot]
+      return seq % 2 == 0 and tag == fidx
+    finally:
+      self._unlock(slot)
+
+  def get(self, fidx: int) -> np.ndarray | None:
+    """A copy of the frame, or None if it's not in the ring"""
+    slot = fidx % self.capacity
+    if not self._lock_read(slot):
+      return None
+    try:
+      seq = self._slots[slot, 0]
+      if seq % 2 or self._slots[slot, 1] != fidx:
+        return None
+      frame = self._frames[slot].copy()
+      return frame if self._slots[slot, 0] == seq else None
+    finally:
+      self._unlock(slot)
+
+  def begin_write(self, fidx: int) -> np.ndarray:
+    """The slot to write frame fidx to, it reads as empty until end_write. It's a view of the shared memory,
+    which must not be used once the ring is closed"""
+    slot = fidx % self.capacity
+    fcntl.lockf(self._lock_fd, fcntl.LOCK_EX, 1, slot)
+    self._slots[slot, 0] += 1 + self._slots[slot, 0] % 2
+    self._slots[slot, 1] = fidx
+    return self._frames[slot]
+
+  def end_write(self, fidx: int) -> None:
+    slot = fidx % self.capacity
+    self._slots[slot, 0] += 1
+    self._unlock(slot)
+
+  def put(self, fidx: int, frame: np.ndarray) -> None:
+    self.begin_write(fidx)[...] = frame
+    self.end_write(fidx)
+
+  def close(self) -> None:
+    del self._slots, self._frames
+    self.shm.close()
+    os.close(self._lock_fd)
+    if self.writable:
+      self.shm.unlink()
+      os.unlink(self._lock_path)
+
+
+def shared_frame_cache_name(fn: str, pix_fmt: str = "rgb24", crop: Crop | None = None, scale: float = 1.0) -> str:
+  # the same name in every process reading the same video into the same frames
+  crop = None if crop is None else tuple(int(v) for v in crop)
+  return "frames_" + hashlib.sha256(f"{fn}:{pix_fmt}:{crop}:{float(scale)}".encode()).hexdigest()[:16]
+
+def readinto_full(f, buf: np.ndarray) -> bool:
+  # fill buf from the file, False if it ends before that
+  view = memoryview(buf).cast("B")
+  pos = 0
+  while pos < len(view):
+    n = f.readinto(view[pos:])
+    if not n:
+      return False
+    pos += n
+  return True
+
+
 def assert_hvec(fn: str) -> None:
   with FileReader(fn) as f:
     header = f.read(4)
@@ -42,27 +187,60 @@ def assert_hvec(fn: str) -> None:
     if 'hevc' not in fn:
       raise NotImplementedError(fn)
 
-def decompress_video_data(rawdat, w, h, pix_fmt="rgb24", vid_fmt='hevc') -> np.ndarray:
+def video_filters(w: int, h: int, pix_fmt: str = "rgb24", crop: Crop | None = None,
+                  scale: float = 1.0) -> tuple[list[tuple[str, str]], int, int]:
+  """The ffmpeg filters that crop and then scale w x h frames, and the size of the frames they output"""
+  filters = []
+  if crop is not None:
+    x, y, w_crop, h_crop = crop
+    if not (0 <= x and 0 <= y and 0 < w_crop and 0 < h_crop and x + w_crop <= w and y + h_crop <= h):
+      raise ValueError(f"crop {crop} is not inside the {w}x{h} frame")
+    if pix_fmt != "rgb24" and any(v % 2 for v in crop):
+      raise ValueError(f"crop {crop} must be even for {pix_fmt}")
+    filters.append(("crop", f"{w_crop}:{h_crop}:{x}:{y}"))
+    w, h = w_crop, h_crop
+  if scale != 1.0:
+    if not 0 < scale <= 1:
+      raise ValueError(f"scale must be in (0, 1], not {scale}")
+    # even, so the chroma planes of yuv frames stay whole
+    w, h = max(2, round(w * scale / 2) * 2), max(2, round(h * scale / 2) * 2)
+    filters.append(("scale", f"{w}:{h}:flags=area"))
+  return filters, w, h
+
+def ffmpeg_decode_args(pix_fmt="rgb24", vid_fmt='hevc', filters: list[tuple[str, str]] | None = None, stream: bool = False) -> list[str]:
   threads = os.getenv("FFMPEG_THREADS", "0")
-  args = ["ffmpeg", "-v", "quiet",
+  # filters run inside ffmpeg, so only the cropped and scaled frames are converted and piped out
+  vf = ["-vf", ",".join(f"{name}={args}" for name, args in filters)] if filters else []
+  # a stream is kept running and fed more video after its frames are read out, so nothing may wait for more input:
+  # frame threads hold frames back, probing waits for probesize bytes, and the output is flushed after every frame.
+  # it exits on decoding errors, a frame that isn't output would leave the read waiting for it
+  stream_in = ["-thread_type", "slice", "-probesize", "32", "-analyzeduration", "0", "-xerror"] if stream else []
+  stream_out = ["-flush_packets", "1"] if stream else []
+  return ["ffmpeg", "-v", "quiet",
           "-threads", threads,
+          *stream_in,
           "-c:v", "hevc",
           "-vsync", "0",
           "-f", vid_fmt,
           "-flags2", "showall",
           "-i", "-",
+          *vf,
+          *stream_out,
           "-f", "rawvideo",
           "-pix_fmt", pix_fmt,
           "-"]
-  dat = subprocess.check_output(args, input=rawdat)
 
+def frame_shape(w: int, h: int, pix_fmt: str) -> tuple[int, ...]:
   if pix_fmt == "rgb24":
-    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, h, w, 3)
+    return (h, w, 3)
   elif pix_fmt in ["nv12", "yuv420p"]:
-    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, (h*w*3//2))
-  else:
-    raise NotImplementedError(f"Unsupported pixel format: {pix_fmt}")
-  return ret
+    return (h*w*3//2,)
+  raise NotImplementedError(f"Unsupported pixel format: {pix_fmt}")
+
+def decompress_video_data(rawdat, w, h, pix_fmt="rgb24", vid_fmt='hevc', crop: Crop | None = None, scale: float = 1.0) -> np.ndarray:
+  filters, w, h = video_filters(w, h, pix_fmt, crop, scale)
+  dat = subprocess.check_output(ffmpeg_decode_args(pix_fmt, vid_fmt, filters), input=rawdat)
+  return np.frombuffer(dat, dtype=np.uint8).reshape(-1, *frame_shape(w, h, pix_fmt))
 
 def ffprobe(fn, fmt=None):
   fn = resolve_name(fn)
@@ -86,26 +264,72 @@ def get_index_data(fn: str, index_data: dict|None = None):
   stream = index_data["probe"]["streams"][0]
   return index_data["index"], index_data["global_prefix"], stream["width"], stream["height"]
 
-def get_video_index(fn):
+def video_index_cache_path(fn: str) -> str:
+  return os.path.join(Paths.download_cache_root(), file_cache_key(fn) + "_vidindex.npz")
+
+def load_video_index(fn: str) -> dict | None:
+  try:
+    with np.load(video_index_cache_path(fn)) as dat:
+      return {
+        'index': dat['index'],
+        'global_prefix': dat['global_prefix'].tobytes(),
+        'probe': json.loads(str(dat['probe'])),
+      }
+  except (OSError, ValueError, KeyError):
+    return None
+
+def save_video_index(fn: str, index_data: dict) -> None:
+  path = video_index_cache_path(fn)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with atomic_write_in_dir(path, mode="wb", overwrite=True) as f:
+    np.savez(f, index=index_data['index'], global_prefix=np.frombuffer(index_data['global_prefix'], dtype=np.uint8),
+             probe=np.array(json.dumps(index_data['probe'])))
+
+def get_video_index(fn, cache: bool = True):
+  # indexing reads the whole file, the index of a known file comes from the download cache instead
+  if cache and (index_data := load_video_index(fn)) is not None:
+    return index_data
   assert_hvec(fn)
   frame_types, dat_len, prefix = hevc_index(fn)
   index = np.array(frame_types + [(0xFFFFFFFF, dat_len)], dtype=np.uint32)
   probe = ffprobe(fn, "hevc")
-  return {
+  index_data = {
     'index': index,
     'global_prefix': prefix,
     'probe': probe
   }
+  if cache:
+    save_video_index(fn, index_data)
+  return index_data
+
+
+def stop_process(proc: subprocess.Popen, feeder: threading.Thread | None = None) -> None:
+  proc.kill()
+  proc.wait()
+  proc.stdout.close()
+  if feeder is not None:
+    feeder.join()
+  try:
+    proc.stdin.close()
+  except BrokenPipeError:
+    pass
 
 
 class FfmpegDecoder:
+  """Decodes with ffmpeg subprocesses. Each thread reading from the decoder has its own ffmpeg, which is kept running
+  and fed the GOPs of every read, it's only restarted when a read stops before all its frames are decoded"""
   def __init__(self, fn: str, index_data: dict|None = None,
-               pix_fmt: str = "rgb24"):
+               pix_fmt: str = "rgb24", crop: Crop | None = None, scale: float = 1.0):
     self.fn = fn
-    self.index, self.prefix, self.w, self.h = get_index_data(fn, index_data)
+    self.index, self.prefix, self.video_w, self.video_h = get_index_data(fn, index_data)
     self.frame_count = len(self.index) - 1          # sentinel row at the end
     self.iframes = np.where(self.index[:, 0] == HEVC_SLICE_I)[0]
     self.pix_fmt = pix_fmt
+    # w and h are the size of the decoded frames, after the crop and scale
+    self.filters, self.w, self.h = video_filters(self.video_w, self.video_h, pix_fmt, crop, scale)
+    self._procs: dict[int, subprocess.Popen] = {}  # by thread
+    self._closed = False
+    self._lock = threading.Lock()
 
   def _gop_bounds(self, frame_idx: int):
     f_b = frame_idx
@@ -119,38 +343,209 @@ class FfmpegDecoder:
   def _decode_gop(self, raw: bytes) -> Iterator[np.ndarray]:
     yield from decompress_video_data(raw, self.w, self.h, self.pix_fmt)
 
+  def _read_frames(self, f_b: int, f_e: int) -> Iterator[memoryview]:
+    # the encoded frames f_b up to f_e, in pieces of at most DECODE_READ_SIZE.
+    # the pieces are views of one buffer that's read into again for the next piece
+    off_b, off_e = int(self.index[f_b, 1]), int(self.index[f_e, 1])
+    buf = memoryview(bytearray(min(DECODE_READ_SIZE, max(off_e - off_b, 0))))
+    with FileReader(self.fn) as f:
+      f.seek(off_b)
+      while off_b < off_e:
+        n = f.readinto(buf[:min(len(buf), off_e - off_b)])
+        if not n:
+          break
+        off_b += n
+        yield buf[:n]
+
+  def _feed(self, stdin, f_b: int, f_e: int, stream: bool) -> None:
+    try:
+      stdin.write(self.prefix)
+      for dat in self._read_frames(f_b, f_e):
+        stdin.write(dat)
+      if stream:
+        stdin.write(HEVC_READ_END)
+        stdin.flush()
+    except (BrokenPipeError, ValueError):
+      pass  # the decoder was stopped early
+    finally:
+      if not stream:
+        try:
+          stdin.close()
+        except BrokenPipeError:
+          pass
+
+  def _process(self) -> subprocess.Popen:
+    # the ffmpeg of this thread, started again if the last one was stopped
+    with self._lock:
+      if self._closed:
+        raise ValueError("the decoder is closed")
+      proc = self._procs.get(threading.get_ident())
+      if proc is None or proc.poll() is not None:
+        args = ffmpeg_decode_args(self.pix_fmt, filters=self.filters, stream=True)
+        proc = self._procs[threading.get_ident()] = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+      return proc
+
+  def _pipe_frames(self, proc: subprocess.Popen, f_b: int, f_e: int, out: SharedFrameCache | None, stream: bool) -> Iterator[np.ndarray]:
+    # frames f_b up to f_e from proc, which is fed while they're read out. a stream is left running once they're all read
+    shape = frame_shape(self.w, self.h, self.pix_fmt)
+    feeder = threading.Thread(target=self._feed, args=(proc.stdin, f_b, f_e, stream), daemon=True)
+    feeder.start()
+    done = False
+    try:
+      fidx = f_b
+      while fidx < f_e and readinto_full(proc.stdout, frame := out.begin_write(fidx) if out is not None else np.empty(shape, dtype=np.uint8)):
+        if out is not None:
+          out.end_write(fidx)
+        fidx += 1
+        done = stream and fidx == f_e
+        yield frame
+      if fidx < f_e and proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    finally:
+      if done:
+        feeder.join()
+      else:
+        stop_process(proc, feeder)
+
+  def _decode_frames(self, f_b: int, f_e: int, out: SharedFrameCache | None = None) -> Iterator[np.ndarray]:
+    """Frames from f_b (the start of a GOP) up to f_e, yielded one at a time as soon as they're decoded.
+    Each frame is read straight into its own array, or into its slot of out.
+
+    The frames come from the ffmpeg of this thread. That one exits on decoding errors, the frames from there on
+    are decoded by an ffmpeg that's fed just this read instead, which goes on past errors"""
+    fidx = f_b
+    try:
+      for frame in self._pipe_frames(self._process(), f_b, f_e, out, stream=True):
+        fidx += 1
+        yield frame
+    except subprocess.CalledProcessError:
+      if self._closed:
+        return
+      args = ffmpeg_decode_args(self.pix_fmt, filters=self.filters)
+      frames = self._pipe_frames(subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE), f_b, f_e, out, stream=False)
+      try:
+        yield from itertools.islice(frames, fidx - f_b, None)
+      finally:
+        frames.close()
+
+  def close(self) -> None:
+    # reads still running in other threads stop when their ffmpeg exits, and no new ones are started
+    with self._lock:
+      self._closed = True
+      procs, self._procs = list(self._procs.values()), {}
+    for proc in procs:
+      stop_process(proc)
+
   def get_gop_start(self, frame_idx: int):
     return self.iframes[np.searchsorted(self.iframes, frame_idx, side="right") - 1]
 
   def get_iterator(self, start_fidx: int = 0, end_fidx: int|None = None,
-                   frame_skip: int = 1) -> Iterator[tuple[int, np.ndarray]]:
+                   frame_skip: int = 1, out: SharedFrameCache | None = None) -> Iterator[tuple[int, np.ndarray]]:
     end_fidx = end_fidx or self.frame_count
-    fidx = start_fidx
-    while fidx < end_fidx:
-      f_b, f_e, off_b, off_e = self._gop_bounds(fidx)
-      with FileReader(self.fn) as f:
-        f.seek(off_b)
-        raw = self.prefix + f.read(off_e - off_b)
-      # number of frames to discard inside this GOP before the wanted one
-      for i, frm in enumerate(decompress_video_data(raw, self.w, self.h, self.pix_fmt)):
+    if start_fidx >= end_fidx:
+      return
+    # all GOPs of the range are decoded in one go
+    f_b = self._gop_bounds(start_fidx)[0]
+    f_e = self._gop_bounds(end_fidx - 1)[1]
+    frames = self._decode_frames(f_b, f_e, out)
+    try:
+      for i, frm in enumerate(frames):
         fidx = f_b + i
         if fidx >= end_fidx:
           return
         elif fidx >= start_fidx and (fidx - start_fidx) % frame_skip == 0:
           yield fidx, frm
-      fidx += 1
+    finally:
+      frames.close()
+
+
+class PyAVDecoder(FfmpegDecoder):
+  """Decodes in process with PyAV, the codec is opened once and reused for every read"""
+  def __init__(self, fn: str, index_data: dict|None = None,
+               pix_fmt: str = "rgb24", crop: Crop | None = None, scale: float = 1.0):
+    super().__init__(fn, index_data, pix_fmt, crop, scale)
+    import av
+    self._av = av
+    self._local = threading.local()
+    self._shape = frame_shape(self.w, self.h, pix_fmt)
+
+  @property
+  def _codec(self):
+    # one codec per thread, so GOPs can be decoded in parallel
+    if not hasattr(self._local, "codec"):
+      self._local.codec = self._av.CodecContext.create("hevc", "r")
+      self._local.codec.options = {"flags2": "+showall", "threads": os.getenv("FFMPEG_THREADS", "0")}
+    return self._local.codec
+
+  def _filter_graph(self, frame):
+    # the crop and scale filters, set up from the first decoded frame. one graph per thread, like the codec
+    if getattr(self._local, "graph", None) is None:
+      graph = self._av.filter.Graph()
+      nodes = [graph.add_buffer(width=frame.width, height=frame.height, format=frame.format.name, time_base=Fraction(1, 1000))]
+      nodes += [graph.add(name, args) for name, args in self.filters]
+      nodes.append(graph.add("buffersink"))
+      graph.link_nodes(*nodes).configure()
+      self._local.graph = graph
+    return self._local.graph
+
+  def _to_ndarray(self, frame, fidx: int, out: SharedFrameCache | None) -> np.ndarray:
+    if self.filters:
+      graph = self._filter_graph(frame)
+      graph.push(frame)
+      frame = graph.pull()
+    arr = frame.to_ndarray(format=self.pix_fmt).reshape(self._shape)
+    if out is None:
+      return arr
+    out.put(fidx, arr)
+    return arr
+
+  def _decode_frames(self, f_b: int, f_e: int, out: SharedFrameCache | None = None) -> Iterator[np.ndarray]:
+    # frames are sent as packets straight from the index, the codec is flushed in case a previous read stopped early
+    codec = self._codec
+    codec.flush_buffers()
+    pending = b""
+    off = int(self.index[f_b, 1])  # file offset of pending
+    fidx, out_fidx = f_b, f_b
+    for dat in self._read_frames(f_b, f_e):
+      buf, pos = pending + dat, 0
+      while fidx < f_e and off + len(buf) >= self.index[fidx + 1, 1]:
+        end = int(self.index[fidx + 1, 1]) - off
+        packet = buf[pos:end]
+        if self.index[fidx, 0] == HEVC_SLICE_I:
+          packet = self.prefix + packet
+        pos, fidx = end, fidx + 1
+        for frame in codec.decode(self._av.Packet(packet)):
+          yield self._to_ndarray(frame, out_fidx, out)
+          out_fidx += 1
+      pending, off = buf[pos:], off + pos
+    for frame in codec.decode(None):
+      yield self._to_ndarray(frame, out_fidx, out)
+      out_fidx += 1
+
+
+DECODERS: dict[str, type[FfmpegDecoder]] = {
+  "ffmpeg": FfmpegDecoder,
+  "pyav": PyAVDecoder,
+}
 
 def FrameIterator(fn: str, index_data: dict|None=None,
                         pix_fmt: str = "rgb24",
-                        start_fidx:int=0, end_fidx=None, frame_skip:int=1) -> Iterator[np.ndarray]:
-  dec = FfmpegDecoder(fn, pix_fmt=pix_fmt, index_data=index_data)
-  for _, frame in dec.get_iterator(start_fidx=start_fidx, end_fidx=end_fidx, frame_skip=frame_skip):
-    yield frame
+                        start_fidx:int=0, end_fidx=None, frame_skip:int=1, decoder: str = "ffmpeg",
+                        crop: Crop | None = None, scale: float = 1.0) -> Iterator[np.ndarray]:
+  dec = DECODERS[decoder](fn, pix_fmt=pix_fmt, index_data=index_data, crop=crop, scale=scale)
+  try:
+    for _, frame in dec.get_iterator(start_fidx=start_fidx, end_fidx=end_fidx, frame_skip=frame_skip):
+      yield frame
+  finally:
+    dec.close()
 
 class FrameReader:
   def __init__(self, fn: str, index_data: dict|None = None,
-               cache_size: int = 30, pix_fmt: str = "rgb24"):
-    self.decoder = FfmpegDecoder(fn, index_data, pix_fmt)
+               cache_size: int = 30, pix_fmt: str = "rgb24", decoder: str = "ffmpeg", lookahead: int = 0,
+               shared_cache: SharedFrameCache | None = None, crop: Crop | None = None, scale: float = 1.0):
+    # decoder is "ffmpeg" (a subprocess that's kept running between reads) or "pyav" (in process, needs the av package).
+    # frames are cropped to crop (x, y, width, height) and then scaled by scale while they're decoded
+    self.decoder = DECODERS[decoder](fn, index_data, pix_fmt, crop, scale)
     self.iframes = self.decoder.iframes
     self._cache: LRUCache = LRUCache(cache_size)
     self.w, self.h, self.frame_count, = self.decoder.w, self.decoder.h, self.decoder.frame_count
@@ -159,14 +554,80 @@ class FrameReader:
     self.it: Iterator[tuple[int, np.ndarray]] | None = None
     self.fidx = -1
 
+    # with lookahead, the GOP of each read and the next lookahead GOPs are decoded in parallel on a pool of lookahead workers.
+    # only those GOPs are kept, older ones are dropped as reads move on. each worker keeps decoding with its own ffmpeg (or PyAV codec)
+    self.lookahead = lookahead
+    self._gop_starts = np.union1d([0], self.iframes).astype(int)
+    self._gops: dict[int, Future] = {}
+    self._executor = ThreadPoolExecutor(lookahead) if lookahead > 0 else None
+
+    # frames are read from the shared cache first. the reader that created it decodes into it (without lookahead).
+    # frames are always returned as copies, so they stay valid once the ring wraps around or is closed
+    self.shared_cache = shared_cache
+    if shared_cache is not None:
+      frames = (frame_shape(self.w, self.h, pix_fmt), pix_fmt, None if crop is None else tuple(crop), float(scale))
+      frames_cached = (shared_cache.shape, shared_cache.pix_fmt, shared_cache.crop, shared_cache.scale)
+      if frames_cached != frames:
+        raise ValueError(f"shared cache holds frames of shape, pixel format, crop and scale {frames_cached}, not {frames}")
+
+  def _decode_gop(self, gop: int) -> list[np.ndarray]:
+    f_e = self._gop_starts[gop + 1] if gop + 1 < len(self._gop_starts) else self.frame_count
+    return [frame for _, frame in self.decoder.get_iterator(self._gop_starts[gop], f_e)]
+
+  def _get_lookahead(self, fidx: int) -> np.ndarray:
+    gop = int(np.searchsorted(self._gop_starts, fidx, side="right")) - 1
+    for g in list(self._gops):
+      if not gop <= g <= gop + self.lookahead:
+        self._gops.pop(g).cancel()
+    for g in range(gop, min(gop + self.lookahead + 1, len(self._gop_starts))):
+      if g not in self._gops:
+        self._gops[g] = self._executor.submit(self._decode_gop, g)
+    return self._gops[gop].result()[fidx - self._gop_starts[gop]]
+
   def get(self, fidx:int):
+    if self.shared_cache is not None and self.shared_cache.writable:
+      return self._get_shared(fidx)
     if fidx in self._cache:  # If frame is cached, return it
       return self._cache[fidx]
+    if self.shared_cache is not None and (frame := self.shared_cache.get(fidx)) is not None:
+      self._cache[fidx] = frame
+      return frame
+    if self._executor is not None:
+      self._cache[fidx] = self._get_lookahead(fidx)
+      return self._cache[fidx]
+
     read_start = self.decoder.get_gop_start(fidx)
-    if not self.it or fidx < self.fidx or read_start != self.decoder.get_gop_start(self.fidx):  # If the frame is in a different GOP, reset the iterator
+    # one read keeps going across GOPs for sequential reads, a new one is only started to go back or skip GOPs
+    if not self.it or fidx < self.fidx or read_start > self.fidx + 1:
+      if self.it:
+        self.it.close()
       self.it = self.decoder.get_iterator(read_start)
       self.fidx = -1
     while self.fidx < fidx:
       self.fidx, frame = next(self.it)
       self._cache[self.fidx] = frame
     return self._cache[fidx]
+
+  def _get_shared(self, fidx: int) -> np.ndarray:
+    # like the sequential reads in get, with the frames decoded straight into the shared cache instead of the LRU cache
+    if (frame := self.shared_cache.get(fidx)) is not None:
+      return frame
+    read_start = self.decoder.get_gop_start(fidx)
+    if not self.it or fidx < self.fidx or read_start > self.fidx + 1:
+      if self.it:
+        self.it.close()
+      self.it = self.decoder.get_iterator(read_start, out=self.shared_cache)
+      self.fidx = -1
+    while self.fidx < fidx:
+      self.fidx, frame = next(self.it)
+    # the decoded frames are views of the ring
+    return frame.copy()
+
+  def close(self) -> None:
+    if self._executor is not None:
+      self._executor.shutdown(wait=False, cancel_futures=True)
+      self._gops.clear()
+    if self.it:
+      self.it.close()
+      self.it = None
+    self.decoder.close()
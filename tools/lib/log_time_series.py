@@ -1,48 +1,43 @@
+import operator
+import struct
+from collections import defaultdict
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass
+from functools import cache, partial
+
+import capnp
 import numpy as np
+from cereal import log
 
+# capnp type -> column kind. integers and floats are widened to int64/float64 so
+# columns behave like the python values they're read from
+INT_TYPES = ('int8', 'int16', 'int32', 'int64', 'uint8', 'uint16', 'uint32', 'uint64')
+FLOAT_TYPES = ('float32', 'float64')
+COLUMN_DEFAULTS = {'bool': False, 'int': 0, 'float': np.nan, 'enum': -1, 'text': "", 'data': b"", 'list': []}
+
+# capnp type -> (size in bits, raw numpy dtype) of fields stored in a struct's data section
+DATA_LAYOUTS = {
+  'bool': (1, None), 'enum': (16, '<u2'),
+  'int8': (8, '<i1'), 'int16': (16, '<i2'), 'int32': (32, '<i4'), 'int64': (64, '<i8'),
+  'uint8': (8, '<u1'), 'uint16': (16, '<u2'), 'uint32': (32, '<u4'), 'uint64': (64, '<u8'),
+  'float32': (32, '<f4'), 'float64': (64, '<f8'),
+}
+FLOAT_FORMATS = {'float32': ('<f', '<I'), 'float64': ('<d', '<Q')}
 
-def flatten_type_dict(d, sep="/", prefix=None):
-  res = {}
-  if isinstance(d, dict):
-    for key, val in d.items():
-      if prefix is None:
-        res.update(flatten_type_dict(val, prefix=key))
-      else:
-        res.update(flatten_type_dict(val, prefix=prefix + sep + key))
-    return res
-  elif isinstance(d, list):
-    return {prefix: np.array(d)}
-  else:
-    return {prefix: d}
-
-
-def get_message_dict(message, typ):
-  valid = message.valid
-  message = message._get(typ)
-  if not hasattr(message, 'to_dict') or typ in ('qcomGnss', 'ubloxGnss'):
-    # TODO: support these
-    #print("skipping", typ)
-    return
-
-  msg_dict = message.to_dict(verbose=True)
-  msg_dict = flatten_type_dict(msg_dict)
-  msg_dict['_valid'] = valid
-  return msg_dict
-
-
-def append_dict(path, t, d, values):
-  if path not in values:
-    group = {}
-    group["t"] = []
-    for k in d:
-      group[k] = []
-    values[path] = group
-  else:
-    group = values[path]
-
-  group["t"].append(t)
-  for k, v in d.items():
-    group[k].append(v)
+
+@dataclass(frozen=True)
+class Column:
+  name: str
+  kind: str
+  getter: Callable
+  enum_names: np.ndarray | None = None
+  # where the field lives in the serialized message, None if it can only be read through the getter.
+  # steps walk from the service struct: ('ptr', pointer index) follows a struct pointer,
+  # ('guard', byte offset, discriminant) requires a union member to be active
+  steps: tuple | None = None
+  # (bit offset in the data section, size in bits, raw dtype, default bits) of the field, or
+  # (byte offset of the discriminant,) for _which columns
+  leaf: tuple | None = None
 
 
 def potentially_ragged_array(arr, dtype=None, **kwargs):
@@ -52,30 +47,391 @@ def potentially_ragged_array(arr, dtype=None, **kwargs):
   except ValueError:
     return np.array(arr, dtype=object, **kwargs)
 
-def msgs_to_time_series(msgs):
+
+def _to_py(value):
+  # list elements, same as to_dict(verbose=True)
+  if hasattr(value, 'to_dict'):
+    return value.to_dict(verbose=True)
+  elif isinstance(value, (str, bytes, bool, int, float)):
+    return value
+  elif hasattr(value, 'raw'):
+    return str(value)
+  return [_to_py(v) for v in value]
+
+
+def _make_getter(path: tuple[str, ...], union_members: frozenset[int], default) -> Callable:
+  if not path:
+    return lambda msg: msg
+  elif not union_members:
+    return operator.attrgetter(".".join(path))
+
+  # inactive union members can't be read, they get the column default instead
+  def getter(msg):
+    for i, name in enumerate(path):
+      if i in union_members and msg.which() != name:
+        return default
+      msg = getattr(msg, name)
+    return msg
+  return getter
+
+
+def _default_bits(typ: str, default) -> int:
+  # data section fields are stored xor'd with their default value
+  value = getattr(default, default.which())
+  if typ in FLOAT_FORMATS:
+    value_fmt, bits_fmt = FLOAT_FORMATS[typ]
+    return struct.unpack(bits_fmt, struct.pack(value_fmt, value))[0]
+  elif typ == 'enum':
+    return int(value)
+  return int(value) & ((1 << DATA_LAYOUTS[typ][0]) - 1)
+
+
+def _schema_columns(schema, path: tuple[str, ...] = (), union_members: frozenset[int] = frozenset(), steps: tuple = ()):
+  """Walk a struct schema, yielding a Column for every leaf field"""
+  if len(schema.union_fields):
+    struct_getter = _make_getter(path, union_members, None)
+
+    def which_getter(msg):
+      return "" if (struct := struct_getter(msg)) is None else str(struct.which())
+
+    which_names = np.array([""] * (len(schema.union_fields) + 1), dtype=object)
+    for union_field in schema.fields_list:
+      if union_field.proto.discriminantValue != 0xFFFF:
+        which_names[union_field.proto.discriminantValue] = union_field.proto.name
+    yield Column("/".join((*path, "_which")), 'text', which_getter, which_names, steps, (schema.node.struct.discriminantOffset * 2,))
+
+  for field in schema.fields_list:
+    name = field.proto.name
+    field_path = (*path, name)
+    field_steps = steps
+    field_union_members = union_members
+    if field.proto.discriminantValue != 0xFFFF:
+      field_union_members = union_members | {len(path)}
+      field_steps = (*steps, ('guard', schema.node.struct.discriminantOffset * 2, field.proto.discriminantValue))
+
+    if field.proto.which() == 'group':
+      # groups live in their parent's sections
+      yield from _schema_columns(field.schema, field_path, field_union_members, field_steps)
+      continue
+
+    typ = field.proto.slot.type.which()
+    if typ == 'struct':
+      yield from _schema_columns(field.schema, field_path, field_union_members, (*field_steps, ('ptr', field.proto.slot.offset)))
+      continue
+    elif typ == 'bool':
+      kind = 'bool'
+    elif typ in INT_TYPES:
+      kind = 'int'
+    elif typ in FLOAT_TYPES:
+      kind = 'float'
+    elif typ in ('enum', 'text', 'data', 'list'):
+      kind = typ
+    else:
+      continue  # void, anyPointer, interface
+
+    enum_names = None
+    if kind == 'enum':
+      enumerants = field.schema.enumerants
+      enum_names = np.array([""] * (max(enumerants.values()) + 2), dtype=object)
+      for enum_name, value in enumerants.items():
+        enum_names[value] = enum_name
+
+    leaf = None
+    if typ in DATA_LAYOUTS:
+      bits, dtype = DATA_LAYOUTS[typ]
+      leaf = (field.proto.slot.offset * bits, bits, dtype, _default_bits(typ, field.proto.slot.defaultValue))
+
+    getter = _make_getter(field_path, frozenset(field_union_members), COLUMN_DEFAULTS[kind])
+    yield Column("/".join(field_path), kind, getter, enum_names, field_steps if leaf else None, leaf)
+
+
+@cache
+def service_columns(service: str) -> list[Column]:
+  field = log.Event.schema.fields[service]
+  if field.proto.which() != 'slot' or field.proto.slot.type.which() != 'struct':
+    # TODO: support top level lists and text
+    return []
+  return list(_schema_columns(field.schema))
+
+
+def _parse_fields(fields: Iterable[str] | None) -> dict[str, list[str]] | None:
+  if fields is None:
+    return None
+  field_prefixes = defaultdict(list)
+  for f in fields:
+    service, _, prefix = f.partition("/")
+    field_prefixes[service].append(prefix)
+  return field_prefixes
+
+
+def _selected_columns(service: str, field_prefixes: dict[str, list[str]] | None) -> list[Column]:
+  prefixes = field_prefixes.get(service) if field_prefixes is not None else None
+  return [c for c in service_columns(service) if prefixes is None or any(p == "" or c.name == p or c.name.startswith(p + "/") for p in prefixes)]
+
+
+def column_names(service: str, fields: Iterable[str] | None = None) -> list[str]:
+  """Names of the columns the time series of service has, restricted to fields like msgs_to_time_series"""
+  field_prefixes = _parse_fields(fields)
+  if (field_prefixes is not None and service not in field_prefixes) or not service_columns(service):
+    return []
+  return ["t", "_valid", *(c.name for c in _selected_columns(service, field_prefixes))]
+
+
+def _fill_column(msgs: list, kind: str, getter: Callable, enum_names):
+  count = len(msgs)
+  if kind == 'bool':
+    return np.fromiter(map(getter, msgs), dtype=bool, count=count)
+  elif kind == 'float':
+    return np.fromiter(map(getter, msgs), dtype=np.float64, count=count)
+  elif kind == 'int':
+    try:
+      return np.fromiter(map(getter, msgs), dtype=np.int64, count=count)
+    except OverflowError:
+      return np.fromiter(map(getter, msgs), dtype=np.uint64, count=count)
+  elif kind == 'enum':
+    raw = np.fromiter((v if isinstance(v, int) else v.raw for v in map(getter, msgs)), dtype=np.int64, count=count)
+    raw[(raw < 0) | (raw >= len(enum_names))] = -1
+    return enum_names[raw].astype(str)
+  elif kind == 'list':
+    return potentially_ragged_array([_to_py(v) for v in map(getter, msgs)])
+  return potentially_ragged_array(list(map(getter, msgs)))
+
+
+def msgs_to_time_series(msgs: Iterable, fields: Iterable[str] | None = None):
   """
     Convert an iterable of canonical capnp messages into a dictionary of time series.
     Each time series has a value with key "t" which consists of monotonically increasing timestamps
     in seconds.
+
+    Columns are laid out once per service from its schema and filled straight from the readers.
+    fields optionally restricts them to "service/field/..." paths, nested fields included.
   """
-  values = {}
+  field_prefixes = _parse_fields(fields)
+
+  times = defaultdict(list)
+  valid = defaultdict(list)
+  readers = defaultdict(list)
   for msg in msgs:
     typ = msg.which()
+    if field_prefixes is not None and typ not in field_prefixes:
+      continue
 
-    tm = msg.logMonoTime / 1.0e9
-    msg_dict = get_message_dict(msg, typ)
-    if msg_dict is not None:
-      append_dict(typ, tm, msg_dict, values)
+    times[typ].append(msg.logMonoTime)
+    valid[typ].append(msg.valid)
+    readers[typ].append(msg._get(typ))
+
+  values = {}
+  for typ, typ_readers in readers.items():
+    columns = service_columns(typ)
+    if not columns:
+      continue
 
-  # Sort values by time.
-  for group in values.values():
-    order = np.argsort(group["t"])
-    for name, group_values in group.items():
-      group[name] = potentially_ragged_array(group_values)[order]
+    order = np.argsort(np.array(times[typ], dtype=np.uint64), kind='stable')
+    sorted_readers = [typ_readers[i] for i in order]
+    group = {
+      "t": np.array(times[typ], dtype=np.uint64)[order] / 1.0e9,
+      "_valid": np.array(valid[typ], dtype=bool)[order],
+    }
+    for column in _selected_columns(typ, field_prefixes):
+      group[column.name] = _fill_column(sorted_readers, column.kind, column.getter, column.enum_names)
+    values[typ] = group
 
   return values
 
 
+class _StructArrays:
+  """The same struct in many single segment messages: word offsets of the data and pointer sections, one row per message"""
+  def __init__(self, data, data_words, ptr_count, ok, active):
+    self.data = data
+    self.data_words = data_words
+    self.ptr_count = ptr_count
+    # False where the struct couldn't be located (multi segment message, far pointer), those rows need a reader
+    self.ok = ok
+    # False where an enclosing union member isn't active, those rows get the column default
+    self.active = active
+
+
+class _EventArrays:
+  """Reads columns for one service straight from the data sections of serialized events, without building readers"""
+  def __init__(self, dat: bytes, offsets: np.ndarray, sizes: np.ndarray, service_pointer: int):
+    dat = memoryview(dat)[:len(dat) & ~7]
+    self.views = {dtype: np.frombuffer(dat, dtype=dtype) for dtype in ('<u1', '<u2', '<u4', '<u8')}
+    self.words = self.views['<u8']
+
+    # single segment messages have a one word header and the root pointer right after it
+    offsets = offsets.astype(np.int64)
+    self.start = offsets // 8 + 1
+    self.end = (offsets + sizes.astype(np.int64)) // 8
+    single_segment = self.views['<u4'][offsets // 4] == 0
+    header = _StructArrays(self.start, np.zeros_like(self.start), np.ones_like(self.start), single_segment, np.ones_like(single_segment))
+
+    self.event = self._follow(header, 0)
+    self._structs: dict[tuple, _StructArrays] = {(): self._follow(self.event, service_pointer)}
+
+  def _read(self, s: _StructArrays, bit_offset: int, bits: int) -> tuple[np.ndarray, np.ndarray]:
+    # raw unsigned value of a data section field, zero where the struct is too old to have it
+    present = s.ok & (bit_offset + bits <= s.data_words * 64)
+    if bits == 1:
+      values = self.views['<u1'][np.where(present, s.data * 8 + bit_offset // 8, 0)]
+      values = (values >> (bit_offset % 8)) & 1
+    else:
+      size = bits // 8
+      values = self.views[f'<u{size}'][np.where(present, (s.data * 8 + bit_offset // 8) // size, 0)]
+    return np.where(present, values, values.dtype.type(0)), present
+
+  def _follow(self, s: _StructArrays, index: int) -> _StructArrays:
+    has = s.ok & (index < s.ptr_count)
+    p = np.where(has, s.data + s.data_words + index, 0)
+    val = np.where(has, self.words[p], 0)
+
+    low = (val & 0xFFFFFFFF).astype(np.int64)
+    offset = np.where(low >= 1 << 31, low - (1 << 32), low) >> 2
+    data = p + 1 + offset
+    data_words = ((val >> 32) & 0xFFFF).astype(np.int64)
+    ptr_count = (val >> 48).astype(np.int64)
+
+    null = val == 0
+    located = ((val & 3) == 0) & (data >= self.start) & (data + data_words + ptr_count <= self.end)
+    ok = s.ok & (null | located)
+    data_words = np.where(null | ~ok, 0, data_words)
+    ptr_count = np.where(null | ~ok, 0, ptr_count)
+    return _StructArrays(np.where(ok, data, 0), data_words, ptr_count, ok, s.active)
+
+  def struct(self, steps: tuple) -> _StructArrays:
+    # structs are shared by all the columns under them, so each pointer is only followed once
+    if steps not in self._structs:
+      parent = self.struct(steps[:-1])
+      step = steps[-1]
+      if step[0] == 'ptr':
+        self._structs[steps] = self._follow(parent, step[1])
+      else:
+        disc, _ = self._read(parent, step[1] * 8, 16)
+        self._structs[steps] = _StructArrays(parent.data, parent.data_words, parent.ptr_count, parent.ok, parent.active & (disc == step[2]))
+    return self._structs[steps]
+
+  def column(self, column: Column, s: _StructArrays | None = None) -> tuple[np.ndarray, np.ndarray]:
+    """Column values and a mask of the rows they're valid for, read from the service struct unless s is given"""
+    if s is None:
+      s = self.struct(column.steps)
+    if column.kind == 'text':
+      disc, _ = self._read(s, column.leaf[0] * 8, 16)
+      names = column.enum_names[np.where(s.active & (disc < len(column.enum_names) - 1), disc.astype(np.int64), -1)]
+      return names.astype(str), s.ok
+
+    bit_offset, bits, dtype, default_bits = column.leaf
+    raw, _ = self._read(s, bit_offset, bits)
+    raw = raw ^ np.array(default_bits).astype(raw.dtype)
+    if column.kind == 'bool':
+      values = raw.astype(bool) & s.active
+    elif column.kind == 'enum':
+      names = np.where(s.active & (raw < len(column.enum_names) - 1), raw.astype(np.int64), -1)
+      values = column.enum_names[names].astype(str)
+    elif column.kind == 'float':
+      with np.errstate(invalid='ignore'):
+        values = np.where(s.active, raw.view(dtype).astype(np.float64), np.nan)
+    else:
+      values = np.where(s.active, raw.view(dtype), 0)
+      if dtype != '<u8' or not np.any(values > np.iinfo(np.int64).max):
+        values = values.astype(np.int64)
+    return values, s.ok
+
+
+def _event_readers(dat: bytes, rows: np.ndarray, readers: dict, idxs: Iterable[int]) -> list:
+  # readers for the given rows, only made once for each row
+  for i in idxs:
+    if i not in readers:
+      offset, size = int(rows[i]['offset']), int(rows[i]['size'])
+      with log.Event.from_bytes(memoryview(dat)[offset:offset + size]) as evt:
+        readers[i] = evt
+  return [readers[i] for i in idxs]
+
+
+EVENT_VALID_COLUMN = next(c for c in _schema_columns(log.Event.schema) if c.name == 'valid')
+
+
+def events_to_time_series(dat: bytes, index: np.ndarray, fields: Iterable[str] | None = None):
+  """
+    Same as msgs_to_time_series, for the events of a decompressed log described by index
+    (rows with offset, size, logMonoTime and which, see logreader.build_event_index).
+
+    Fields in the data sections of single segment messages are read for all events of a service at once,
+    readers are only made for text, data and list columns and for events that can't be read that way.
+  """
+  field_prefixes = _parse_fields(fields)
+  services = {log.Event.schema.fields[name].proto.discriminantValue: name for name in log.Event.schema.union_fields}
+
+  values = {}
+  for which in np.unique(index['which']):
+    typ = services.get(int(which))
+    if typ is None or (field_prefixes is not None and typ not in field_prefixes):
+      continue
+    columns = service_columns(typ)
+    if not columns:
+      continue
+
+    rows = index[index['which'] == which]
+    rows = rows[np.argsort(rows['logMonoTime'], kind='stable')]
+    arrays = _EventArrays(dat, rows['offset'], rows['size'], log.Event.schema.fields[typ].proto.slot.offset)
+    readers: dict[int, capnp._DynamicStructReader] = {}
+    get_readers = partial(_event_readers, dat, rows, readers)
+
+    valid, ok = arrays.column(EVENT_VALID_COLUMN, arrays.event)
+    if not ok.all():
+      bad = np.flatnonzero(~ok)
+      valid[bad] = [e.valid for e in get_readers(bad)]
+
+    group = {
+      "t": rows['logMonoTime'] / 1.0e9,
+      "_valid": valid,
+    }
+    for column in _selected_columns(typ, field_prefixes):
+      if column.steps is None:
+        group[column.name] = _fill_column([e._get(typ) for e in get_readers(range(len(rows)))], column.kind, column.getter, column.enum_names)
+        continue
+
+      col, ok = arrays.column(column)
+      if not ok.all():
+        bad = np.flatnonzero(~ok)
+        fallback = _fill_column([e._get(typ) for e in get_readers(bad)], column.kind, column.getter, column.enum_names)
+        if col.dtype != fallback.dtype:
+          col = col.astype(np.result_type(col, fallback))
+        col[bad] = fallback
+      group[column.name] = col
+    values[typ] = group
+
+  return values
+
+
+def concat_time_series(parts: Iterable[dict]) -> dict:
+  """Join time series of consecutive logs, keeping each service sorted by time"""
+  columns = defaultdict(lambda: defaultdict(list))
+  for part in parts:
+    for typ, group in part.items():
+      for name, values in group.items():
+        columns[typ][name].append(values)
+
+  values = {}
+  for typ, group in columns.items():
+    t = np.concatenate(group["t"])
+    order = np.argsort(t, kind='stable')
+    in_order = bool(np.all(t[:-1] <= t[1:]))
+    values[typ] = {}
+    for name, arrays in group.items():
+      if len(arrays) == 1 and in_order:
+        # a single sorted log is kept as is, so memory mapped columns aren't copied
+        values[typ][name] = arrays[0]
+        continue
+      try:
+        joined = np.concatenate(arrays)
+      except ValueError:
+        # 2d columns whose width changed between logs
+        joined = np.empty(sum(len(a) for a in arrays), dtype=object)
+        for i, v in enumerate(v for a in arrays for v in a):
+          joined[i] = v
+      values[typ][name] = joined[order]
+  return values
+
+
 if __name__ == "__main__":
   import sys
   from openpilot.tools.lib.logreader import LogReader
@@ -1,57 +1,480 @@
 #!/usr/bin/env python3
 import bz2
+import contextlib
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import cache, partial
+import io
+import json
 import multiprocessing
 import capnp
 import enum
+import numpy as np
 import os
 import pathlib
+import re
+import shutil
+import struct
 import sys
+import time
 import tqdm
 import urllib.parse
 import warnings
 import zstandard as zstd
 
 from collections.abc import Callable, Iterable, Iterator
+from typing import TypeVar
 from urllib.parse import parse_qs, urlparse
 
-from cereal import log as capnp_log
+from cereal import CEREAL_PATH, log as capnp_log
+from cereal.serialized import EVENT_WHICH, EVENT_WHICH_NAMES, event_fields, event_root
+from openpilot.common.file_helpers import atomic_write_in_dir
 from openpilot.common.swaglog import cloudlog
+from openpilot.system.hardware.hw import Paths
+from openpilot.tools.lib.auth_config import get_token
 from openpilot.tools.lib.comma_car_segments import get_url as get_comma_segments_url
 from openpilot.tools.lib.openpilotci import get_url
-from openpilot.tools.lib.filereader import FileReader, file_exists, internal_source_available
-from openpilot.tools.lib.route import Route, SegmentRange
-from openpilot.tools.lib.log_time_series import msgs_to_time_series
+from openpilot.tools.lib.filereader import FileReader, file_cache_key, file_exists, internal_source_available, read_all
+from openpilot.tools.lib.route import ROUTE_THREADS, Route, SegmentRange
+from openpilot.tools.lib.log_time_series import column_names, concat_time_series, events_to_time_series, msgs_to_time_series, potentially_ragged_array
+from openpilot.tools.lib.url_file import hash_256
 
 LogMessage = type[capnp._DynamicStructReader]
 LogIterable = Iterable[LogMessage]
 RawLogIterable = Iterable[bytes]
+T = TypeVar("T")
+R = TypeVar("R")
 
+ZSTD_MAGIC = b'\x28\xB5\x2F\xFD'  # https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#zstandard-frames
+BZ2_MAGIC = b'BZh9'
+ZSTD_FRAME_MAGIC = 0xFD2FB528
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+ZSTD_FRAME_HEADER = struct.Struct("<II")  # magic, and the size of skippable frames
+# stream header followed by the first block's magic (pi), https://github.com/dsnet/compress/blob/master/doc/bzip2-format.pdf
+BZ2_STREAM_START = re.compile(rb"BZh[1-9]1AY&SY")
+DECOMPRESS_THREADS = min(8, os.cpu_count() or 1)
 
-def save_log(dest, log_msgs, compress=True):
-  dat = b"".join(msg.as_builder().to_bytes() for msg in log_msgs)
+# one row per event in the decompressed log, with a sentinel row at the end (like vidindex)
+EVENT_INDEX_DTYPE = np.dtype([('offset', '<u8'), ('size', '<u4'), ('logMonoTime', '<u8'), ('which', '<u2')])
+EVENT_INDEX_SENTINEL = 0xFFFF
 
+# extracted time series are cached per log and service, up to this many bytes in total
+TIME_SERIES_CACHE_SIZE = int(os.getenv("TIME_SERIES_CACHE_SIZE", 10 * 1024 * 1024 * 1024))
+TIME_SERIES_CACHE_SUFFIX = "_time_series"
+TIME_SERIES_CACHE_VERSION = 2  # bump when the way columns are extracted or stored changes
+
+FILE_EXISTS_THREADS = 16  # concurrent existence checks when picking a source
+SOURCE_CACHE_TTL = 10 * 60  # seconds a resolved source is reused, comma api URLs are signed and expire
+
+SAVE_CHUNK_SIZE = 1024 * 1024  # uncompressed bytes compressed and written at once by save_log
+STREAM_READ_SIZE = 1024 * 1024  # compressed bytes read from the source per step
+STREAM_WINDOW_SIZE = 1024 * 1024  # decompressed bytes parsed at once in streaming mode
+
+
+def _new_compressor(dest: str, compress: bool):
   if compress and dest.endswith(".bz2"):
-    dat = bz2.compress(dat)
+    return bz2.BZ2Compressor()
   elif compress and dest.endswith(".zst"):
-    dat = zstd.compress(dat, 10)
+    return zstd.ZstdCompressor(level=10).compressobj()
+  return None
+
 
+def save_log(dest, log_msgs: LogIterable | RawLogIterable, compress=True, frame_size: int | None = None):
+  """Write messages to dest, compressed according to its extension.
+  Serialized events (e.g. from iter_raw) are copied as they are, only readers are encoded again.
+  With frame_size, a new zstd frame or bz2 stream is started every frame_size uncompressed bytes, so the log can be decompressed in parallel."""
+  compressor = _new_compressor(dest, compress)
   with open(dest, "wb") as f:
-    f.write(dat)
+    pending: list[bytes] = []
+    pending_size = frame_written = 0
+    for msg in log_msgs:
+      dat = msg if isinstance(msg, (bytes, bytearray, memoryview)) else msg.as_builder().to_bytes()
+      pending.append(dat)
+      pending_size += len(dat)
+      if pending_size >= SAVE_CHUNK_SIZE or (frame_size is not None and frame_written + pending_size >= frame_size):
+        chunk = b"".join(pending)
+        if compressor is None:
+          f.write(chunk)
+        elif frame_size is not None and frame_written + pending_size >= frame_size:
+          f.write(compressor.compress(chunk) + compressor.flush())
+          compressor = _new_compressor(dest, compress)
+          frame_written = 0
+        else:
+          f.write(compressor.compress(chunk))
+          frame_written += pending_size
+        pending, pending_size = [], 0
+
+    chunk = b"".join(pending)
+    if compressor is None:
+      f.write(chunk)
+    elif pending_size or frame_written or f.tell() == 0:
+      # no empty frame after the last full one
+      f.write(compressor.compress(chunk) + compressor.flush())
+
+
+def split_zstd_frames(dat: bytes) -> list[memoryview] | None:
+  """The frames of a zstd file, found by walking the frame and block headers without decompressing anything.
+  Returns None if dat isn't made of complete frames."""
+  # https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#frames
+  frames = []
+  offset = 0
+  while offset < len(dat):
+    if len(dat) - offset < 8:
+      return None
+    magic, skippable_size = ZSTD_FRAME_HEADER.unpack_from(dat, offset)
+    if magic & 0xFFFFFFF0 == ZSTD_SKIPPABLE_MAGIC:
+      offset += 8 + skippable_size
+      continue
+    elif magic != ZSTD_FRAME_MAGIC:
+      return None
+
+    descriptor = dat[offset + 4]
+    single_segment = (descriptor >> 5) & 1
+    content_size_bytes = (single_segment, 2, 4, 8)[descriptor >> 6]
+    pos = offset + 5 + (1 - single_segment) + (0, 1, 2, 4)[descriptor & 3] + content_size_bytes
+
+    while True:
+      if pos + 3 > len(dat):
+        return None
+      block_header = int.from_bytes(dat[pos:pos + 3], "little")
+      block_type, block_size = (block_header >> 1) & 3, block_header >> 3
+      if block_type == 3:
+        return None
+      pos += 3 + (1 if block_type == 1 else block_size)
+      if block_header & 1:
+        break
+
+    pos += 4 * ((descriptor >> 2) & 1)  # content checksum
+    if pos > len(dat):
+      return None
+    frames.append(memoryview(dat)[offset:pos])
+    offset = pos
+  return frames
+
+
+def split_bz2_streams(dat: bytes) -> list[memoryview]:
+  """Where bz2 streams may start in dat, like in the output of pbzip2. The pieces still need to be checked when decompressing them."""
+  view = memoryview(dat)
+  starts = [m.start() for m in BZ2_STREAM_START.finditer(dat)]
+  if not starts or starts[0] != 0:
+    return [view]
+  return [view[a:b] for a, b in zip(starts, [*starts[1:], len(dat)], strict=True)]
+
+
+def _decompress_zstd_frame(frame: memoryview) -> bytes:
+  return zstd.ZstdDecompressor().decompressobj().decompress(frame)
+
+
+def _decompress_bz2_stream(stream: memoryview) -> bytes | None:
+  decompressor = bz2.BZ2Decompressor()
+  try:
+    out = decompressor.decompress(stream)
+  except OSError:
+    return None
+  return out if decompressor.eof and not decompressor.unused_data else None
+
+
+def decompress_stream(data: bytes, threads: int = DECOMPRESS_THREADS) -> bytes:
+  """Decompress a zstd log. Independent frames are decompressed in parallel."""
+  frames = split_zstd_frames(data)
+  if frames is None or len(frames) == 1 or threads <= 1:
+    dctx = zstd.ZstdDecompressor()
+    with dctx.stream_reader(data, read_across_frames=True) as reader:
+      return reader.read()
+
+  with ThreadPoolExecutor(min(threads, len(frames))) as executor:
+    return b"".join(executor.map(_decompress_zstd_frame, frames))
+
+
+def decompress_bz2(data: bytes, threads: int = DECOMPRESS_THREADS) -> bytes:
+  """Decompress a bz2 log. Multi stream files (e.g. from pbzip2 or save_log with frame_size) are decompressed in parallel."""
+  streams = split_bz2_streams(data)
+  if len(streams) > 1 and threads > 1:
+    with ThreadPoolExecutor(min(threads, len(streams))) as executor:
+      out = list(executor.map(_decompress_bz2_stream, streams))
+    # a stream start can also show up by chance in compressed data, then it's decompressed in one go
+    if all(o is not None for o in out):
+      return b"".join(out)
+  return bz2.decompress(data)
+
+
+def _new_decompressor(dat: bytes):
+  if dat.startswith(BZ2_MAGIC):
+    return bz2.BZ2Decompressor()
+  elif dat.startswith(ZSTD_MAGIC):
+    return zstd.ZstdDecompressor().decompressobj()
+  return None
+
+
+def decompress_chunks(f, read_size: int = STREAM_READ_SIZE) -> Iterator[bytes]:
+  """Incrementally decompress a bz2, zstd or uncompressed log from a file-like object.
+  Concatenated streams/frames are supported, each one is detected by its magic."""
+  dat = f.read(read_size)
+  compressed = _new_decompressor(dat) is not None
+  decompressor = None
+  while len(dat):
+    if not compressed:
+      yield dat
+    else:
+      if decompressor is None:
+        decompressor = _new_decompressor(dat)
+        if decompressor is None:
+          warnings.warn("Unexpected data after end of compressed log", RuntimeWarning, stacklevel=1)
+          return
+
+      out = decompressor.decompress(dat)
+      if len(out):
+        yield out
+
+      if decompressor.eof:
+        # another stream/frame may start right after the current one
+        dat, decompressor = decompressor.unused_data, None
+        if len(dat):
+          continue
+    dat = f.read(read_size)
+
+
+def _message_size(dat: bytes, offset: int) -> int:
+  """Size of the serialized capnp message starting at offset, or -1 if dat doesn't contain all of it"""
+  # https://capnproto.org/encoding.html#serialization-over-a-stream
+  if len(dat) - offset < 4:
+    return -1
+  num_segments = struct.unpack_from("<I", dat, offset)[0] + 1
+  header_size = 8 * ((num_segments + 2) // 2)
+  if len(dat) - offset < header_size:
+    return -1
+  size = header_size + 8 * sum(struct.unpack_from(f"<{num_segments}I", dat, offset + 4))
+  return size if len(dat) - offset >= size else -1
+
+
+def _decoded_event_fields(dat: bytes) -> tuple[int, int]:
+  # which and logMonoTime of an event whose root can't be read from its bytes, (-1, 0) if it can't be decoded either
+  try:
+    with capnp_log.Event.from_bytes(dat) as evt:
+      return EVENT_WHICH[evt.which()], evt.logMonoTime
+  except capnp.KjException:
+    return -1, 0
+
+
+SINGLE_SEGMENT_TABLE = struct.Struct("<II")  # segment count - 1, segment size
+
+
+def scan_events(dat: bytes) -> Iterator[tuple[int, int, int, int]]:
+  """Yield (offset, size, which, logMonoTime) for each serialized Event in dat, read with cereal.serialized.
+  Only events whose root struct can't be found that way are decoded, which is -1 if that fails as well."""
+  view = memoryview(dat)
+  offset = 0
+  while offset + SINGLE_SEGMENT_TABLE.size <= len(dat):
+    num_segments, segment_words = SINGLE_SEGMENT_TABLE.unpack_from(dat, offset)
+    # most events are a single segment, their size is in the first word
+    size = 8 + 8 * segment_words if num_segments == 0 else _message_size(dat, offset)
+    if size == -1 or offset + size > len(dat):
+      break
+
+    data_start, data_size = event_root(dat, offset)
+    if data_start == -1:
+      which, mono_time = _decoded_event_fields(view[offset:offset + size])
+    else:
+      which, mono_time, _ = event_fields(dat, data_start, data_size)
+    yield offset, size, which, mono_time
+    offset += size
+
+  if offset != len(dat):
+    warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+
+
+def event_which(dat: bytes) -> int:
+  """Union discriminant of a single serialized Event, -1 if it can't be read"""
+  data_start, data_size = event_root(dat)
+  if data_start != -1:
+    return event_fields(dat, data_start, data_size)[0]
+  return next(scan_events(dat), (0, 0, -1, -1))[2]
+
 
-def decompress_stream(data: bytes):
-  dctx = zstd.ZstdDecompressor()
-  decompressed_data = b""
+def filter_events(dat: bytes, services: set[int]) -> Iterator[memoryview]:
+  """Yield the serialized events in dat whose union discriminant is in services. The others are never decoded."""
+  view = memoryview(dat)
+  for offset, size, which, _ in scan_events(dat):
+    if which in services:
+      yield view[offset:offset + size]
 
-  with dctx.stream_reader(data) as reader:
-    decompressed_data = reader.read()
 
-  return decompressed_data
+def build_event_index(dat: bytes) -> np.ndarray:
+  rows = []
+  for offset, size, which, mono_time in scan_events(dat):
+    rows.append((offset, size, mono_time, which if which != -1 else EVENT_INDEX_SENTINEL))
+  rows.append((len(dat), 0, 0, EVENT_INDEX_SENTINEL))
+  return np.array(rows, dtype=EVENT_INDEX_DTYPE)
+
+
+def event_index_path(fn: str) -> str:
+  return os.path.join(Paths.download_cache_root(), file_cache_key(fn) + "_events.npy")
+
+
+def load_event_index(fn: str) -> np.ndarray | None:
+  try:
+    index = np.load(event_index_path(fn))
+  except (OSError, ValueError):
+    return None
+  return index if index.dtype == EVENT_INDEX_DTYPE and len(index) > 0 else None
+
+
+def save_event_index(fn: str, index: np.ndarray) -> None:
+  path = event_index_path(fn)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with atomic_write_in_dir(path, mode="wb", overwrite=True) as f:
+    np.save(f, index)
+
+
+@cache
+def time_series_cache_version() -> str:
+  # the columns come from the schema, so a changed schema doesn't reuse columns extracted with the old one
+  schemas = "".join(pathlib.Path(schema).read_text() for schema in sorted(pathlib.Path(CEREAL_PATH).glob("*.capnp")))
+  return f"v{TIME_SERIES_CACHE_VERSION}_{hash_256(schemas)[:16]}"
+
+
+def time_series_cache_path(fn: str, service: str) -> str:
+  return os.path.join(Paths.download_cache_root(), f"{file_cache_key(fn)}_{time_series_cache_version()}{TIME_SERIES_CACHE_SUFFIX}", service)
+
+
+def _json_default(value):
+  if isinstance(value, bytes):
+    return {"__bytes__": value.hex()}
+  raise TypeError(f"{type(value).__name__} can't be cached")
+
+
+def _json_object(obj: dict):
+  return bytes.fromhex(obj["__bytes__"]) if obj.keys() == {"__bytes__"} else obj
+
+
+def ragged_to_flat(values: np.ndarray) -> tuple[np.ndarray, np.ndarray, bool] | None:
+  """Elements of all rows of a column of lists, where each row starts, and whether the elements are JSON text.
+  Numbers and strings are kept as they are, structs and lists as JSON. None if the rows aren't lists"""
+  rows = [v.tolist() if isinstance(v, np.ndarray) else v for v in values]
+  if not all(isinstance(row, list) for row in rows):
+    return None
+  offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+  np.cumsum([len(row) for row in rows], out=offsets[1:])
+  elements = [e for row in rows for e in row]
+  if all(isinstance(e, (bool, int, float, str)) for e in elements):
+    flat = np.array(elements)
+    if not flat.dtype.hasobject:
+      return flat, offsets, False
+  return np.array([json.dumps(e, default=_json_default) for e in elements], dtype=str), offsets, True
+
+
+def flat_to_ragged(flat: np.ndarray, offsets: np.ndarray, is_json: bool) -> np.ndarray:
+  """Column of lists from ragged_to_flat, the same as the one it was made from"""
+  elements = [json.loads(e, object_hook=_json_object) for e in flat] if is_json else flat.tolist()
+  bounds = offsets.tolist()
+  return potentially_ragged_array([elements[a:b] for a, b in zip(bounds[:-1], bounds[1:], strict=True)])
+
+
+def _load_column(path: str) -> np.ndarray:
+  # never unpickled, the cache is a shared directory
+  try:
+    return np.load(path + ".npy", mmap_mode='r', allow_pickle=False)
+  except FileNotFoundError:
+    pass
+  # ragged columns, the offsets are written last
+  offsets = np.load(path + "+offsets.npy", allow_pickle=False)
+  is_json = not os.path.exists(path + "+values.npy")
+  return flat_to_ragged(np.load(path + ("+json.npy" if is_json else "+values.npy"), allow_pickle=False), offsets, is_json)
+
+
+def load_time_series(fn: str, service: str, names: list[str]) -> dict[str, np.ndarray]:
+  """Columns of service that were cached for fn, memory mapped unless they're ragged"""
+  path = time_series_cache_path(fn, service)
+  columns = {}
+  for name in names:
+    try:
+      columns[name] = _load_column(os.path.join(path, name.replace("/", ".")))
+    except (OSError, ValueError):
+      continue
+  if columns:
+    # directories are evicted least recently used first
+    os.utime(path)
+  return columns
+
+
+def _save_column(path: str, values: np.ndarray) -> None:
+  with atomic_write_in_dir(path, mode="wb", overwrite=True) as f:
+    np.save(f, values)
+
+
+def save_time_series(fn: str, service: str, columns: dict[str, np.ndarray]) -> None:
+  """Cache the columns of service for fn. Columns of python objects (lists that differ in length) are saved
+  as their elements and where each row starts, so they're never pickled"""
+  path = time_series_cache_path(fn, service)
+  os.makedirs(path, exist_ok=True)
+  for name, values in columns.items():
+    column_path = os.path.join(path, name.replace("/", "."))
+    if not values.dtype.hasobject:
+      _save_column(column_path + ".npy", values)
+      continue
+
+    ragged = ragged_to_flat(values)
+    if ragged is None:
+      continue
+    flat, offsets, is_json = ragged
+    _save_column(column_path + ("+json.npy" if is_json else "+values.npy"), flat)
+    _save_column(column_path + "+offsets.npy", offsets)
+
+
+def evict_time_series_cache(max_size: int = TIME_SERIES_CACHE_SIZE) -> None:
+  """Delete cached services, least recently used first, until the time series cache fits in max_size bytes"""
+  root = Paths.download_cache_root()
+  entries = []
+  with contextlib.suppress(FileNotFoundError):
+    for log_dir in os.scandir(root):
+      if not (log_dir.name.endswith(TIME_SERIES_CACHE_SUFFIX) and log_dir.is_dir()):
+        continue
+      for service_dir in os.scandir(log_dir.path):
+        size = sum(f.stat().st_size for f in os.scandir(service_dir.path))
+        entries.append((service_dir.stat().st_mtime_ns, size, service_dir.path))
+
+  total = sum(size for _, size, _ in entries)
+  for _, size, path in sorted(entries):
+    if total <= max_size:
+      break
+    shutil.rmtree(path, ignore_errors=True)
+    with contextlib.suppress(OSError):
+      os.rmdir(os.path.dirname(path))
+    total -= size
+
+
+def split_events(chunks: Iterable[bytes], window_size: int = STREAM_WINDOW_SIZE) -> Iterator[bytes]:
+  """Regroup a stream of byte chunks into windows of roughly window_size bytes containing only whole events"""
+  pending = b""
+  for chunk in chunks:
+    pending += chunk
+    if len(pending) < window_size:
+      continue
+
+    end = 0
+    while (size := _message_size(pending, end)) != -1:
+      end += size
+    if end > 0:
+      yield pending[:end]
+      pending = pending[end:]
+
+  # a truncated last event is left to the parser to report
+  if len(pending):
+    yield pending
+
 
 class _LogFileReader:
-  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False, dat=None):
+  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False, dat=None, stream=False,
+               services: Iterable[str] | None = None):
     self.data_version = None
     self._only_union_types = only_union_types
+    self._stream = stream
+
+    self._services = None
+    if services is not None:
+      unknown = set(services) - EVENT_WHICH.keys()
+      if len(unknown):
+        raise ValueError(f"unknown services {sorted(unknown)}")
+      self._services = {EVENT_WHICH[s] for s in services}
 
     ext = None
     if not dat:
@@ -60,29 +483,110 @@ class _LogFileReader:
         # old rlogs weren't compressed
         raise ValueError(f"unknown extension {ext}")
 
+    self._fn = fn
+    self._sort_by_time = sort_by_time
+    self._ents: list[capnp._DynamicStructReader] | None = None
+    self._index: np.ndarray | None = None
+    if stream:
+      # nothing is read until iteration, and every iteration reads the file again
+      assert not sort_by_time, "sort_by_time needs the whole log in memory, it can't be used with stream"
+      self._dat = dat
+      return
+
+    if not dat:
       with FileReader(fn) as f:
-        dat = f.read()
+        dat = read_all(f)
 
-    if ext == ".bz2" or dat.startswith(b'BZh9'):
-      dat = bz2.decompress(dat)
-    elif ext == ".zst" or dat.startswith(b'\x28\xB5\x2F\xFD'):
-      # https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#zstandard-frames
+    if ext == ".bz2" or dat.startswith(BZ2_MAGIC):
+      dat = decompress_bz2(dat)
+    elif ext == ".zst" or dat.startswith(ZSTD_MAGIC):
       dat = decompress_stream(dat)
+    self._dat = dat
+
+  def _read_ents(self, services: set[int] | None) -> list[capnp._DynamicStructReader]:
+    dat = self._dat
+    if services is not None:
+      dat = b"".join(filter_events(dat, services))
 
     ents = capnp_log.Event.read_multiple_bytes(dat)
 
-    self._ents = []
+    ret = []
     try:
       for e in ents:
-        self._ents.append(e)
+        ret.append(e)
     except capnp.KjException:
       warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
 
-    if sort_by_time:
-      self._ents.sort(key=lambda x: x.logMonoTime)
+    if self._sort_by_time:
+      ret.sort(key=lambda x: x.logMonoTime)
+    return ret
+
+  def _get_ents(self) -> list[capnp._DynamicStructReader]:
+    # events are only parsed once they're iterated over, index lookups don't need them
+    if self._ents is None:
+      self._ents = self._read_ents(self._services)
+    return self._ents
+
+  @property
+  def index(self) -> np.ndarray:
+    """EVENT_INDEX_DTYPE row for each event in file order, loaded from the index cache if it was built before"""
+    assert not self._stream, "index isn't available in stream mode"
+    if self._index is None:
+      index = load_event_index(self._fn) if self._fn else None
+      if index is None or index[-1]['offset'] != len(self._dat):
+        index = build_event_index(self._dat)
+        if self._fn:
+          save_event_index(self._fn, index)
+      self._index = index
+    return self._index
+
+  def event_at(self, offset: int, size: int) -> capnp._DynamicStructReader:
+    with capnp_log.Event.from_bytes(memoryview(self._dat)[offset:offset + size]) as evt:
+      return evt
+
+  def _stream_ents(self, services: set[int] | None) -> Iterator[capnp._DynamicStructReader]:
+    with (io.BytesIO(self._dat) if self._dat else FileReader(self._fn)) as f:
+      for window in split_events(decompress_chunks(f, STREAM_READ_SIZE), STREAM_WINDOW_SIZE):
+        if services is not None:
+          window = b"".join(filter_events(window, services))
+        try:
+          yield from capnp_log.Event.read_multiple_bytes(window)
+        except capnp.KjException:
+          warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+          return
+
+  def iter_raw(self) -> Iterator[memoryview]:
+    """Serialized events, with the same filtering and ordering as iterating over the reader but without decoding them"""
+    if self._stream:
+      with (io.BytesIO(self._dat) if self._dat else FileReader(self._fn)) as f:
+        for window in split_events(decompress_chunks(f, STREAM_READ_SIZE), STREAM_WINDOW_SIZE):
+          view = memoryview(window)
+          for offset, size, which, _ in scan_events(window):
+            if (self._services is None or which in self._services) and (not self._only_union_types or which in EVENT_WHICH_NAMES):
+              yield view[offset:offset + size]
+      return
+
+    index = self.index[:-1]
+    if self._services is not None:
+      index = index[np.isin(index['which'], list(self._services))]
+    if self._only_union_types:
+      index = index[np.isin(index['which'], list(EVENT_WHICH_NAMES))]
+    if self._sort_by_time:
+      index = index[np.argsort(index['logMonoTime'], kind='stable')]
+
+    view = memoryview(self._dat)
+    for offset, size in zip(index['offset'].tolist(), index['size'].tolist(), strict=True):
+      yield view[offset:offset + size]
+
+  def iter_services(self, services: Iterable[str]) -> Iterator[capnp._DynamicStructReader]:
+    """Events of services (that the reader's own services also include), only those are decoded"""
+    which = {EVENT_WHICH[s] for s in services if s in EVENT_WHICH}
+    if self._services is not None:
+      which &= self._services
+    yield from (self._stream_ents(which) if self._stream else self._read_ents(which))
 
   def __iter__(self) -> Iterator[capnp._DynamicStructReader]:
-    for ent in self._ents:
+    for ent in (self._stream_ents(self._services) if self._stream else self._get_ents()):
       if self._only_union_types:
         try:
           ent.which()
@@ -93,6 +597,11 @@ class _LogFileReader:
         yield ent
 
 
+def _run_on_segment(func: Callable[[LogIterable], T], identifier: str, reader_kwargs: dict) -> T:
+  # runs in a worker process, only the identifier and the reader's options are sent to it
+  return func(_LogFileReader(identifier, **reader_kwargs))
+
+
 class ReadMode(enum.StrEnum):
   RLOG = "r"  # only read rlogs
   QLOG = "q"  # only read qlogs
@@ -117,9 +626,18 @@ def default_valid_file(fn: LogPath) -> bool:
   return fn is not None and file_exists(fn)
 
 
+def _valid_files(valid_file: ValidFileCallable, files: list[LogPath]) -> list[bool]:
+  # each check can be an HTTP request, so they're all made at once
+  if not files:
+    return []
+  with ThreadPoolExecutor(min(FILE_EXISTS_THREADS, len(files))) as executor:
+    return list(executor.map(lambda fn: fn is not None and valid_file(fn), files))
+
+
 def auto_strategy(rlog_paths: list[LogPath], qlog_paths: list[LogPath], interactive: bool, valid_file: ValidFileCallable) -> list[LogPath]:
   # auto select logs based on availability
-  missing_rlogs = [rlog is None or not valid_file(rlog) for rlog in rlog_paths].count(True)
+  rlogs_valid = _valid_files(valid_file, rlog_paths)
+  missing_rlogs = rlogs_valid.count(False)
   if missing_rlogs != 0:
     if interactive:
       if input(f"{missing_rlogs}/{len(rlog_paths)} rlogs were not found, would you like to fallback to qlogs for those segments? (y/n) ").lower() != "y":
@@ -127,8 +645,9 @@ def auto_strategy(rlog_paths: list[LogPath], qlog_paths: list[LogPath], interact
     else:
       cloudlog.warning(f"{missing_rlogs}/{len(rlog_paths)} rlogs were not found, falling back to qlogs for those segments...")
 
-    return [rlog if valid_file(rlog) else (qlog if valid_file(qlog) else None)
-            for (rlog, qlog) in zip(rlog_paths, qlog_paths, strict=True)]
+    qlogs_valid = _valid_files(valid_file, [None if rlog_valid else qlog for rlog_valid, qlog in zip(rlogs_valid, qlog_paths, strict=True)])
+    return [rlog if rlog_valid else (qlog if qlog_valid else None)
+            for (rlog, qlog, rlog_valid, qlog_valid) in zip(rlog_paths, qlog_paths, rlogs_valid, qlogs_valid, strict=True)]
   return rlog_paths
 
 
@@ -201,8 +720,9 @@ def direct_source(file_or_url: str) -> list[LogPath]:
 
 
 def get_invalid_files(files):
-  for f in files:
-    if f is None or not file_exists(f):
+  files = list(files)
+  for f, valid in zip(files, _valid_files(file_exists, files), strict=True):
+    if not valid:
       yield f
 
 
@@ -213,6 +733,32 @@ def check_source(source: Source, *args) -> list[LogPath]:
   return files
 
 
+def source_cache_path(sr: SegmentRange, mode: ReadMode, sources: list[Source]) -> str:
+  # the range as it was given, its segments aren't looked up just to find the cache. comma api URLs are signed for
+  # the account, so each account has its own entries
+  key = f"{sr}:{mode}:{[getattr(source, '__name__', repr(source)) for source in sources]}:{get_token()}"
+  return os.path.join(Paths.download_cache_root(), hash_256(key) + "_source.json")
+
+
+def load_source_cache(sr: SegmentRange, mode: ReadMode, sources: list[Source]) -> list[LogPath] | None:
+  try:
+    with open(source_cache_path(sr, mode, sources)) as f:
+      cached = json.load(f)
+    if 0 <= time.time() - cached["time"] < SOURCE_CACHE_TTL:
+      return cached["files"]
+  except (OSError, ValueError, KeyError, TypeError):
+    pass
+  return None
+
+
+def save_source_cache(sr: SegmentRange, mode: ReadMode, sources: list[Source], source: Source, files: list[LogPath]) -> None:
+  path = source_cache_path(sr, mode, sources)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with atomic_write_in_dir(path, overwrite=True) as f:
+    os.fchmod(f.fileno(), 0o600)
+    json.dump({"time": time.time(), "source": getattr(source, '__name__', repr(source)), "files": files}, f)
+
+
 def auto_source(sr: SegmentRange, mode=ReadMode.RLOG, sources: list[Source] = None) -> list[LogPath]:
   if mode == ReadMode.SANITIZED:
     return comma_car_segments_source(sr, mode)
@@ -222,20 +768,30 @@ def auto_source(sr: SegmentRange, mode=ReadMode.RLOG, sources: list[Source] = No
                comma_api_source, comma_car_segments_source, testing_closet_source]
   exceptions = {}
 
+  # a route that was resolved recently isn't checked against every source again
+  cached = load_source_cache(sr, mode, sources)
+  if cached is not None:
+    return cached
+
   # for automatic fallback modes, auto_source needs to first check if rlogs exist for any source
   if mode in [ReadMode.AUTO, ReadMode.AUTO_INTERACTIVE]:
     for source in sources:
       try:
-        return check_source(source, sr, ReadMode.RLOG)
+        files = check_source(source, sr, ReadMode.RLOG)
       except Exception:
-        pass
+        continue
+      save_source_cache(sr, mode, sources, source, files)
+      return files
 
   # Automatically determine viable source
   for source in sources:
     try:
-      return check_source(source, sr, mode)
+      files = check_source(source, sr, mode)
     except Exception as e:
       exceptions[source.__name__] = e
+      continue
+    save_source_cache(sr, mode, sources, source, files)
+    return files
 
   raise LogsUnavailable("auto_source could not find any valid source, exceptions for sources:\n  - " +
                         "\n  - ".join([f"{k}: {repr(v)}" for k, v in exceptions.items()]))
@@ -275,7 +831,8 @@ class LogReader:
     return identifiers
 
   def __init__(self, identifier: str | list[str], default_mode: ReadMode = ReadMode.RLOG,
-               source: Source = auto_source, sort_by_time=False, only_union_types=False):
+               source: Source = auto_source, sort_by_time=False, only_union_types=False, stream=False,
+               services: list[str] | None = None, prefetch: int = 0):
     self.default_mode = default_mode
     self.source = source
     self.identifier = identifier
@@ -284,48 +841,179 @@ class LogReader:
 
     self.sort_by_time = sort_by_time
     self.only_union_types = only_union_types
+    self.stream = stream
+    self.services = services
+    # number of segments downloaded and parsed in the background while iterating
+    self.prefetch = prefetch
 
     self.__lrs: dict[int, _LogFileReader] = {}
+    self.__indexes: dict[int, np.ndarray] = {}
     self.reset()
 
   def _get_lr(self, i):
     if i not in self.__lrs:
-      self.__lrs[i] = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types)
+      self.__lrs[i] = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types,
+                                     stream=self.stream, services=self.services)
     return self.__lrs[i]
 
+  def _load_lr(self, i):
+    lr = self._get_lr(i)
+    if not self.stream:
+      lr._get_ents()
+    return lr
+
   def __iter__(self):
+    # stream readers don't load anything up front, so there's nothing to prefetch
+    if self.prefetch <= 0 or self.stream:
+      for i in range(len(self.logreader_identifiers)):
+        yield from self._get_lr(i)
+      return
+
+    num_segs = len(self.logreader_identifiers)
+    executor = ThreadPoolExecutor(self.prefetch)
+    futures: dict[int, Future] = {}
+    try:
+      for i in range(num_segs):
+        for j in range(i, min(i + 1 + self.prefetch, num_segs)):
+          if j not in futures:
+            futures[j] = executor.submit(self._load_lr, j)
+        yield from futures.pop(i).result()
+    finally:
+      executor.shutdown(wait=False, cancel_futures=True)
+
+  def _get_index(self, i):
+    # a cached index tells which events a segment has without downloading it
+    if i not in self.__indexes:
+      index = load_event_index(self.logreader_identifiers[i]) if i not in self.__lrs else None
+      self.__indexes[i] = index if index is not None else self._get_lr(i).index
+    return self.__indexes[i][:-1]
+
+  def seek(self, mono_time: int, service: str | None = None) -> LogMessage | None:
+    """First event at or after mono_time (optionally only of service), from the first segment that has one"""
     for i in range(len(self.logreader_identifiers)):
-      yield from self._get_lr(i)
-
-  def _run_on_segment(self, func, i):
-    return func(self._get_lr(i))
-
-  def run_across_segments(self, num_processes, func, disable_tqdm=False, desc=None):
+      index = self._get_index(i)
+      if service is not None:
+        index = index[index['which'] == EVENT_WHICH[service]]
+      index = index[index['logMonoTime'] >= mono_time]
+      if len(index):
+        row = index[np.argmin(index['logMonoTime'])]
+        return self._get_lr(i).event_at(int(row['offset']), int(row['size']))
+    return None
+
+  def range(self, service: str, t0: int, t1: int) -> Iterator[LogMessage]:
+    """Events of service with t0 <= logMonoTime < t1, in time order within each segment"""
+    which = EVENT_WHICH[service]
+    for i in range(len(self.logreader_identifiers)):
+      index = self._get_index(i)
+      index = index[(index['which'] == which) & (index['logMonoTime'] >= t0) & (index['logMonoTime'] < t1)]
+      if len(index) == 0:
+        continue
+
+      lr = self._get_lr(i)
+      for row in index[np.argsort(index['logMonoTime'], kind='stable')]:
+        yield lr.event_at(int(row['offset']), int(row['size']))
+
+  def _reader_kwargs(self) -> dict:
+    return {"sort_by_time": self.sort_by_time, "only_union_types": self.only_union_types, "stream": self.stream, "services": self.services}
+
+  def imap_segments(self, num_processes: int, func: Callable[[LogIterable], T], ordered: bool = True) -> Iterator[T]:
+    """
+      Yield func(segment) for every segment, computed in a pool of num_processes workers.
+      Workers get the segment's identifier and read it themselves, and results are yielded as they come in
+      (in segment order unless ordered is False).
+    """
+    run = partial(_run_on_segment, func, reader_kwargs=self._reader_kwargs())
     with multiprocessing.Pool(num_processes) as pool:
+      yield from (pool.imap if ordered else pool.imap_unordered)(run, self.logreader_identifiers)
+
+  def run_across_segments(self, num_processes: int, func: Callable[[LogIterable], T], disable_tqdm=False, desc=None,
+                          reducer: Callable[[R, T], R] | None = None, initial: R = None, ordered: bool = True):
+    """
+      Run func over every segment in a pool of num_processes workers. Without a reducer the results are
+      concatenated into a list, otherwise they're folded into initial with reducer as they come in.
+    """
+    results = tqdm.tqdm(self.imap_segments(num_processes, func, ordered), total=len(self.logreader_identifiers), disable=disable_tqdm, desc=desc)
+    if reducer is None:
       ret = []
-      num_segs = len(self.logreader_identifiers)
-      for p in tqdm.tqdm(pool.imap(partial(self._run_on_segment, func), range(num_segs)), total=num_segs, disable=disable_tqdm, desc=desc):
+      for p in results:
         ret.extend(p)
       return ret
 
+    acc = initial
+    for p in results:
+      acc = reducer(acc, p)
+    return acc
+
+  def iter_raw(self) -> Iterator[memoryview]:
+    """Serialized events of all segments, see _LogFileReader.iter_raw. Pass them to save_log to copy them without re-encoding."""
+    for i in range(len(self.logreader_identifiers)):
+      yield from self._get_lr(i).iter_raw()
+
   def reset(self):
-    self.logreader_identifiers = []
-    for identifier in self.identifier:
-      self.logreader_identifiers.extend(self._parse_identifier(identifier))
+    # each identifier can take several api requests and file checks, a list of them is resolved concurrently
+    # (unless the user is asked about missing rlogs). the route metadata and file lists are cached on disk,
+    # see route.cached_api_get, so resolving them again is quick
+    identifiers = self.identifier
+    if len(identifiers) > 1 and self.default_mode != ReadMode.AUTO_INTERACTIVE:
+      with ThreadPoolExecutor(min(ROUTE_THREADS, len(identifiers))) as executor:
+        parsed = list(executor.map(self._parse_identifier, identifiers))
+    else:
+      parsed = [self._parse_identifier(identifier) for identifier in identifiers]
+    self.logreader_identifiers = [fn for fns in parsed for fn in fns]
 
   @staticmethod
   def from_bytes(dat):
     return _LogFileReader("", dat=dat)
 
   def filter(self, msg_type: str):
-    return (getattr(m, m.which()) for m in filter(lambda m: m.which() == msg_type, self))
+    # only the events of msg_type are decoded, like with services=[msg_type]
+    return (getattr(m, msg_type) for i in range(len(self.logreader_identifiers)) for m in self._get_lr(i).iter_services([msg_type]))
 
   def first(self, msg_type: str):
     return next(self.filter(msg_type), None)
 
+  def _get_cached_time_series(self, i, fields: list[str] | None):
+    fn = self.logreader_identifiers[i]
+    services = {EVENT_WHICH_NAMES[w] for w in np.unique(self._get_index(i)['which']) if w in EVENT_WHICH_NAMES}
+
+    part, missing = {}, []
+    for service in services:
+      names = column_names(service, fields)
+      if names:
+        part[service] = load_time_series(fn, service, names)
+        missing.extend(f"{service}/{name}" for name in names if name not in part[service])
+
+    if missing:
+      lr = self._get_lr(i)
+      for service, columns in events_to_time_series(lr._dat, lr.index[:-1], missing).items():
+        save_time_series(fn, service, columns)
+        part[service].update(columns)
+      evict_time_series_cache()
+    return part
+
+  def get_time_series(self, fields: list[str] | None = None, cache: bool = False):
+    """
+      time_series, optionally restricted to "service/field/..." paths.
+      With cache, the columns of each segment are saved in the download cache and memory mapped from there next time.
+    """
+    if fields is None and self.services is not None:
+      fields = self.services
+    if self.stream:
+      return msgs_to_time_series(self, fields)
+
+    # columns are read straight from the decompressed logs, using each segment's event index
+    parts = []
+    for i in range(len(self.logreader_identifiers)):
+      if cache:
+        parts.append(self._get_cached_time_series(i, fields))
+      else:
+        lr = self._get_lr(i)
+        parts.append(events_to_time_series(lr._dat, lr.index[:-1], fields))
+    return concat_time_series(parts)
+
   @property
   def time_series(self):
-    return msgs_to_time_series(self)
+    return self.get_time_series()
 
 if __name__ == "__main__":
   import codecs
@@ -1,11 +1,18 @@
+import json
 import os
 import re
 import requests
+import time
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 from functools import cache
+from hashlib import sha256
 from urllib.parse import urlparse
 from collections import defaultdict
 from itertools import chain
 
+from openpilot.common.file_helpers import atomic_write_in_dir
+from openpilot.system.hardware.hw import Paths
 from openpilot.tools.lib.auth_config import get_token
 from openpilot.tools.lib.api import APIError, CommaApi
 from openpilot.tools.lib.helpers import RE
@@ -17,6 +24,43 @@ CAMERA_FILENAMES = ['fcamera.hevc', 'video.hevc']
 DCAMERA_FILENAMES = ['dcamera.hevc']
 ECAMERA_FILENAMES = ['ecamera.hevc']
 
+API_CACHE_TTL = 10 * 60  # seconds route metadata and file lists from the api are reused, the file URLs are signed and expire
+ROUTE_THREADS = 16  # routes resolved at once by get_routes
+
+
+def api_cache_path(endpoint: str) -> str:
+  # the responses are for the account, so each account has its own entries. the query is part of the endpoint
+  key = f"{endpoint}:{get_token()}"
+  return os.path.join(Paths.download_cache_root(), sha256(key.encode()).hexdigest() + "_api.json")
+
+
+def cached_api_get(endpoint: str, ttl: float = API_CACHE_TTL):
+  """GET endpoint from the comma api, the response is kept on disk and reused for ttl seconds"""
+  path = api_cache_path(endpoint)
+  try:
+    with open(path) as f:
+      cached = json.load(f)
+    if 0 <= time.time() - cached["time"] < ttl:
+      return cached["response"]
+  except (OSError, ValueError, KeyError, TypeError):
+    pass
+
+  response = CommaApi(get_token()).get(endpoint)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with atomic_write_in_dir(path, mode="w", overwrite=True) as f:
+    os.fchmod(f.fileno(), 0o600)
+    json.dump({"time": time.time(), "response": response}, f)
+  return response
+
+
+def get_routes(route_names: Iterable[str], threads: int = ROUTE_THREADS) -> dict[str, 'Route']:
+  """Routes by name, their metadata and files fetched from the api concurrently instead of one route after another"""
+  route_names = list(dict.fromkeys(route_names))
+  if not route_names:
+    return {}
+  with ThreadPoolExecutor(min(threads, len(route_names))) as executor:
+    return dict(zip(route_names, executor.map(Route, route_names), strict=True))
+
 
 class Route:
   def __init__(self, name, data_dir=None):
@@ -32,8 +76,7 @@ class Route:
   @property
   def metadata(self):
     if not self._metadata:
-      api = CommaApi(get_token())
-      self._metadata = api.get('v1/route/' + self.name.canonical_name)
+      self._metadata = cached_api_get('v1/route/' + self.name.canonical_name)
     return self._metadata
 
   @property
@@ -70,8 +113,7 @@ class Route:
 
   # TODO: refactor this, it's super repetitive
   def _get_segments_remote(self):
-    api = CommaApi(get_token())
-    route_files = api.get('v1/route/' + self.name.canonical_name + '/files')
+    route_files = cached_api_get('v1/route/' + self.name.canonical_name + '/files')
     self.files = list(chain.from_iterable(route_files.values()))
 
     segments = {}
@@ -262,8 +304,8 @@ class SegmentName:
 @cache
 def get_max_seg_number_cached(sr: 'SegmentRange') -> int:
   try:
-    api = CommaApi(get_token())
-    max_seg_number = api.get("/v1/route/" + sr.route_name.replace("/", "|"))["maxqlog"]
+    # the same request as Route.metadata, so they share the cached response
+    max_seg_number = cached_api_get("v1/route/" + sr.route_name.replace("/", "|"))["maxqlog"]
     assert isinstance(max_seg_number, int)
     return max_seg_number
   except Exception as e:
@@ -1,6 +1,7 @@
 # Utilities for sanitizing routes of only essential data for testing car ports and doing validation.
 
-from openpilot.tools.lib.logreader import LogIterable, LogMessage
+from cereal import log as capnp_log
+from openpilot.tools.lib.logreader import EVENT_WHICH, LogIterable, LogMessage, RawLogIterable, event_which
 
 
 def sanitize_vin(vin: str):
@@ -24,3 +25,15 @@ def sanitize(lr: LogIterable) -> LogIterable:
   filtered = filter(lambda msg: msg.which() in PRESERVE_SERVICES, lr)
   sanitized = map(sanitize_msg, filtered)
   return sanitized
+
+
+def sanitize_raw(events: RawLogIterable) -> RawLogIterable:
+  # same as sanitize on serialized events, only the ones that are changed get decoded
+  preserve = {EVENT_WHICH[s] for s in PRESERVE_SERVICES}
+  for dat in events:
+    which = event_which(dat)
+    if which == EVENT_WHICH["carParams"]:
+      with capnp_log.Event.from_bytes(dat) as msg:
+        yield sanitize_msg(msg).as_builder().to_bytes()
+    elif which in preserve:
+      yield dat
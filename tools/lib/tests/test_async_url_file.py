@@ -0,0 +1,79 @@
+import asyncio
+import random
+import pytest
+
+from cereal import log as capnp_log
+from openpilot.tools.lib import async_url_file
+from openpilot.tools.lib.async_logreader import iter_logs
+from openpilot.tools.lib.async_url_file import AsyncURLFile, new_session, read_file
+from openpilot.tools.lib.logreader import save_log
+from openpilot.tools.lib.tests.test_caching import RangeRequestHandler, range_host  # noqa: F401
+from openpilot.tools.lib.url_file import URLFile
+
+
+async def read_ranges(url: str, cache: bool, ranges: list[tuple[int, int]]) -> list[bytes]:
+  async with new_session() as session:
+    async def read(start: int, ll: int) -> bytes:
+      f = AsyncURLFile(url, session, cache=cache)
+      f.seek(start)
+      return await f.read(ll)
+    return await asyncio.gather(*(read(start, ll) for start, ll in ranges))
+
+
+class TestAsyncURLFile:
+  @pytest.fixture(autouse=True)
+  def chunk_size(self, monkeypatch):
+    # the same small chunks range_host gives URLFile
+    monkeypatch.setattr(async_url_file, "CHUNK_SIZE", 1000)
+
+  @pytest.mark.parametrize("cache_enabled", [True, False])
+  def test_read(self, range_host, cache_enabled):  # noqa: F811
+    data = RangeRequestHandler.DATA
+
+    async def read_all():
+      async with new_session() as session:
+        return await read_file(range_host, session, cache=cache_enabled)
+    assert asyncio.run(read_all()) == data
+
+    rng = random.Random(3)
+    ranges = [(rng.randrange(len(data) + 10), rng.randrange(3000)) for _ in range(50)]
+    for (start, ll), dat in zip(ranges, asyncio.run(read_ranges(range_host, cache_enabled, ranges)), strict=True):
+      assert dat == data[start:start + ll]
+
+  def test_shared_cache(self, range_host):  # noqa: F811
+    data = RangeRequestHandler.DATA
+    assert asyncio.run(read_ranges(range_host, True, [(0, len(data))])) == [data]
+
+    # the chunks are where URLFile looks for them, nothing is downloaded again
+    RangeRequestHandler.requests = []
+    with URLFile(range_host, cache=True) as f:
+      assert f.read() == data
+    assert asyncio.run(read_ranges(range_host, True, [(1234, 5000)])) == [data[1234:6234]]
+    assert RangeRequestHandler.requests == []
+
+
+class TestIterLogs:
+  @pytest.mark.parametrize("ordered", [True, False])
+  def test_iter_logs(self, tmp_path, ordered):
+    fns = []
+    for i in range(5):
+      fn = str(tmp_path / f"{i}.zst")
+      save_log(fn, [capnp_log.Event.new_message(logMonoTime=i * 100 + j, valid=True).to_bytes() for j in range(10)])
+      fns.append(fn)
+
+    async def collect():
+      return [(fn, [m.logMonoTime for m in lr]) async for fn, lr in iter_logs(fns, max_in_flight=2, ordered=ordered)]
+    logs = asyncio.run(collect())
+
+    if ordered:
+      assert [fn for fn, _ in logs] == fns
+    assert sorted(logs) == [(fn, [i * 100 + j for j in range(10)]) for i, fn in enumerate(fns)]
+
+  def test_stop_early(self, tmp_path):
+    fn = str(tmp_path / "rlog.zst")
+    save_log(fn, [capnp_log.Event.new_message(logMonoTime=1).to_bytes()])
+
+    async def first():
+      async for _, lr in iter_logs([fn] * 10, max_in_flight=3, services=["carState"]):
+        return list(lr)
+    assert asyncio.run(first()) == []
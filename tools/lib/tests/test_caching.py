@@ -1,12 +1,16 @@
 import http.server
+import multiprocessing
 import os
+import random
+import re
 import shutil
 import socket
 import pytest
 
 from openpilot.selfdrive.test.helpers import http_server_context
 from openpilot.system.hardware.hw import Paths
-from openpilot.tools.lib.url_file import URLFile
+from openpilot.tools.lib import url_file
+from openpilot.tools.lib.url_file import DownloadCacheIndex, URLFile, evict_download_cache, hash_256
 
 
 class CachingTestRequestHandler(http.server.BaseHTTPRequestHandler):
@@ -28,11 +32,46 @@ class CachingTestRequestHandler(http.server.BaseHTTPRequestHandler):
     self.end_headers()
 
 
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+  DATA = random.Random(0).randbytes(10_500)
+  requests: list[str|None] = []
+
+  def do_GET(self):
+    RangeRequestHandler.requests.append(self.headers.get("Range"))
+    if m := re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", "")):
+      start, end = int(m.group(1)), int(m.group(2)) + 1
+      self.send_response(206)
+    else:
+      start, end = 0, len(self.DATA)
+      self.send_response(200)
+    self.send_header("Content-Length", str(end - start))
+    self.end_headers()
+    self.wfile.write(self.DATA[start:end])
+
+  def do_HEAD(self):
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(self.DATA)))
+    self.end_headers()
+
+  def log_message(self, *args):
+    pass
+
+
 @pytest.fixture
-def host():
+def host(monkeypatch, tmp_path):
+  monkeypatch.setenv("COMMA_CACHE", str(tmp_path))
   with http_server_context(handler=CachingTestRequestHandler) as (host, port):
     yield f"http://{host}:{port}"
 
+
+@pytest.fixture
+def range_host(monkeypatch, tmp_path):
+  monkeypatch.setenv("COMMA_CACHE", str(tmp_path))
+  monkeypatch.setattr(url_file, "CHUNK_SIZE", 1000)
+  RangeRequestHandler.requests = []
+  with http_server_context(handler=RangeRequestHandler) as (host, port):
+    yield f"http://{host}:{port}/rlog.zst"
+
 class TestFileDownload:
 
   def test_pipeline_defaults(self, host):
@@ -128,3 +167,167 @@ class TestFileDownload:
     CachingTestRequestHandler.FILE_EXISTS = True
     length = URLFile(file_url).get_length()
     assert length == 4
+
+  @pytest.mark.parametrize("cache_enabled", [True, False])
+  def test_ranged_reads(self, range_host, cache_enabled):
+    data = RangeRequestHandler.DATA
+    with URLFile(range_host, cache=cache_enabled) as f:
+      assert f.read() == data
+    rng = random.Random(1)
+    with URLFile(range_host, cache=cache_enabled) as f:
+      for _ in range(50):
+        start, ll = rng.randrange(len(data) + 10), rng.randrange(3000)
+        f.seek(start)
+        assert f.read(ll) == data[start:start + ll]
+      f.seek(123)
+      assert b"".join(iter(lambda: f.read(700), b"")) == data[123:]
+
+  @pytest.mark.parametrize("cache_enabled", [True, False])
+  def test_readinto(self, range_host, cache_enabled):
+    data = RangeRequestHandler.DATA
+    for _ in range(2):  # from the server, and then from the cache
+      buf = bytearray(len(data) + 100)
+      with URLFile(range_host, cache=cache_enabled) as f:
+        assert f.readinto(buf) == len(data)
+        assert f.readinto(buf) == 0
+      assert buf[:len(data)] == data
+
+    # corrupt chunks aren't read into the buffer
+    if cache_enabled:
+      with open(os.path.join(Paths.download_cache_root(), hash_256(range_host) + "_4.0"), "r+b") as chunk:
+        chunk.write(b"corrupt")
+
+    rng = random.Random(2)
+    with URLFile(range_host, cache=cache_enabled) as f:
+      for _ in range(50):
+        start, buf = rng.randrange(len(data) + 10), bytearray(rng.randrange(3000))
+        f.seek(start)
+        n = f.readinto(memoryview(buf))
+        assert buf[:n] == data[start:start + len(buf)]
+        assert f.tell() == start + n
+      f.seek(123)
+      out, buf = bytearray(), bytearray(700)
+      while n := f.readinto(buf):
+        out += buf[:n]
+      assert out == data[123:]
+
+  @pytest.mark.parametrize("cache_enabled", [True, False])
+  def test_read_ahead(self, range_host, cache_enabled):
+    data = RangeRequestHandler.DATA
+    with URLFile(range_host, cache=cache_enabled) as f:
+      assert f.read(10) == data[:10]
+      assert f.read(300) == data[10:310]
+      # the next chunks are on their way while the first is read
+      assert set(f._read_ahead) >= {1, 2}
+      assert b"".join(iter(lambda: f.read(300), b"")) == data[310:]
+
+    # no chunk is downloaded twice
+    ranges = [r for r in RangeRequestHandler.requests if r is not None]
+    assert len(ranges) == len(set(ranges)) <= 12
+
+  def test_concurrent_chunks(self, range_host, mocker):
+    submit = mocker.spy(URLFile.executor(), "submit")
+    with URLFile(range_host, cache=True) as f:
+      assert f.read() == RangeRequestHandler.DATA
+    assert submit.call_count == 11
+    assert sorted(RangeRequestHandler.requests) == sorted(f"bytes={i}-{min(i + 1000, 10_500) - 1}" for i in range(0, 10_500, 1000))
+
+    # without the cache, a whole file is still one request
+    RangeRequestHandler.requests = []
+    with URLFile(range_host, cache=False) as f:
+      assert f.read() == RangeRequestHandler.DATA
+    assert RangeRequestHandler.requests == [None]
+
+  def test_cache_index(self, range_host, mocker):
+    data = RangeRequestHandler.DATA
+    with URLFile(range_host, cache=True) as f:
+      assert f.read() == data
+
+    # the index knows the length and which chunks are cached, nothing is requested or stat'ed
+    RangeRequestHandler.requests = []
+    exists = mocker.spy(os.path, "exists")
+    with URLFile(range_host, cache=True) as f:
+      assert f.read() == data
+    assert RangeRequestHandler.requests == []
+    assert not any(str(call.args[0]).startswith(os.path.join(Paths.download_cache_root(), hash_256(range_host))) for call in exists.call_args_list)
+
+    # corrupt chunks are downloaded again
+    chunk_path = os.path.join(Paths.download_cache_root(), hash_256(range_host) + "_3.0")
+    with open(chunk_path, "r+b") as chunk:
+      chunk.truncate(500)
+    os.remove(os.path.join(Paths.download_cache_root(), hash_256(range_host) + "_5.0"))
+    with URLFile(range_host, cache=True) as f:
+      assert f.read() == data
+    assert sorted(RangeRequestHandler.requests) == ["bytes=3000-3999", "bytes=5000-5999"]
+    assert os.path.getsize(chunk_path) == 1000
+
+  def test_evict(self, range_host):
+    other = range_host.replace("rlog.zst", "qlog.zst")
+    for url in (other, range_host):
+      with URLFile(url, cache=True) as f:
+        f.read()
+    root = Paths.download_cache_root()
+    # the indexes of a log and video are evicted with them, a local file's on their own
+    for fn, size in ((hash_256(other) + "_events.npy", 20_000), (hash_256(other) + "_vidindex.npz", 100),
+                     (hash_256("/data/rlog.zst") + "_events.npy", 100), ("unrelated", 100)):
+      with open(os.path.join(root, fn), "wb") as f:
+        f.write(b"\0" * size)
+    for fn in os.listdir(root):
+      if fn.startswith(hash_256(other)):
+        os.utime(os.path.join(root, fn), ns=(0, 0))
+
+    evict_download_cache(max_size=15_000)
+    files = set(os.listdir(root))
+    assert not any(fn.startswith(hash_256(other)) for fn in files)
+    assert sum(fn.startswith(hash_256(range_host)) for fn in files) == 12
+    assert {hash_256("/data/rlog.zst") + "_events.npy", "unrelated"} <= files
+
+    evict_download_cache(max_size=0)
+    assert os.listdir(root) == ["unrelated"]
+
+
+def put_chunks(url: str, chunks: list[int]) -> None:
+  index = DownloadCacheIndex(url)
+  for chunk in chunks:
+    index.put(chunk, bytes([chunk]) * 100)
+
+
+class TestDownloadCacheIndex:
+  URL = "http://localhost/rlog.zst"
+
+  @pytest.fixture(autouse=True)
+  def cache_dir(self, monkeypatch, tmp_path):
+    monkeypatch.setenv("COMMA_CACHE", str(tmp_path))
+    os.makedirs(Paths.download_cache_root(), exist_ok=True)
+
+  def test_processes(self):
+    index = DownloadCacheIndex(self.URL)
+    with multiprocessing.get_context("spawn").Pool(4) as pool:
+      pool.starmap(put_chunks, [(self.URL, list(range(i, 40, 4))) for i in range(4)])
+
+    # none of the chunks other processes cached are lost, and an index that's open already finds them
+    assert all(index.get(chunk) == bytes([chunk]) * 100 for chunk in range(40))
+    assert DownloadCacheIndex(self.URL).chunks == index.chunks
+    # a line per chunk, the index isn't written again for every chunk
+    with open(index.path) as f:
+      assert len(f.readlines()) == 40
+
+  def test_drop(self):
+    index = DownloadCacheIndex(self.URL)
+    put_chunks(self.URL, [0, 1])
+    with open(index.chunk_path(0), "wb") as f:
+      f.write(b"\xff" * 100)
+    assert index.get(0) is None and index.get(1) == b"\x01" * 100
+
+    # the drop is kept after more chunks are cached
+    index.put(2, b"\x02" * 100)
+    assert sorted(DownloadCacheIndex(self.URL).chunks) == [1, 2]
+
+    # a line that's still being written is read once it's complete
+    with open(index.path, "a") as f:
+      f.write("3 1")
+    other = DownloadCacheIndex(self.URL)
+    assert 3 not in other.chunks
+    with open(index.path, "a") as f:
+      f.write("23\n")
+    assert other._lookup(3) == 123
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from cereal import log as capnp_log
+from openpilot.tools.lib import framereader, logreader
+from openpilot.tools.lib.camerareader import CameraReader
+from openpilot.tools.lib.framereader import save_video_index
+from openpilot.tools.lib.logreader import save_log
+from openpilot.tools.lib.tests.test_framereader import FakeDecoder, make_index_data
+
+FRAMES_PER_SEGMENT = 20
+FRAME_TIME = 50_000_000
+
+
+def encode_idx_log(segment: int) -> list:
+  msgs = []
+  for i in range(FRAMES_PER_SEGMENT):
+    t = (segment * FRAMES_PER_SEGMENT + i) * FRAME_TIME
+    msg = capnp_log.Event.new_message(logMonoTime=t + 5_000_000)
+    idx = msg.init("roadEncodeIdx")
+    idx.segmentNum, idx.segmentId, idx.frameId, idx.timestampEof = segment, i, segment * FRAMES_PER_SEGMENT + i, t
+    msgs.append(msg.as_reader())
+    msgs.append(capnp_log.Event.new_message(logMonoTime=t + 1, carState={"vEgo": i}).as_reader())
+  return msgs
+
+
+@pytest.fixture
+def route(tmp_path, monkeypatch):
+  monkeypatch.setenv("COMMA_CACHE", str(tmp_path / "cache"))
+  monkeypatch.setitem(framereader.DECODERS, "fake", FakeDecoder)
+  FakeDecoder.decode_calls = []
+
+  logs, videos = [], []
+  for segment in range(2):
+    logs.append(str(tmp_path / f"{segment}_rlog.zst"))
+    save_log(logs[-1], encode_idx_log(segment))
+    videos.append(str(tmp_path / f"{segment}_fcamera.hevc"))
+    with open(videos[-1], "wb") as f:
+      f.write(b"\x00")
+    save_video_index(videos[-1], make_index_data(FRAMES_PER_SEGMENT))
+  return logs, videos
+
+
+class TestCameraReader:
+  def test_frame_at(self, route):
+    logs, videos = route
+    cr = CameraReader(logs, video_paths=videos, decoder="fake")
+    assert len(cr) == 2 * FRAMES_PER_SEGMENT
+    assert cr.frame_index(-1) is None and cr.frame_at(-1) is None
+
+    assert cr.frame_index(3 * FRAME_TIME) == (0, 3)
+    assert cr.frame_index(3 * FRAME_TIME + FRAME_TIME - 1) == (0, 3)
+    assert cr.frame_index((FRAMES_PER_SEGMENT + 2) * FRAME_TIME + 1) == (1, 2)
+    assert cr.frame_index(10**18) == (1, FRAMES_PER_SEGMENT - 1)
+
+    assert np.all(cr.frame_at(7 * FRAME_TIME) == 7)
+    assert np.all(cr.frame_at((FRAMES_PER_SEGMENT + 11) * FRAME_TIME) == 11)
+    assert set(cr._frame_readers) == {0, 1}
+    cr.close()
+
+  def test_timestamp_cached(self, route, mocker):
+    logs, videos = route
+    CameraReader(logs, video_paths=videos, decoder="fake")
+    # the second reader gets the timestamps from the time series cache
+    parse = mocker.spy(logreader, "events_to_time_series")
+    cr = CameraReader(logs[1:], video_paths={1: videos[1]}, timestamp="logMonoTime", decoder="fake")
+    assert parse.call_count == 0
+    assert cr.frame_index((FRAMES_PER_SEGMENT + 4) * FRAME_TIME + 5_000_000) == (1, 4)
+    with pytest.raises(FileNotFoundError):
+      cr.get(0, 0)
+
+  def test_unknown_camera(self, route):
+    with pytest.raises(ValueError):
+      CameraReader(route[0], camera="rear", video_paths=route[1])
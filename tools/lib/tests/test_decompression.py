@@ -0,0 +1,75 @@
+import bz2
+import os
+import random
+import tempfile
+import zstandard as zstd
+
+import pytest
+from parameterized import parameterized
+
+from cereal import log as capnp_log
+from openpilot.tools.lib.logreader import LogReader, decompress_bz2, decompress_stream, save_log, split_bz2_streams, split_zstd_frames
+
+
+def generate_log(num_msgs: int) -> list:
+  # can data is random, so it compresses about as badly as the real thing
+  rng = random.Random(0)
+  msgs = []
+  for i in range(num_msgs):
+    msg = capnp_log.Event.new_message(logMonoTime=i * 10_000_000)
+    can = msg.init("can", 8)
+    for j, c in enumerate(can):
+      c.address = (i + j) % 2048
+      c.dat = rng.randbytes(8)
+    msgs.append(msg.as_reader())
+  return msgs
+
+
+class TestDecompression:
+  @classmethod
+  def setup_class(cls):
+    cls.msgs = generate_log(5000)
+    cls.dat = b"".join(m.as_builder().to_bytes() for m in cls.msgs)
+
+  @parameterized.expand([(".zst",), (".bz2",)])
+  def test_frames(self, ext):
+    decompress = decompress_stream if ext == ".zst" else decompress_bz2
+    split = split_zstd_frames if ext == ".zst" else split_bz2_streams
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fn = os.path.join(tmpdir, "rlog" + ext)
+      save_log(fn, self.msgs)
+      with open(fn, "rb") as f:
+        single = f.read()
+      assert len(split(single)) == 1
+      assert decompress(single) == self.dat
+
+      save_log(fn, self.msgs, frame_size=len(self.dat) // 5)
+      with open(fn, "rb") as f:
+        multi = f.read()
+      assert len(split(multi)) == 5
+      assert decompress(multi) == self.dat
+      assert decompress(multi, threads=1) == self.dat
+      assert b"".join(m.as_builder().to_bytes() for m in LogReader(fn)) == self.dat
+      assert b"".join(m.as_builder().to_bytes() for m in LogReader(fn, stream=True)) == self.dat
+
+  def test_zstd_frame_headers(self):
+    # skippable frames, content sizes and checksums change the header layout
+    frames = [
+      zstd.ZstdCompressor(write_content_size=True, write_checksum=True).compress(self.dat[:1000]),
+      b"\x50\x2a\x4d\x18\x04\x00\x00\x00skip",
+      zstd.ZstdCompressor(level=3).compress(self.dat),
+      zstd.ZstdCompressor(write_content_size=False).compress(b""),
+    ]
+    assert [bytes(f) for f in split_zstd_frames(b"".join(frames))] == [frames[0], frames[2], frames[3]]
+    assert decompress_stream(b"".join(frames)) == self.dat[:1000] + self.dat
+    assert split_zstd_frames(b"".join(frames)[:-1]) is None
+
+  def test_bz2_false_stream_start(self):
+    # a stream start in the compressed data that isn't one falls back to decompressing everything at once
+    dat = bz2.compress(self.dat)
+    fake = dat[:100] + b"BZh91AY&SY" + dat[100:]
+    assert len(split_bz2_streams(fake)) == 2
+    with pytest.raises(OSError):
+      decompress_bz2(fake)
+    assert decompress_bz2(dat + dat) == self.dat + self.dat
+
@@ -0,0 +1,402 @@
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from openpilot.tools.lib import framereader
+from openpilot.tools.lib.framereader import FfmpegDecoder, FrameReader, SharedFrameCache, HEVC_SLICE_I, HEVC_SLICE_P
+from openpilot.tools.lib.vidindex import hevc_index
+
+GOP_SIZE = 5
+NUM_FRAMES = 23
+
+
+def make_index_data(num_frames: int = NUM_FRAMES, gop_size: int = GOP_SIZE) -> dict:
+  frame_types = [(HEVC_SLICE_I if i % gop_size == 0 else HEVC_SLICE_P, 100 * i) for i in range(num_frames)]
+  return {
+    'index': np.array(frame_types + [(0xFFFFFFFF, 100 * num_frames)], dtype=np.uint32),
+    'global_prefix': b"",
+    'probe': {'streams': [{'width': 4, 'height': 2}]},
+  }
+
+
+class FakeDecoder(FfmpegDecoder):
+  # decodes frame i to a frame filled with i, without any video
+  decode_calls: list[tuple[int, int]] = []
+
+  def _decode_frames(self, f_b, f_e, out=None):
+    assert f_b == 0 or self.index[f_b, 0] == HEVC_SLICE_I
+    FakeDecoder.decode_calls.append((f_b, f_e))
+    for i in range(f_b, f_e):
+      time.sleep(0.001)
+      frame = out.begin_write(i) if out is not None else np.empty((self.h, self.w, 3), dtype=np.uint8)
+      frame[...] = i
+      if out is not None:
+        out.end_write(i)
+      yield frame
+
+
+# stands in for ffmpeg, and notes each start in bin/started. NAL units of type 1 and 19 are 4x2 frames, filled with the byte after their header.
+# like with ffmpeg, a frame is output once the next NAL unit other than an end of sequence starts, or the input ends.
+# frame 0xfe can't be decoded, and neither can 0xff when ffmpeg exits on decoding errors
+STUB_FFMPEG = """#!{python}
+import os
+import sys
+
+with open(os.path.join(os.path.dirname(sys.argv[0]), "started"), "a") as f:
+  f.write(f"{{os.getpid()}}\\n")
+
+def output(val):
+  if val == 0xfe or (val == 0xff and "-xerror" in sys.argv):
+    sys.exit(1)
+  sys.stdout.buffer.write(bytes([val]) * 24)
+  sys.stdout.buffer.flush()
+
+pending = None
+dat, pos = b"", 0
+while chunk := os.read(0, 1 << 16):
+  dat += chunk
+  while (start := dat.find(bytes([0, 0, 1]), pos)) != -1 and start + 5 <= len(dat):
+    nal_type, val = (dat[start + 3] >> 1) & 63, dat[start + 4]
+    pos = start + 3
+    if nal_type == 36:
+      continue
+    if pending is not None:
+      output(pending)
+    pending = val if nal_type in (1, 19) else None
+if pending is not None:
+  output(pending)
+"""
+
+
+@pytest.fixture
+def stub_ffmpeg(tmp_path, monkeypatch):
+  bin_dir = tmp_path / "bin"
+  bin_dir.mkdir()
+  (bin_dir / "ffmpeg").write_text(STUB_FFMPEG.format(python=sys.executable))
+  (bin_dir / "ffmpeg").chmod(0o755)
+  monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+  def make_video(values) -> tuple[str, dict]:
+    # frame i of the video decodes to values[i], each frame is 100 bytes like in make_index_data
+    fn = str(tmp_path / "fcamera.hevc")
+    with open(fn, "wb") as f:
+      f.write(b"".join(b"\x00\x00\x01" + bytes([0x26 if i % GOP_SIZE == 0 else 0x02, v]) + b"\xaa" * 95 for i, v in enumerate(values)))
+    return fn, {**make_index_data(len(values)), 'global_prefix': b"\x00\x00\x01\x40\x01"}
+  return make_video
+
+
+def encode_video(fn: str, num_frames: int = NUM_FRAMES, gop_size: int = GOP_SIZE) -> tuple[dict, np.ndarray]:
+  # a real video, its index data and its frames in yuv420p
+  av = pytest.importorskip("av")
+  rng = np.random.default_rng(0)
+  with av.open(fn, "w", format="hevc") as container:
+    stream = container.add_stream("libx265", rate=20)
+    stream.width, stream.height, stream.pix_fmt = 64, 48, "yuv420p"
+    stream.options = {"x265-params": f"keyint={gop_size}:min-keyint={gop_size}:bframes=0:log-level=none"}
+    for i in range(num_frames):
+      img = np.clip(rng.integers(0, 40, (48, 64, 3)) + np.arange(64)[None, :, None] * 2 + i * 8, 0, 255).astype(np.uint8)
+      container.mux(stream.encode(av.VideoFrame.from_ndarray(img, format="rgb24")))
+    container.mux(stream.encode(None))
+  with av.open(fn) as container:
+    frames = np.stack([frame.to_ndarray(format="yuv420p").reshape(-1) for frame in container.decode(video=0)])
+
+  frame_types, dat_len, prefix = hevc_index(fn)
+  index_data = {
+    'index': np.array(frame_types + [(0xFFFFFFFF, dat_len)], dtype=np.uint32),
+    'global_prefix': prefix,
+    'probe': {'streams': [{'width': 64, 'height': 48}]},
+  }
+  return index_data, frames
+
+
+def read_shared(name, fidxs):
+  cache = SharedFrameCache((2, 4, 3), name=name, create=False)
+  try:
+    return [None if (frame := cache.get(fidx)) is None else int(frame[0, 0, 0]) for fidx in fidxs]
+  finally:
+    cache.close()
+
+
+@pytest.fixture(autouse=True)
+def download_cache(tmp_path, monkeypatch):
+  # video indexes are cached for local files too, keep them out of the real download cache
+  monkeypatch.setenv("COMMA_CACHE", str(tmp_path / "download_cache"))
+
+
+@pytest.fixture(autouse=True)
+def fake_decoder(monkeypatch):
+  monkeypatch.setitem(framereader.DECODERS, "fake", FakeDecoder)
+  FakeDecoder.decode_calls = []
+
+
+class TestFrameReader:
+  def test_iterator(self):
+    dec = FakeDecoder("", make_index_data())
+    assert [fidx for fidx, _ in dec.get_iterator(3, 17, frame_skip=4)] == [3, 7, 11, 15]
+    assert FakeDecoder.decode_calls == [(0, 20)]
+    assert all(np.all(frame == fidx) for fidx, frame in dec.get_iterator(12))
+
+  def test_sequential_reads_share_decoder(self):
+    fr = FrameReader("", make_index_data(), decoder="fake", cache_size=1)
+    for fidx in range(NUM_FRAMES):
+      assert np.all(fr.get(fidx) == fidx)
+    assert FakeDecoder.decode_calls == [(0, NUM_FRAMES)]
+
+    # going back or skipping a whole GOP starts over from that GOP
+    assert np.all(fr.get(2) == 2)
+    assert np.all(fr.get(16) == 16)
+    assert FakeDecoder.decode_calls[1:] == [(0, NUM_FRAMES), (15, NUM_FRAMES)]
+
+  @pytest.mark.parametrize("lookahead", [1, 3])
+  def test_lookahead(self, lookahead):
+    fr = FrameReader("", make_index_data(), decoder="fake", lookahead=lookahead, cache_size=1)
+    for fidx in [*range(NUM_FRAMES), 7, 21, 0]:
+      assert np.all(fr.get(fidx) == fidx)
+
+    # every GOP is decoded by itself, and only once while reading in order
+    num_gops = -(-NUM_FRAMES // GOP_SIZE)
+    gops = [(g * GOP_SIZE, min((g + 1) * GOP_SIZE, NUM_FRAMES)) for g in range(num_gops)]
+    assert sorted(FakeDecoder.decode_calls[:num_gops]) == gops
+    assert set(FakeDecoder.decode_calls) == set(gops)
+    assert len(fr._gops) <= lookahead + 1
+    fr.close()
+
+  def test_lookahead_parallel(self):
+    threads = set()
+
+    def decode_gop(self, f_b, f_e, out=None):
+      threads.add(threading.get_ident())
+      time.sleep(0.05)
+      yield from FakeDecoder._decode_frames(self, f_b, f_e, out)
+
+    fr = FrameReader("", make_index_data(), decoder="fake", lookahead=4)
+    fr.decoder._decode_frames = decode_gop.__get__(fr.decoder)
+    fr.get(0)
+    fr.get(NUM_FRAMES - 1)
+    assert len(threads) > 1
+    fr.close()
+
+
+class TestFfmpegDecoder:
+  def test_reads_share_process(self, stub_ffmpeg):
+    dec = FfmpegDecoder(*stub_ffmpeg(range(NUM_FRAMES)))
+    try:
+      assert [int(frame[0, 0, 0]) for _, frame in dec.get_iterator()] == list(range(NUM_FRAMES))
+      pid = dec._process().pid
+
+      # reads of whole GOPs in any order go to the same ffmpeg
+      for start, end in [(15, 20), (0, 5), (20, 23), (5, 15)]:
+        assert [(fidx, int(frame[0, 0, 0])) for fidx, frame in dec.get_iterator(start, end)] == [(i, i) for i in range(start, end)]
+      assert dec._process().pid == pid
+
+      # one that stops early stops its ffmpeg
+      frames = dec.get_iterator(10, 13)
+      assert next(frames)[0] == 10
+      frames.close()
+      assert dec._process().pid != pid
+      assert [fidx for fidx, _ in dec.get_iterator(10, 13)] == [10, 11, 12]
+      proc = dec._process()
+    finally:
+      dec.close()
+    assert proc.poll() is not None and dec._procs == {}
+
+  def test_frame_reader(self, stub_ffmpeg):
+    fr = FrameReader(*stub_ffmpeg(range(NUM_FRAMES)), cache_size=1)
+    for fidx in [*range(12), 3, 22, 0]:
+      assert np.all(fr.get(fidx) == fidx)
+    fr.close()
+    assert fr.decoder._procs == {}
+
+  @pytest.mark.parametrize("lookahead", [1, 3])
+  def test_lookahead(self, stub_ffmpeg, tmp_path, lookahead):
+    fr = FrameReader(*stub_ffmpeg(range(NUM_FRAMES)), lookahead=lookahead, cache_size=1)
+    for fidx in [*range(NUM_FRAMES), 7, 21, 0]:
+      assert np.all(fr.get(fidx) == fidx)
+    workers = set(fr.decoder._procs)
+    fr.close()
+
+    # each worker decodes all of its GOPs with one ffmpeg
+    assert 0 < len(workers) <= lookahead
+    assert len((tmp_path / "bin" / "started").read_text().splitlines()) == len(workers)
+
+  def test_decoding_errors(self, stub_ffmpeg):
+    values = list(range(NUM_FRAMES))
+    values[7] = 0xff
+    dec = FfmpegDecoder(*stub_ffmpeg(values))
+    try:
+      # the frames from the error on come from an ffmpeg that goes on past errors
+      assert [int(frame[0, 0, 0]) for _, frame in dec.get_iterator()] == values
+      assert [int(frame[0, 0, 0]) for _, frame in dec.get_iterator(10, 15)] == values[10:15]
+    finally:
+      dec.close()
+
+    values[12] = 0xfe
+    dec = FfmpegDecoder(*stub_ffmpeg(values))
+    try:
+      with pytest.raises(subprocess.CalledProcessError):
+        list(dec.get_iterator())
+    finally:
+      dec.close()
+
+  @pytest.mark.parametrize("decoder", ["ffmpeg", "pyav"])
+  def test_video(self, tmp_path, decoder):
+    fn = str(tmp_path / "fcamera.hevc")
+    index_data, frames = encode_video(fn)
+    if decoder == "ffmpeg" and shutil.which("ffmpeg") is None:
+      pytest.skip("ffmpeg is not installed")
+    dec = framereader.DECODERS[decoder](fn, index_data, "yuv420p")
+    try:
+      for start, end in [(0, None), (15, 20), (5, 10), (0, 3), (12, 23)]:
+        fidxs, decoded = zip(*dec.get_iterator(start, end), strict=True)
+        assert fidxs == tuple(range(start, end or NUM_FRAMES))
+        assert np.array_equal(np.stack(decoded), frames[start:end])
+    finally:
+      dec.close()
+
+
+class TestCropScale:
+  def test_filters(self):
+    assert framereader.video_filters(1928, 1208) == ([], 1928, 1208)
+    filters, w, h = framereader.video_filters(1928, 1208, scale=0.25)
+    assert (w, h) == (482, 302) and filters == [("scale", "482:302:flags=area")]
+    filters, w, h = framereader.video_filters(1928, 1208, "nv12", crop=(100, 200, 512, 256), scale=0.5)
+    assert (w, h) == (256, 128) and filters == [("crop", "512:256:100:200"), ("scale", "256:128:flags=area")]
+
+    args = framereader.ffmpeg_decode_args("rgb24", filters=filters)
+    assert args[args.index("-vf") + 1] == "crop=512:256:100:200,scale=256:128:flags=area"
+    assert args.index("-vf") > args.index("-i")
+    assert "-vf" not in framereader.ffmpeg_decode_args("rgb24")
+
+  @pytest.mark.parametrize("crop, scale, pix_fmt", [
+    ((0, 0, 2000, 100), 1.0, "rgb24"),
+    ((-2, 0, 100, 100), 1.0, "rgb24"),
+    ((1, 0, 100, 100), 1.0, "nv12"),
+    (None, 0.0, "rgb24"),
+    (None, 2.0, "rgb24"),
+  ])
+  def test_invalid(self, crop, scale, pix_fmt):
+    with pytest.raises(ValueError):
+      framereader.video_filters(1928, 1208, pix_fmt, crop, scale)
+
+  def test_frame_reader(self):
+    fr = FrameReader("", make_index_data(), decoder="fake", crop=(0, 0, 4, 2), scale=0.5)
+    assert (fr.w, fr.h) == (2, 2) and (fr.decoder.video_w, fr.decoder.video_h) == (4, 2)
+    assert fr.get(3).shape == (2, 2, 3)
+
+
+class TestVideoIndex:
+  def test_index_cache(self, tmp_path, monkeypatch):
+    monkeypatch.setenv("COMMA_CACHE", str(tmp_path / "cache"))
+    calls = []
+
+    def hevc_index(fn):
+      calls.append(fn)
+      return [(HEVC_SLICE_I, 0), (HEVC_SLICE_P, 10)], 20, b"\x00\x00\x01prefix"
+
+    monkeypatch.setattr(framereader, "hevc_index", hevc_index)
+    monkeypatch.setattr(framereader, "assert_hvec", lambda fn: None)
+    monkeypatch.setattr(framereader, "ffprobe", lambda fn, fmt=None: {'streams': [{'width': 4, 'height': 2}]})
+
+    fn = str(tmp_path / "fcamera.hevc")
+    with open(fn, "wb") as f:
+      f.write(b"video")
+    index_data = framereader.get_video_index(fn)
+    cached = framereader.get_video_index(fn)
+    assert calls == [fn]
+    assert np.array_equal(cached['index'], index_data['index']) and cached['index'].dtype == np.uint32
+    assert cached['global_prefix'] == index_data['global_prefix']
+    assert cached['probe'] == index_data['probe']
+
+    # a changed local file is indexed again
+    os.utime(fn, ns=(0, 0))
+    framereader.get_video_index(fn)
+    framereader.get_video_index(fn, cache=False)
+    assert calls == [fn] * 3
+
+
+class TestSharedFrameCache:
+  def test_ring(self):
+    cache = SharedFrameCache((2, 4, 3), capacity=4)
+    try:
+      for fidx in range(6):
+        cache.put(fidx, np.full((2, 4, 3), fidx, dtype=np.uint8))
+      assert [fidx in cache for fidx in range(6)] == [False, False, True, True, True, True]
+      assert cache.get(1) is None
+      assert np.all(cache.get(5) == 5)
+
+      # a slot being written reads as empty, also when a previous write never finished
+      cache.begin_write(6)
+      assert cache.get(6) is None and cache.get(2) is None
+      cache.begin_write(6)[...] = 6
+      cache.end_write(6)
+      assert np.all(cache.get(6) == 6)
+    finally:
+      cache.close()
+
+  def test_other_process(self):
+    cache = SharedFrameCache((2, 4, 3), capacity=8)
+    try:
+      for fidx in range(3):
+        cache.put(fidx, np.full((2, 4, 3), fidx, dtype=np.uint8))
+      with multiprocessing.get_context("spawn").Pool(1) as pool:
+        assert pool.apply(read_shared, (cache.name, [0, 2, 3])) == [0, 2, None]
+
+        # a slot that's locked for writing isn't read, even where the sequence number already looks like it was written
+        cache.begin_write(1)
+        cache._slots[1, 0] += 1
+        assert pool.apply(read_shared, (cache.name, [0, 1])) == [0, None]
+        cache.end_write(1)
+
+      # the memory is still there after a reader exits
+      code = f"from openpilot.tools.lib.tests.test_framereader import read_shared; assert read_shared({cache.name!r}, [2]) == [2]"
+      subprocess.check_call([sys.executable, "-c", code], env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)})
+      assert read_shared(cache.name, [0]) == [0]
+
+      # only frames of the same shape, pixel format, crop and scale
+      for shape, kwargs in [((4, 4, 3), {}), ((2, 4, 3), {"pix_fmt": "yuv420p"}), ((2, 4, 3), {"crop": (0, 0, 4, 2)}), ((2, 4, 3), {"scale": 0.5})]:
+        with pytest.raises(ValueError):
+          SharedFrameCache(shape, name=cache.name, create=False, **kwargs)
+    finally:
+      cache.close()
+
+  def test_name(self):
+    names = {framereader.shared_frame_cache_name("fcamera.hevc", *args) for args in
+             [(), ("rgb24", None, 1.0), ("rgb24", None, 1), ("nv12",), ("rgb24", (0, 0, 4, 2)), ("rgb24", [0, 0, 4, 2]), ("rgb24", None, 0.5)]}
+    assert len(names) == 4
+
+    cache = SharedFrameCache((2, 2, 3), capacity=4, name=framereader.shared_frame_cache_name("fcamera.hevc", crop=(0, 0, 4, 2), scale=0.5),
+                             crop=(0, 0, 4, 2), scale=0.5)
+    try:
+      reader = SharedFrameCache((2, 2, 3), name=cache.name, create=False, crop=[0, 0, 4, 2], scale=0.5)
+      assert (reader.crop, reader.scale) == ((0, 0, 4, 2), 0.5)
+      reader.close()
+      FrameReader("", make_index_data(), decoder="fake", shared_cache=cache, crop=(0, 0, 4, 2), scale=0.5).close()
+      with pytest.raises(ValueError):
+        FrameReader("", make_index_data(), decoder="fake", shared_cache=cache, scale=0.5)
+    finally:
+      cache.close()
+
+  def test_frame_reader(self):
+    cache = SharedFrameCache((2, 4, 3), capacity=NUM_FRAMES)
+    try:
+      writer = FrameReader("", make_index_data(), decoder="fake", shared_cache=cache)
+      frames = [writer.get(fidx) for fidx in [*range(NUM_FRAMES), 3]]
+      assert not any(np.shares_memory(frame, cache._frames) for frame in frames)
+      writer.close()
+
+      reader = FrameReader("", make_index_data(), decoder="fake",
+                           shared_cache=SharedFrameCache((2, 4, 3), name=cache.name, create=False))
+      frames += [reader.get(fidx) for fidx in range(NUM_FRAMES)]
+      assert FakeDecoder.decode_calls == [(0, NUM_FRAMES)]
+      reader.shared_cache.close()
+    finally:
+      cache.close()
+    # the frames are still there once the ring is gone
+    assert [int(frame[0, 0, 0]) for frame in frames] == [*range(NUM_FRAMES), 3, *range(NUM_FRAMES)]
@@ -1,17 +1,25 @@
 import capnp
+import numpy as np
 import contextlib
 import io
 import shutil
 import tempfile
+import threading
+import time
 import os
 import pytest
 import requests
+import zstandard as zstd
 
 from parameterized import parameterized
 
 from cereal import log as capnp_log
-from openpilot.tools.lib.logreader import LogIterable, LogReader, comma_api_source, parse_indirect, ReadMode, InternalUnavailableException
+from cereal.serialized import EVENT_WHICH_OFFSET, event_header
+from openpilot.tools.lib import logreader
+from openpilot.tools.lib.log_time_series import msgs_to_time_series
+from openpilot.tools.lib.logreader import LogIterable, LogReader, comma_api_source, parse_indirect, ReadMode, InternalUnavailableException, save_log
 from openpilot.tools.lib.route import SegmentRange
+from openpilot.tools.lib.sanitizer import sanitize, sanitize_raw
 from openpilot.tools.lib.url_file import URLFileException
 
 NUM_SEGS = 17  # number of segments in the test route
@@ -24,6 +32,41 @@ def noop(segment: LogIterable):
   return segment
 
 
+def mono_times(segment: LogIterable):
+  return [m.logMonoTime for m in segment]
+
+
+def generate_msgs(num_msgs: int = 300) -> list:
+  services = ["carState", "can", "controlsState", "carParams"]
+  msgs = []
+  for i in range(num_msgs):
+    msg = capnp_log.Event.new_message(logMonoTime=i * 10_000_000)
+    if services[i % len(services)] == "can":
+      msg.init("can", i % 5)
+    else:
+      msg.init(services[i % len(services)])
+    msgs.append(msg.as_reader())
+  return msgs
+
+
+def generate_ragged_msgs(num_msgs: int = 300) -> list:
+  # lists that differ in length: of structs, of numbers, and of structs with data
+  msgs = []
+  for i, msg in enumerate(generate_msgs(num_msgs)):
+    msg = msg.as_builder()
+    if msg.which() == "carState":
+      for j, event in enumerate(msg.carState.init("buttonEvents", i % 3)):
+        event.pressed = j % 2 == 0
+        event.type = j + 1
+    elif msg.which() == "carParams":
+      msg.carParams.longitudinalTuning.kpBP = [0.5 * j for j in range(i % 4)]
+      for j, fw in enumerate(msg.carParams.init("carFw", 1 + i % 2)):
+        fw.fwVersion = bytes([i, j, 0])
+        fw.request = [b"\x10\x03", bytes(j)]
+    msgs.append(msg.as_reader())
+  return msgs
+
+
 @contextlib.contextmanager
 def setup_source_scenario(mocker, is_internal=False):
   internal_source_mock = mocker.patch("openpilot.tools.lib.logreader.internal_source")
@@ -46,6 +89,12 @@ def setup_source_scenario(mocker, is_internal=False):
   yield
 
 
+@pytest.fixture(autouse=True)
+def download_cache(tmp_path, monkeypatch):
+  # event indexes and time series are cached for local files too, keep them out of the real download cache
+  monkeypatch.setenv("COMMA_CACHE", str(tmp_path / "download_cache"))
+
+
 class TestLogReader:
   @parameterized.expand([
     (f"{TEST_ROUTE}", ALL_SEGS),
@@ -254,3 +303,339 @@ class TestLogReader:
       msgs = list(LogReader(qlog.name, only_union_types=True))
       assert len(msgs) == num_msgs
       [m.which() for m in msgs]
+
+  @pytest.mark.parametrize("ext", ["", ".bz2", ".zst"])
+  def test_stream(self, mocker, ext):
+    # small reads and windows so events get split across chunks
+    mocker.patch("openpilot.tools.lib.logreader.STREAM_READ_SIZE", 100)
+    mocker.patch("openpilot.tools.lib.logreader.STREAM_WINDOW_SIZE", 300)
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fn = os.path.join(tmpdir, "rlog" + ext)
+      save_log(fn, generate_msgs())
+
+      msgs = [m.as_builder().to_bytes() for m in LogReader(fn)]
+      stream_msgs = [m.as_builder().to_bytes() for m in LogReader(fn, stream=True)]
+      assert len(msgs) == 300
+      assert stream_msgs == msgs
+
+      # a truncated last event is dropped with a warning
+      with open(fn, "wb") as f:
+        f.write(b"".join(msgs)[:-10])
+      with pytest.warns(RuntimeWarning):
+        assert len(list(LogReader(fn, stream=True))) == 299
+
+  @pytest.mark.parametrize("stream", [True, False])
+  def test_services(self, stream):
+    with tempfile.NamedTemporaryFile(suffix=".zst") as rlog:
+      save_log(rlog.name, generate_msgs())
+
+      lr = LogReader(rlog.name)
+      for services in (["carState"], ["can", "carParams"], []):
+        msgs = [m.as_builder().to_bytes() for m in lr if m.which() in services]
+        filtered_msgs = [m.as_builder().to_bytes() for m in LogReader(rlog.name, stream=stream, services=services)]
+        assert filtered_msgs == msgs
+
+      with pytest.raises(ValueError):
+        list(LogReader(rlog.name, stream=stream, services=["notAService"]))
+
+  def test_scan_events(self):
+    single = capnp_log.Event.new_message(logMonoTime=123, valid=True)
+    single.init("carState").vEgo = 1.0
+    builder = capnp._MallocMessageBuilder(4)
+    multi = builder.init_root(capnp_log.Event)
+    multi.logMonoTime = 456
+    multi.init("can", 3)
+    dat = single.to_bytes()
+    # the root is a far pointer to a landing pad in the second segment, where the first segment was
+    far = b"".join([(1).to_bytes(4, "little"), (1).to_bytes(4, "little"), dat[4:8], b"\0" * 4,
+                    (2 | (1 << 32)).to_bytes(8, "little"), dat[8:]])
+    with capnp_log.Event.from_bytes(far) as evt:
+      assert evt.logMonoTime == 123
+
+    # a null root pointer is an event with every field at its default
+    empty = (0).to_bytes(4, "little") + (1).to_bytes(4, "little") + b"\0" * 8
+    events = [dat, multi.to_bytes(), far, empty]
+    which = [logreader.EVENT_WHICH[s] for s in ("carState", "can", "carState")] + [0]
+    assert [(w, t) for _, _, w, t in logreader.scan_events(b"".join(events))] == [(which[0], 123), (which[1], 456), (which[2], 123), (0, 0)]
+    assert [logreader.event_which(e) for e in events] == which
+    assert [logreader.event_root(e) == (-1, 0) for e in events] == [False, False, True, False]
+
+  def test_event_header(self):
+    events = []
+    for valid in (True, False):
+      single = capnp_log.Event.new_message(logMonoTime=123, valid=valid)
+      single.init("carState")
+      builder = capnp._MallocMessageBuilder(4)
+      multi = builder.init_root(capnp_log.Event)
+      multi.logMonoTime = 456
+      multi.valid = valid
+      multi.init("can", 3)
+      events += [single.to_bytes(), multi.to_bytes()]
+    assert events[1][:4] != b"\0" * 4, "not a multi-segment message"
+    assert [event_header(e) for e in events] == [("carState", 123, True), ("can", 456, True), ("carState", 123, False), ("can", 456, False)]
+
+    # the ones that can't be read without decoding them
+    dat = events[0]
+    far = b"".join([(1).to_bytes(4, "little"), (1).to_bytes(4, "little"), dat[4:8], b"\0" * 4,
+                    (2 | (1 << 32)).to_bytes(8, "little"), dat[8:]])
+    not_a_service = bytearray(dat)
+    not_a_service[16 + EVENT_WHICH_OFFSET:16 + EVENT_WHICH_OFFSET + 2] = (0xFFFF).to_bytes(2, "little")
+    for e in (far, bytes(not_a_service), dat[:12], dat[:20]):
+      assert event_header(e) is None
+
+  @pytest.mark.parametrize("stream", [True, False])
+  def test_filter(self, mocker, stream):
+    with tempfile.NamedTemporaryFile(suffix=".zst") as rlog:
+      save_log(rlog.name, generate_msgs())
+      msgs = list(LogReader(rlog.name))
+
+      read_spy = mocker.spy(capnp_log.Event, "read_multiple_bytes")
+      lr = LogReader(rlog.name, stream=stream)
+      expected = [m.carState.as_builder().to_bytes() for m in msgs if m.which() == "carState"]
+      assert [m.as_builder().to_bytes() for m in lr.filter("carState")] == expected
+      assert lr.first("carParams").as_builder().to_bytes() == next(m.carParams.as_builder().to_bytes() for m in msgs if m.which() == "carParams")
+      assert lr.first("notAService") is None
+      assert list(LogReader(rlog.name, stream=stream, services=["can"]).filter("carState")) == []
+      # only the events that were asked for are decoded
+      decoded = {w for call in read_spy.call_args_list for _, _, w, _ in logreader.scan_events(call.args[0])}
+      assert decoded == {logreader.EVENT_WHICH["carState"], logreader.EVENT_WHICH["carParams"]}
+
+  def test_index(self, mocker, monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      monkeypatch.setenv("COMMA_CACHE", os.path.join(tmpdir, "cache"))
+      fn = os.path.join(tmpdir, "rlog.bz2")
+      save_log(fn, generate_msgs())
+      msgs = list(LogReader(fn))
+
+      lr = LogReader(fn)
+      t0, t1 = msgs[50].logMonoTime, msgs[200].logMonoTime
+      expected = [m.as_builder().to_bytes() for m in msgs if m.which() == "carState" and t0 <= m.logMonoTime < t1]
+      assert [m.as_builder().to_bytes() for m in lr.range("carState", t0, t1)] == expected
+      assert len(expected) > 0
+
+      assert lr.seek(t0).as_builder().to_bytes() == msgs[50].as_builder().to_bytes()
+      assert lr.seek(t0 + 1, "carParams").logMonoTime == next(m.logMonoTime for m in msgs[51:] if m.which() == "carParams")
+      assert lr.seek(msgs[-1].logMonoTime + 1) is None
+
+      # the index is built once and reused
+      build_mock = mocker.patch("openpilot.tools.lib.logreader.build_event_index")
+      assert len(list(LogReader(fn).range("carState", t0, t1))) == len(expected)
+      assert build_mock.call_count == 0
+
+  def test_prefetch(self, mocker):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fns = [os.path.join(tmpdir, f"rlog{i}.zst") for i in range(5)]
+      for i, fn in enumerate(fns):
+        save_log(fn, generate_msgs(50 + i))
+
+      msgs = [m.as_builder().to_bytes() for m in LogReader(fns)]
+      init_spy = mocker.spy(logreader, "_LogFileReader")
+      lr = LogReader(fns, prefetch=2)
+      assert [m.as_builder().to_bytes() for m in lr] == msgs
+      assert [m.as_builder().to_bytes() for m in lr] == msgs
+      assert init_spy.call_count == len(fns)
+
+      # stopping early doesn't wait for or break the remaining segments
+      assert next(iter(LogReader(fns, prefetch=2))).as_builder().to_bytes() == msgs[0]
+
+  def test_time_series(self):
+    dats = []
+    for i in range(100):
+      # every tenth message is split over several segments, which can only be read through a reader
+      builder = capnp._MallocMessageBuilder(4 if i % 10 == 0 else 1024)
+      msg = builder.init_root(capnp_log.Event)
+      msg.logMonoTime = (100 - i) * 10_000_000
+      msg.valid = i % 3 == 0
+      if i % 2:
+        cs = msg.init("carState")
+        cs.vEgo = i
+        cs.gearShifter = i % 4
+        cs.cruiseState.speed = -i
+        cs.canErrorCounter = i
+        cs.init("buttonEvents", i % 3)
+      else:
+        gnss = msg.init("ubloxGnss")
+        if i % 4:
+          gnss.init("measurementReport").numMeas = i
+        else:
+          gnss.init("ephemeris").svId = i
+      dats.append(msg.to_bytes())
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fns = [os.path.join(tmpdir, "rlog0.zst"), os.path.join(tmpdir, "rlog1.zst")]
+      for fn, dat in zip(fns, (dats[:50], dats[50:]), strict=True):
+        with open(fn, "wb") as f:
+          f.write(zstd.compress(b"".join(dat)))
+
+      ts = LogReader(fns).time_series
+      assert ts.keys() == {"carState", "ubloxGnss"}
+      cs = ts["carState"]
+      assert np.all(np.diff(cs["t"]) > 0)
+      assert cs["vEgo"].tolist() == list(range(99, 0, -2))
+      assert cs["cruiseState/speed"].tolist() == list(range(-99, 0, 2))
+      assert cs["gearShifter"].tolist() == [("unknown", "park", "drive", "neutral")[i % 4] for i in range(99, 0, -2)]
+      assert cs["_valid"].tolist() == [i % 3 == 0 for i in range(99, 0, -2)]
+      assert [len(b) for b in cs["buttonEvents"]] == [i % 3 for i in range(99, 0, -2)]
+
+      gnss = ts["ubloxGnss"]
+      assert gnss["_which"].tolist() == [("ephemeris", "measurementReport")[i % 4 != 0] for i in range(98, -1, -2)]
+      assert np.array_equal(gnss["measurementReport/numMeas"], [i if i % 4 else 0 for i in range(98, -1, -2)])
+      assert np.isnan(gnss["measurementReport/rcvTow"][gnss["_which"] == "ephemeris"]).all()
+
+      # reading the columns from readers gives the same table
+      expected = msgs_to_time_series(LogReader(fns, stream=True))
+      for service, columns in expected.items():
+        assert columns.keys() == ts[service].keys()
+        for name, values in columns.items():
+          assert values.dtype == ts[service][name].dtype, name
+          assert str(values.tolist()) == str(ts[service][name].tolist()), name
+
+      ts = LogReader(fns).get_time_series(["carState/vEgo", "carState/cruiseState"])
+      assert ts.keys() == {"carState"}
+      assert set(ts["carState"]) == {"t", "_valid", "vEgo"} | {n for n in cs if n.startswith("cruiseState/")}
+
+  def test_time_series_cache(self, mocker, monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      monkeypatch.setenv("COMMA_CACHE", os.path.join(tmpdir, "cache"))
+      fns = [os.path.join(tmpdir, f"rlog{i}.zst") for i in range(2)]
+      for i, fn in enumerate(fns):
+        save_log(fn, generate_ragged_msgs(100 + i))
+
+      expected = LogReader(fns).time_series
+      assert expected["carState"]["buttonEvents"].dtype == object and expected["carParams"]["carFw"].dtype == object
+      assert LogReader(fns).get_time_series(["carState/vEgo"], cache=True)["carState"].keys() == {"t", "_valid", "vEgo"}
+
+      # only the columns that weren't asked for before are extracted
+      extract_spy = mocker.spy(logreader, "events_to_time_series")
+      ts = LogReader(fns).get_time_series(cache=True)
+      assert extract_spy.call_count == len(fns)
+      assert "carState/vEgo" not in extract_spy.call_args.args[2]
+      assert ts.keys() == expected.keys()
+      for service, columns in expected.items():
+        for name, values in columns.items():
+          assert str(values.tolist()) == str(ts[service][name].tolist()), name
+
+      # everything comes from the cache now, lists that differ in length too, without reading the logs
+      extract_spy.reset_mock()
+      lr_spy = mocker.spy(logreader, "_LogFileReader")
+      ts = LogReader(fns).get_time_series(cache=True)
+      assert isinstance(LogReader(fns[0]).get_time_series(cache=True)["carState"]["vEgo"], np.memmap)
+      assert extract_spy.call_count == 0 and lr_spy.call_count == 0
+      for service, columns in expected.items():
+        for name, values in columns.items():
+          assert str(values.tolist()) == str(ts[service][name].tolist()), name
+
+      # a pickle in the cache is never loaded
+      ragged = np.empty(2, dtype=object)
+      ragged[:] = [[1], [2, 3]]
+      np.save(os.path.join(logreader.time_series_cache_path(fns[0], "carState"), "ragged.npy"), ragged, allow_pickle=True)
+      assert logreader.load_time_series(fns[0], "carState", ["ragged"]) == {}
+
+      # a new schema or cache version doesn't reuse the columns
+      assert logreader.load_time_series(fns[0], "carState", ["vEgo"]).keys() == {"vEgo"}
+      with monkeypatch.context() as m:
+        m.setattr(logreader, "time_series_cache_version", lambda: "v0_other")
+        assert logreader.load_time_series(fns[0], "carState", ["vEgo"]) == {}
+
+      logreader.evict_time_series_cache(0)
+      assert not any(f.endswith(logreader.TIME_SERIES_CACHE_SUFFIX) for f in os.listdir(os.path.join(tmpdir, "cache")))
+
+  def test_run_across_segments_local(self, mocker):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fns = [os.path.join(tmpdir, f"rlog{i}.zst") for i in range(4)]
+      for i, fn in enumerate(fns):
+        save_log(fn, generate_msgs(20 + i))
+      lr = LogReader(fns)
+      expected = [mono_times(LogReader(fn)) for fn in fns]
+      list(lr)
+
+      # only identifiers are sent to the workers, never the reader and the segments it already loaded
+      pickle_spy = mocker.spy(LogReader, "__reduce_ex__")
+      assert lr.run_across_segments(2, mono_times) == sum(expected, [])
+      assert pickle_spy.call_count == 0
+
+      assert list(lr.imap_segments(2, mono_times)) == expected
+      assert sorted(lr.imap_segments(2, mono_times, ordered=False)) == sorted(expected)
+      assert lr.run_across_segments(2, mono_times, reducer=lambda acc, p: acc + len(p), initial=0, ordered=False) == sum(map(len, expected))
+
+  @parameterized.expand([(".zst",), (".bz2",), ("",)])
+  def test_save_log_raw(self, ext):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fn = os.path.join(tmpdir, "rlog" + ext)
+      save_log(fn, generate_msgs())
+      lr = LogReader(fn)
+      msgs = [m.as_builder().to_bytes() for m in lr]
+      assert b"".join(lr.iter_raw()) == b"".join(msgs)
+      assert [bytes(m) for m in LogReader(fn, stream=True, services=["carState"]).iter_raw()] == \
+             [m.as_builder().to_bytes() for m in LogReader(fn, services=["carState"])]
+
+      # serialized events are copied as they are, and readers are encoded again
+      raw_fn = os.path.join(tmpdir, "raw" + ext)
+      save_log(raw_fn, (raw if i % 2 else msg for i, (raw, msg) in enumerate(zip(lr.iter_raw(), lr, strict=True))))
+      assert [m.as_builder().to_bytes() for m in LogReader(raw_fn)] == msgs
+
+      sanitized_fn = os.path.join(tmpdir, "sanitized" + ext)
+      save_log(sanitized_fn, sanitize_raw(lr.iter_raw()))
+      assert [m.as_builder().to_bytes() for m in LogReader(sanitized_fn)] == [m.as_builder().to_bytes() for m in sanitize(lr)]
+
+  def test_auto_source_cache(self, mocker, monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      monkeypatch.setenv("COMMA_CACHE", tmpdir)
+      sr = SegmentRange(f"{TEST_ROUTE}/0:3")
+      fns = [os.path.join(tmpdir, f"rlog{i}.zst") for i in range(3)]
+      for fn in fns[1:]:
+        save_log(fn, generate_msgs(10))
+
+      missing_source = mocker.Mock(__name__="missing_source", return_value=fns)
+      valid_source = mocker.Mock(__name__="valid_source", return_value=fns[1:] + fns[1:2])
+      sources = [missing_source, valid_source]
+      assert logreader.auto_source(sr, ReadMode.RLOG, sources) == fns[1:] + fns[1:2]
+      assert missing_source.call_count == valid_source.call_count == 1
+
+      # resolved once, until it expires
+      assert logreader.auto_source(sr, ReadMode.RLOG, sources) == fns[1:] + fns[1:2]
+      assert missing_source.call_count == valid_source.call_count == 1
+      assert logreader.auto_source(sr, ReadMode.QLOG, sources) == fns[1:] + fns[1:2]
+      assert valid_source.call_count == 2
+
+      # only readable by the user, and another account resolves it again
+      path = logreader.source_cache_path(sr, ReadMode.RLOG, sources)
+      assert os.stat(path).st_mode & 0o777 == 0o600
+      mocker.patch("openpilot.tools.lib.logreader.get_token", return_value="other account")
+      logreader.auto_source(sr, ReadMode.RLOG, sources)
+      assert valid_source.call_count == 3
+      mocker.patch("openpilot.tools.lib.logreader.get_token", return_value=None)
+
+      # a damaged entry is a miss
+      for damaged in ("{}", "[]", '{"time": "now"}'):
+        with open(path, "w") as f:
+          f.write(damaged)
+        assert logreader.load_source_cache(sr, ReadMode.RLOG, sources) is None
+
+      # the key is the range as it was given, an open ended range isn't looked up
+      max_seg = mocker.patch("openpilot.tools.lib.route.get_max_seg_number_cached", return_value=NUM_SEGS)
+      open_sr = SegmentRange(f"{TEST_ROUTE}/1:")
+      logreader.auto_source(open_sr, ReadMode.RLOG, [valid_source])
+      assert logreader.auto_source(open_sr, ReadMode.RLOG, [valid_source]) == fns[1:] + fns[1:2]
+      assert valid_source.call_count == 4 and not max_seg.called
+
+      mocker.patch("time.time", return_value=time.time() + logreader.SOURCE_CACHE_TTL + 1)
+      logreader.auto_source(sr, ReadMode.RLOG, sources)
+      assert valid_source.call_count == 5
+
+  def test_identifiers_resolved_concurrently(self, mocker):
+    mocker.patch("openpilot.tools.lib.logreader.file_exists", return_value=True)
+    barrier = threading.Barrier(3, timeout=10)
+
+    def source(sr, mode):
+      barrier.wait()  # every identifier is resolved at once
+      return [f"{sr.route_name}/{seg}/{mode}" for seg in sr.seg_idxs]
+
+    lr = LogReader([f"{TEST_ROUTE}/{i}" for i in range(3)], default_mode=ReadMode.QLOG, source=source)
+    assert lr.logreader_identifiers == [f"{TEST_ROUTE}/{i}/q" for i in range(3)]
+
+  def test_invalid_files_concurrent(self, mocker):
+    exists = mocker.patch("openpilot.tools.lib.logreader.file_exists", side_effect=lambda fn: not fn.startswith("missing"))
+    files = ["a", "missing1", None, "b", "missing2"]
+    assert list(logreader.get_invalid_files(files)) == ["missing1", None, "missing2"]
+    assert exists.call_count == 4
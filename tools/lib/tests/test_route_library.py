@@ -1,6 +1,10 @@
+import os
+import threading
+import time
 from collections import namedtuple
 
-from openpilot.tools.lib.route import SegmentName
+from openpilot.tools.lib import route
+from openpilot.tools.lib.route import Route, SegmentName
 
 class TestRouteLibrary:
   def test_segment_name_formats(self):
@@ -25,3 +29,53 @@ class TestRouteLibrary:
 
     for case in cases:
       _validate(case)
+
+  def test_cached_api_get(self, mocker, monkeypatch, tmp_path):
+    monkeypatch.setenv("COMMA_CACHE", str(tmp_path))
+    mocker.patch("openpilot.tools.lib.route.get_token", return_value=None)
+    api = mocker.patch("openpilot.tools.lib.route.CommaApi").return_value
+    api.get.side_effect = lambda endpoint: {"endpoint": endpoint}
+
+    assert route.cached_api_get("v1/route/a") == {"endpoint": "v1/route/a"}
+    assert route.cached_api_get("v1/route/a") == {"endpoint": "v1/route/a"}
+    assert route.cached_api_get("v1/route/b") == {"endpoint": "v1/route/b"}
+    assert api.get.call_count == 2
+
+    # only the owner can read the responses, and other accounts don't get them
+    assert os.stat(route.api_cache_path("v1/route/a")).st_mode & 0o777 == 0o600
+    mocker.patch("openpilot.tools.lib.route.get_token", return_value="other")
+    assert route.cached_api_get("v1/route/a") == {"endpoint": "v1/route/a"}
+    assert route.cached_api_get("v1/route/a?b") == {"endpoint": "v1/route/a?b"}
+    assert api.get.call_count == 4
+
+    mocker.patch("time.time", return_value=time.time() + route.API_CACHE_TTL + 1)
+    route.cached_api_get("v1/route/a")
+    assert api.get.call_count == 5
+
+  def test_get_routes(self, mocker, monkeypatch, tmp_path):
+    monkeypatch.setenv("COMMA_CACHE", str(tmp_path))
+    mocker.patch("openpilot.tools.lib.route.get_token", return_value=None)
+    routes = [f"a2a0ccea32023010|2023-07-27--13-0{i}-19" for i in range(5)]
+    barrier = threading.Barrier(len(routes), timeout=10)
+
+    def get(endpoint):
+      name = endpoint.split("/")[2]
+      if not endpoint.endswith("/files"):
+        return {"url": f"https://example.com/{name}"}
+      barrier.wait()  # every route's files are requested at once
+      dongle_id, time_str = name.split("|")
+      return {"logs": [f"https://example.com/{dongle_id}/{time_str}/{seg}/rlog.bz2" for seg in range(3)],
+              "qlogs": [f"https://example.com/{dongle_id}/{time_str}/{seg}/qlog.bz2" for seg in range(2)]}
+    api = mocker.patch("openpilot.tools.lib.route.CommaApi").return_value
+    api.get.side_effect = get
+
+    by_name = route.get_routes(routes + routes[:2])
+    assert list(by_name) == routes
+    for name, r in by_name.items():
+      assert r.log_paths()[2].endswith(f"{name.split('|')[1]}/2/rlog.bz2")
+      assert r.qlog_paths()[2] is None
+
+    # the lists are cached on disk
+    calls = api.get.call_count
+    assert [Route(name).log_paths() for name in routes] == [r.log_paths() for r in by_name.values()]
+    assert api.get.call_count == calls
@@ -0,0 +1,84 @@
+import random
+
+import pytest
+
+from openpilot.tools.lib.vidindex import HevcNalUnitType, VideoFileInvalid, hevc_index_data, hevc_index_reference
+
+
+def ue(val: int) -> str:
+  code = bin(val + 1)[2:]
+  return "0" * (len(code) - 1) + code
+
+
+def nal_unit(rng: random.Random, nal_unit_type: int, header_bits: str = "", first: bool = False) -> bytes:
+  bits = header_bits + "".join(rng.choice("01") for _ in range(rng.randint(0, 40)))
+  bits += "1" + "0" * (-(len(bits) + 1) % 8)
+  payload = int(bits, 2).to_bytes(len(bits) // 8, "big")
+  # no emulated start codes in the payload
+  payload = payload.replace(b"\x00\x00", b"\x00\x03\x00") + bytes(rng.randint(0x10, 0xff) for _ in range(rng.randint(0, 30)))
+  start_code = b"\x00\x00\x00\x01" if first or rng.random() < 0.5 else b"\x00\x00\x01"
+  return start_code + bytes([nal_unit_type << 1, 1]) + payload
+
+
+def make_hevc(seed: int, num_frames: int = 50, pps_id_bits: int = 6, slice_types: tuple[int, ...] = (0, 1, 2)) -> bytes:
+  rng = random.Random(seed)
+  dat = nal_unit(rng, HevcNalUnitType.VPS_NUT, first=True)
+  dat += nal_unit(rng, HevcNalUnitType.SPS_NUT) + nal_unit(rng, HevcNalUnitType.PPS_NUT)
+  for i in range(num_frames):
+    if rng.random() < 0.1:
+      dat += nal_unit(rng, rng.choice([HevcNalUnitType.PREFIX_SEI_NUT, HevcNalUnitType.AUD_NUT, HevcNalUnitType.PPS_NUT]))
+    nal_unit_type = rng.choice([HevcNalUnitType.IDR_W_RADL, HevcNalUnitType.CRA_NUT] if i % 10 == 0 else
+                               [HevcNalUnitType.TRAIL_R, HevcNalUnitType.TRAIL_N, HevcNalUnitType.RASL_N])
+    irap = "0" if HevcNalUnitType.BLA_W_LP <= nal_unit_type <= HevcNalUnitType.RSV_IRAP_VCL23 else ""
+    header = "1" + irap + ue(rng.randrange(2 ** pps_id_bits)) + ue(rng.choice(slice_types))
+    dat += nal_unit(rng, nal_unit_type, header)
+    for _ in range(rng.randint(0, 2)):
+      dat += nal_unit(rng, nal_unit_type, "0")
+  return dat
+
+
+def assert_same_index(dat: bytes) -> None:
+  try:
+    expected = hevc_index_reference(dat)
+  except (VideoFileInvalid, IndexError) as e:
+    with pytest.raises(type(e)):
+      hevc_index_data(dat)
+  else:
+    assert hevc_index_data(dat) == expected
+  assert hevc_index_data(dat, allow_corrupt=True) == hevc_index_reference(dat, allow_corrupt=True)
+
+
+class TestVidIndex:
+  @pytest.mark.parametrize("seed", range(20))
+  def test_matches_reference(self, seed):
+    dat = make_hevc(seed)
+    assert hevc_index_data(dat) == hevc_index_reference(dat)
+    assert len(hevc_index_data(dat)[0]) == 50
+
+  def test_long_slice_headers(self):
+    # headers that don't fit 64 bits are parsed bit by bit
+    for seed in range(5):
+      assert_same_index(make_hevc(seed, pps_id_bits=40))
+    header = "1" + ue(2 ** 41 - 2) + ue(1) + "1"
+    header += "0" * (-len(header) % 8)
+    slice_nal = b"\x00\x00\x01" + bytes([HevcNalUnitType.TRAIL_R << 1, 1]) + int(header, 2).to_bytes(len(header) // 8, "big")
+    dat = make_hevc(0, num_frames=1) + slice_nal + b"\xff"
+    frame_types = hevc_index_data(dat)[0]
+    assert frame_types == hevc_index_reference(dat)[0] and frame_types[-1] == (1, len(dat) - len(slice_nal) - 1)
+
+  @pytest.mark.parametrize("seed", range(20))
+  def test_corrupt(self, seed):
+    rng = random.Random(seed)
+    dat = make_hevc(seed, slice_types=(0, 1, 2, 5) if seed % 2 else (0, 1, 2))
+    if seed % 4 == 0:
+      dat = dat[:rng.randrange(4, len(dat))]
+    assert_same_index(dat)
+
+  def test_invalid(self):
+    with pytest.raises(VideoFileInvalid):
+      hevc_index_data(b"\x00\x00")
+    with pytest.raises(VideoFileInvalid):
+      hevc_index_data(b"\x01\x00\x00\x01\x40\x01")
+    with pytest.raises(VideoFileInvalid):
+      hevc_index_data(b"\x00\x00\x00\x00\x01\x40\x01")
+
@@ -1,7 +1,14 @@
+import contextlib
+import fcntl
 import logging
 import os
+import re
 import socket
+import threading
 import time
+import zlib
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
 from hashlib import sha256
 from urllib3 import PoolManager, Retry
 from urllib3.response import BaseHTTPResponse
@@ -12,6 +19,16 @@ from openpilot.system.hardware.hw import Paths
 #  Cache chunk size
 K = 1000
 CHUNK_SIZE = 1000 * K
+DOWNLOAD_THREADS = int(os.getenv("URLFILE_DOWNLOAD_THREADS", "8"))  # ranged GETs in flight at once, shared by all files
+READ_AHEAD_CHUNKS = int(os.getenv("URLFILE_READ_AHEAD", "2"))  # chunks downloaded in the background after sequential reads
+DOWNLOAD_CACHE_SIZE = int(os.getenv("DOWNLOAD_CACHE_SIZE", str(20 * 1024 ** 3)))  # bytes of chunks kept in the download cache
+EVICT_INTERVAL = 256 * CHUNK_SIZE  # bytes of chunks written between evictions
+# the files kept per url: chunks, the chunk index and the length of files cached before there was an index,
+# and the event and video indexes of logs and videos (local ones too, see file_cache_key)
+URL_CACHE_FILE = re.compile(r"(?P<key>[0-9a-f]{64})_(?:\d+\.0|index|length|events\.npy|vidindex\.npz)")
+RETRIES = 5
+RETRY_BACKOFF = 0.5  # seconds, doubled on every retry
+RETRY_STATUSES = [409, 429, 503, 504]
 
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
@@ -23,21 +40,191 @@ class URLFileException(Exception):
   pass
 
 
+def check_response(url: str, response_code: int, headers: dict[str, str], download_range: bool, body: bytes) -> None:
+  if response_code == 416:  # Requested Range Not Satisfiable
+    raise URLFileException(f"Error, range out of bounds {response_code} {headers} ({url}): {repr(body)[:500]}")
+  if download_range and response_code != 206:  # Partial Content
+    raise URLFileException(f"Error, requested range but got unexpected response {response_code} {headers} ({url}): {repr(body)[:500]}")
+  if (not download_range) and response_code != 200:  # OK
+    raise URLFileException(f"Error {response_code} {headers} ({url}): {repr(body)[:500]}")
+
+
+class DownloadCacheIndex:
+  """
+    The chunks of a url that are in the download cache, with their crc32, and the length of the url.
+    It's a log next to the chunks, so reads don't stat every chunk, and chunks that don't
+    match their checksum (e.g. truncated by a full disk) are downloaded again instead of being served.
+
+    Every chunk written or dropped and the length are appended to the log as a line, under an fcntl lock so lines
+    of processes sharing the cache don't mix. A chunk that isn't in the index is looked up in the lines appended since
+    the log was last read, which are what other processes cached in the meantime. The last line of a chunk wins.
+  """
+  _lock = threading.Lock()
+  _written = 0  # bytes of chunks written since the last eviction
+
+  def __init__(self, url: str):
+    self.key = hash_256(url)
+    self.path = os.path.join(Paths.download_cache_root(), self.key + "_index")
+    self.length: int|None = None
+    self.chunks: dict[int, int] = {}
+    self._read = 0  # bytes of the log read
+    self._log_lock = threading.Lock()
+    self._load()
+    if self.length is None:
+      # cached before there was an index
+      with contextlib.suppress(OSError, ValueError), open(os.path.join(Paths.download_cache_root(), self.key + "_length")) as f:
+        self.length = int(f.read())
+
+  def _load(self) -> None:
+    # apply the lines appended to the log since it was last read, a line that's still being written is left for later
+    with self._log_lock:
+      try:
+        with open(self.path, "rb") as f:
+          if os.fstat(f.fileno()).st_size < self._read:
+            # evicted and cached again
+            self.chunks, self._read = {}, 0
+          f.seek(self._read)
+          dat = f.read()
+      except OSError:
+        return
+      dat = dat[:dat.rfind(b"\n") + 1]
+      self._read += len(dat)
+      for line in dat.decode(errors="replace").splitlines():
+        key, _, value = line.partition(" ")
+        with contextlib.suppress(ValueError):
+          if key == "length":
+            self.length = int(value)
+          elif value == "-":
+            self.chunks.pop(int(key), None)
+          else:
+            self.chunks[int(key)] = int(value)
+
+  def _append(self, line: str) -> None:
+    with contextlib.suppress(OSError):
+      fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.write(fd, f"{line}\n".encode())
+      finally:
+        os.close(fd)
+
+  def _lookup(self, chunk: int) -> int|None:
+    # crc of the chunk, from the lines other processes appended if this one didn't have it yet
+    if chunk not in self.chunks:
+      self._load()
+    return self.chunks.get(chunk)
+
+  def chunk_path(self, chunk: int) -> str:
+    # chunk files are named after the chunk number as a float, like they always were
+    return os.path.join(Paths.download_cache_root(), self.key + "_" + str(chunk * CHUNK_SIZE / CHUNK_SIZE))
+
+  def touch(self) -> None:
+    # the index is the url's last use for eviction
+    with contextlib.suppress(OSError):
+      os.utime(self.path)
+
+  def set_length(self, length: int) -> None:
+    self.length = length
+    self._append(f"length {length}")
+
+  def _drop(self, chunk: int) -> None:
+    with self._log_lock:
+      self.chunks.pop(chunk, None)
+    self._append(f"{chunk} -")
+
+  def get(self, chunk: int) -> bytes|None:
+    if (crc := self._lookup(chunk)) is None:
+      return None
+    try:
+      with open(self.chunk_path(chunk), "rb") as f:
+        data = f.read()
+    except OSError:
+      data = None
+    if data is None or zlib.crc32(data) != crc:
+      self._drop(chunk)
+      return None
+    return data
+
+  def readinto(self, chunk: int, out: memoryview) -> bool:
+    """Reads the chunk into out, which has to be the size of the chunk. False if it isn't cached or doesn't match its checksum"""
+    if (crc := self._lookup(chunk)) is None:
+      return False
+    try:
+      with open(self.chunk_path(chunk), "rb", buffering=0) as f:
+        n = f.readinto(out)
+        intact = n == len(out) and not f.read(1) and zlib.crc32(out) == crc
+    except OSError:
+      intact = False
+    if not intact:
+      self._drop(chunk)
+    return intact
+
+  def put(self, chunk: int, data: bytes|memoryview) -> None:
+    with atomic_write_in_dir(self.chunk_path(chunk), mode="wb", overwrite=True) as f:
+      f.write(data)
+    crc = zlib.crc32(data)
+    with self._log_lock:
+      self.chunks[chunk] = crc
+    self._append(f"{chunk} {crc}")
+    with self._lock:
+      DownloadCacheIndex._written += len(data)
+      evict = DownloadCacheIndex._written >= min(EVICT_INTERVAL, DOWNLOAD_CACHE_SIZE // 16)
+      if evict:
+        DownloadCacheIndex._written = 0
+    if evict:
+      evict_download_cache()
+
+
+def evict_download_cache(max_size: int|None = None) -> None:
+  """Delete cached urls, least recently used first, until their files fit in max_size bytes"""
+  max_size = DOWNLOAD_CACHE_SIZE if max_size is None else max_size
+  root = Paths.download_cache_root()
+  urls: dict[str, list] = {}
+  with contextlib.suppress(FileNotFoundError):
+    for entry in os.scandir(root):
+      if (m := URL_CACHE_FILE.fullmatch(entry.name)) is None:
+        continue
+      with contextlib.suppress(FileNotFoundError):
+        st = entry.stat()
+        # [last use, size, files], the index's mtime is the last use of urls that have one
+        url = urls.setdefault(m.group("key"), [0, 0, []])
+        last_use = st.st_mtime_ns if entry.name.endswith("_index") else st.st_mtime_ns - 1
+        url[0], url[1] = max(url[0], last_use), url[1] + st.st_size
+        url[2].append(entry.path)
+
+  total = sum(size for _, size, _ in urls.values())
+  for _, size, paths in sorted(urls.values()):
+    if total <= max_size:
+      break
+    for path in paths:
+      with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+    total -= size
+
+
 class URLFile:
   _pool_manager: PoolManager|None = None
+  _executor: ThreadPoolExecutor|None = None
 
   @staticmethod
   def reset() -> None:
     URLFile._pool_manager = None
+    URLFile._executor = None
 
   @staticmethod
   def pool_manager() -> PoolManager:
     if URLFile._pool_manager is None:
       socket_options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),]
-      retries = Retry(total=5, backoff_factor=0.5, status_forcelist=[409, 429, 503, 504])
+      retries = Retry(total=RETRIES, backoff_factor=RETRY_BACKOFF, status_forcelist=RETRY_STATUSES)
       URLFile._pool_manager = PoolManager(num_pools=10, maxsize=100, socket_options=socket_options, retries=retries)
     return URLFile._pool_manager
 
+  @staticmethod
+  def executor() -> ThreadPoolExecutor:
+    if URLFile._executor is None:
+      URLFile._executor = ThreadPoolExecutor(DOWNLOAD_THREADS, thread_name_prefix="urlfile")
+    return URLFile._executor
+
   def __init__(self, url: str, timeout: int=10, debug: bool=False, cache: bool|None=None):
     self._url = url
     self._timeout = Timeout(connect=timeout, read=timeout)
@@ -48,6 +235,10 @@ class URLFile:
     self._force_download = not int(os.environ.get("FILEREADER_CACHE", "0"))
     if cache is not None:
       self._force_download = not cache
+    # chunks being downloaded ahead of sequential reads, and where the last read ended
+    self._read_ahead: dict[int, Future] = {}
+    self._read_end: int|None = None
+    self._cache_index: DownloadCacheIndex|None = None
 
     if not self._force_download:
       os.makedirs(Paths.download_cache_root(), exist_ok=True)
@@ -56,10 +247,10 @@ class URLFile:
     return self
 
   def __exit__(self, exc_type, exc_value, traceback) -> None:
-    pass
+    self.close()
 
-  def _request(self, method: str, url: str, headers: dict[str, str]|None=None) -> BaseHTTPResponse:
-    return URLFile.pool_manager().request(method, url, timeout=self._timeout, headers=headers)
+  def _request(self, method: str, url: str, headers: dict[str, str]|None=None, preload_content: bool=True) -> BaseHTTPResponse:
+    return URLFile.pool_manager().request(method, url, timeout=self._timeout, headers=headers, preload_content=preload_content)
 
   def get_length_online(self) -> int:
     response = self._request('HEAD', self._url)
@@ -68,54 +259,129 @@ class URLFile:
     length = response.headers.get('content-length', 0)
     return int(length)
 
+  @property
+  def cache_enabled(self) -> bool:
+    return not self._force_download
+
+  @property
+  def _cache(self) -> DownloadCacheIndex:
+    if self._cache_index is None:
+      self._cache_index = DownloadCacheIndex(self._url)
+    return self._cache_index
+
   def get_length(self) -> int:
     if self._length is not None:
       return self._length
 
-    file_length_path = os.path.join(Paths.download_cache_root(), hash_256(self._url) + "_length")
-    if not self._force_download and os.path.exists(file_length_path):
-      with open(file_length_path) as file_length:
-        content = file_length.read()
-        self._length = int(content)
-        return self._length
+    if not self._force_download and self._cache.length is not None:
+      self._length = self._cache.length
+      return self._length
 
     self._length = self.get_length_online()
     if not self._force_download and self._length != -1:
-      with atomic_write_in_dir(file_length_path, mode="w", overwrite=True) as file_length:
-        file_length.write(str(self._length))
+      self._cache.set_length(self._length)
     return self._length
 
+  def _load_chunk(self, chunk: int, out: memoryview|None=None) -> bytes|None:
+    """
+      Chunk from the download cache, downloaded (and cached unless caching is off) if it's not there.
+      With out, the size of the chunk, the chunk is read into it and None is returned.
+    """
+    if not self._force_download:
+      if out is None and (data := self._cache.get(chunk)) is not None:
+        return data
+      if out is not None and self._cache.readinto(chunk, out):
+        return None
+
+    start = chunk * CHUNK_SIZE
+    end = min(start + CHUNK_SIZE, self.get_length())
+    data = self._download_range(start, end) if out is None else self._download_range_into(start, end, out)
+    if not self._force_download:
+      self._cache.put(chunk, out if data is None else data)
+    return data
+
   def read(self, ll: int|None=None) -> bytes:
-    if self._force_download:
-      return self.read_aux(ll=ll)
+    if self._force_download and ll is None and self._pos == 0:
+      # one GET streams the whole file without any round trips in between
+      return self.read_aux()
+    ret = self._read(ll)
+    assert isinstance(ret, bytes)
+    return ret
 
+  def readinto(self, b: bytearray|memoryview) -> int:
+    """Reads up to len(b) bytes into b, without copying them through intermediate buffers. Returns the number of bytes read"""
+    out = memoryview(b).cast("B")
+    length = self.get_length()
+    if self._force_download and self._pos == 0 and 0 < length <= len(out):
+      self._get_into({}, False, out[:length])
+      self._pos = length
+      return length
+    ret = self._read(len(out), out)
+    assert isinstance(ret, int)
+    return ret
+
+  def _read(self, ll: int|None, out: memoryview|None=None) -> bytes|int:
+    """Reads ll bytes (the rest of the file if None) from the position, as bytes or into out, returning how many there were"""
     file_begin = self._pos
-    file_end = self._pos + ll if ll is not None else self.get_length()
-    assert file_end != -1, f"Remote file is empty or doesn't exist: {self._url}"
-    #  We have to align with chunks we store. Position is the begginiing of the latest chunk that starts before or at our file
-    position = (file_begin // CHUNK_SIZE) * CHUNK_SIZE
-    response = b""
-    while True:
-      self._pos = position
-      chunk_number = self._pos / CHUNK_SIZE
-      file_name = hash_256(self._url) + "_" + str(chunk_number)
-      full_path = os.path.join(Paths.download_cache_root(), str(file_name))
-      data = None
-      #  If we don't have a file, download it
-      if not os.path.exists(full_path):
-        data = self.read_aux(ll=CHUNK_SIZE)
-        with atomic_write_in_dir(full_path, mode="wb", overwrite=True) as new_cached_file:
-          new_cached_file.write(data)
+    length = self.get_length()
+    assert length != -1, f"Remote file is empty or doesn't exist: {self._url}"
+    file_end = length if ll is None else min(file_begin + ll, length)
+    if file_begin >= file_end:
+      return b"" if out is None else 0
+    if not self._force_download:
+      self._cache.touch()
+    sequential = file_begin == self._read_end
+    first, last = file_begin // CHUNK_SIZE, (file_end - 1) // CHUNK_SIZE
+
+    # read ahead chunks this read jumped away from aren't needed anymore
+    for chunk in list(self._read_ahead):
+      if not first <= chunk <= last + READ_AHEAD_CHUNKS:
+        self._read_ahead.pop(chunk).cancel()
+
+    # every chunk the read touches is fetched concurrently. without the cache, only the bytes that
+    # are read are downloaded, unless reads are sequential and the whole chunk will be read anyway.
+    # with out, downloads and whole cached chunks go straight into their part of it
+    pieces: list[tuple[Future|Callable[[], bytes|None], int, int]] = []
+    views: list[memoryview|None] = []
+    for chunk in range(first, last + 1):
+      start, end = max(file_begin, chunk * CHUNK_SIZE), min(file_end, (chunk + 1) * CHUNK_SIZE)
+      offset = chunk * CHUNK_SIZE
+      view = None if out is None else out[start - file_begin:end - file_begin]
+      views.append(view)
+      if chunk in self._read_ahead:
+        pieces.append((self._read_ahead.pop(chunk), start - offset, end - offset))
+      elif self._force_download and not (sequential and READ_AHEAD_CHUNKS > 0):
+        if view is None:
+          pieces.append((lambda start=start, end=end: self._download_range(start, end), 0, end - start))
+        else:
+          pieces.append((lambda start=start, end=end, view=view: self._download_range_into(start, end, view), 0, end - start))
       else:
-        with open(full_path, "rb") as cached_file:
-          data = cached_file.read()
-
-      response += data[max(0, file_begin - position): min(CHUNK_SIZE, file_end - position)]
-
-      position += CHUNK_SIZE
-      if position >= file_end:
-        self._pos = file_end
-        return response
+        whole_chunk = start == offset and end == min(offset + CHUNK_SIZE, length)
+        view = view if whole_chunk else None
+        pieces.append((lambda chunk=chunk, view=view: self._load_chunk(chunk, view), start - offset, end - offset))
+    if len(pieces) > 1:
+      pieces = [(self.executor().submit(p) if callable(p) else p, a, b) for p, a, b in pieces]
+    chunks = [p() if callable(p) else p.result() for p, _, _ in pieces]
+    response: bytes|int
+    if out is None:
+      response = b"".join(dat[a:b] for dat, (_, a, b) in zip(chunks, pieces, strict=True))
+    else:
+      for dat, (_, a, b), view in zip(chunks, pieces, views, strict=True):
+        if dat is not None:
+          view[:] = dat[a:b]
+      response = file_end - file_begin
+
+    if sequential and READ_AHEAD_CHUNKS > 0:
+      if self._force_download and file_end < min((last + 1) * CHUNK_SIZE, length):
+        # without the cache, the rest of the last chunk is kept for the next read
+        self._read_ahead[last] = Future()
+        self._read_ahead[last].set_result(chunks[-1])
+      for chunk in range(last + 1, min(last + 1 + READ_AHEAD_CHUNKS, -(-length // CHUNK_SIZE))):
+        if chunk not in self._read_ahead and (self._force_download or chunk not in self._cache.chunks):
+          self._read_ahead[chunk] = self.executor().submit(self._load_chunk, chunk)
+
+    self._pos = self._read_end = file_end
+    return response
 
   def read_aux(self, ll: int|None=None) -> bytes:
     download_range = False
@@ -130,6 +396,21 @@ class URLFile:
       headers['Range'] = f"bytes={self._pos}-{end}"
       download_range = True
 
+    ret = self._get(headers, download_range)
+    self._pos += len(ret)
+    return ret
+
+  def _download_range(self, start: int, end: int) -> bytes:
+    # doesn't touch the file position, so ranges can be downloaded from several threads
+    if start >= end:
+      return b""
+    return self._get({'Range': f"bytes={start}-{end - 1}"}, True)
+
+  def _download_range_into(self, start: int, end: int, out: memoryview) -> None:
+    if start < end:
+      self._get_into({'Range': f"bytes={start}-{end - 1}"}, True, out)
+
+  def _get(self, headers: dict[str, str], download_range: bool) -> bytes:
     if self._debug:
       t1 = time.time()
 
@@ -141,20 +422,44 @@ class URLFile:
       if t2 - t1 > 0.1:
         print(f"get {self._url} {headers!r} {t2 - t1:.3f} slow")
 
-    response_code = response.status
-    if response_code == 416:  # Requested Range Not Satisfiable
-      raise URLFileException(f"Error, range out of bounds {response_code} {headers} ({self._url}): {repr(ret)[:500]}")
-    if download_range and response_code != 206:  # Partial Content
-      raise URLFileException(f"Error, requested range but got unexpected response {response_code} {headers} ({self._url}): {repr(ret)[:500]}")
-    if (not download_range) and response_code != 200:  # OK
-      raise URLFileException(f"Error {response_code} {headers} ({self._url}): {repr(ret)[:500]}")
-
-    self._pos += len(ret)
+    check_response(self._url, response.status, headers, download_range, ret)
     return ret
 
+  def _get_into(self, headers: dict[str, str], download_range: bool, out: memoryview) -> None:
+    """Like _get, but the body is streamed into out, which it has to fill"""
+    if self._debug:
+      t1 = time.time()
+
+    response = self._request('GET', self._url, headers=headers, preload_content=False)
+    try:
+      if response.status != (206 if download_range else 200):
+        check_response(self._url, response.status, headers, download_range, response.read())
+      pos = 0
+      # in pieces, urllib3 reads into a temporary buffer of the requested size
+      while pos < len(out) and (n := response.readinto(out[pos:pos + CHUNK_SIZE])):
+        pos += n
+      if pos < len(out):
+        raise URLFileException(f"Error, got {pos} of {len(out)} bytes {headers} ({self._url})")
+    finally:
+      response.drain_conn()
+      response.release_conn()
+
+    if self._debug:
+      t2 = time.time()
+      if t2 - t1 > 0.1:
+        print(f"get {self._url} {headers!r} {t2 - t1:.3f} slow")
+
   def seek(self, pos:int) -> None:
     self._pos = pos
 
+  def tell(self) -> int:
+    return self._pos
+
+  def close(self) -> None:
+    for future in self._read_ahead.values():
+      future.cancel()
+    self._read_ahead.clear()
+
   @property
   def name(self) -> str:
     return self._url
@@ -4,6 +4,8 @@ import os
 import struct
 from enum import IntEnum
 
+import numpy as np
+
 from openpilot.tools.lib.filereader import FileReader
 
 DEBUG = int(os.getenv("DEBUG", "0"))
@@ -17,6 +19,7 @@ DEBUG = int(os.getenv("DEBUG", "0"))
 NAL_UNIT_START_CODE = b"\x00\x00\x01"
 NAL_UNIT_START_CODE_SIZE = len(NAL_UNIT_START_CODE)
 NAL_UNIT_HEADER_SIZE = 2
+NAL_UNIT_SEARCH_SIZE = 256 * 1024  # bytes searched for start codes at once
 
 class HevcNalUnitType(IntEnum):
   TRAIL_N = 0         # RBSP structure: slice_segment_layer_rbsp( )
@@ -258,10 +261,120 @@ def get_hevc_slice_type(dat: bytes, nal_unit_start: int, nal_unit_type: HevcNalU
     raise VideoFileInvalid("slice_type must be 0, 1, or 2")
   return slice_type, is_first_slice
 
+def find_nal_units(dat: bytes) -> np.ndarray:
+  """Offsets of all NAL unit start codes in dat, found with one pass of numpy over the whole buffer"""
+  arr = np.frombuffer(dat, dtype=np.uint8)
+  starts = [np.zeros(0, dtype=np.int64)]
+  # start codes can't overlap, so every 00 00 01 is the start of a NAL unit.
+  # the buffer is searched in pieces that stay in cache, overlapping by the start code size
+  for offset in range(0, len(arr) - NAL_UNIT_START_CODE_SIZE + 1, NAL_UNIT_SEARCH_SIZE):
+    chunk = arr[offset:offset + NAL_UNIT_SEARCH_SIZE + NAL_UNIT_START_CODE_SIZE - 1]
+    ones = np.flatnonzero(chunk[2:] == 1)
+    starts.append(ones[(chunk[ones] == 0) & (chunk[ones + 1] == 0)] + offset)
+  return np.concatenate(starts)
+
+def count_leading_zeros(x: np.ndarray) -> np.ndarray:
+  # of non-zero uint64s
+  n = np.zeros(len(x), dtype=np.int64)
+  for shift in (32, 16, 8, 4, 2, 1):
+    zero = (x >> np.uint64(64 - shift)) == 0
+    n[zero] += shift
+    x = np.where(zero, x << np.uint64(shift), x)
+  return n
+
+def get_hevc_slice_types(dat: bytes, nal_unit_starts: np.ndarray, nal_unit_types: np.ndarray) -> np.ndarray:
+  """get_hevc_slice_type for many first slices at once, nan where the slice header needs the slow path.
+
+  slice_pic_parameter_set_id and slice_type are read from a 64 bit window of the header, which fits
+  every valid slice header by far"""
+  arr = np.frombuffer(dat, dtype=np.uint8)
+  rbsp_starts = nal_unit_starts + NAL_UNIT_START_CODE_SIZE + NAL_UNIT_HEADER_SIZE
+  window_idxs = rbsp_starts[:, None] + np.arange(8)
+  window = np.where(window_idxs < len(arr), arr[np.minimum(window_idxs, len(arr) - 1)], 0).astype(np.uint8)
+  bits = window.view(">u8")[:, 0].astype(np.uint64)
+  available_bits = np.minimum(len(arr) - rbsp_starts, 8) * 8
+
+  # skip first_slice_segment_in_pic_flag, and no_output_of_prior_pics_flag for IRAP pictures
+  skip = 1 + ((nal_unit_types >= HevcNalUnitType.BLA_W_LP) & (nal_unit_types <= HevcNalUnitType.RSV_IRAP_VCL23)).astype(np.int64)
+  bits = bits << skip.astype(np.uint64)
+  ok = bits != 0
+  pps_size = 2 * count_leading_zeros(np.where(ok, bits, 1)) + 1
+  ok &= skip + pps_size < 64
+  bits = np.where(ok, bits << np.where(ok, pps_size, 0).astype(np.uint64), 1)
+  ok &= bits != 0
+  slice_type_size = 2 * count_leading_zeros(np.where(ok, bits, 1)) + 1
+  ok &= skip + pps_size + slice_type_size <= available_bits
+  slice_types = (bits >> (64 - np.where(ok, slice_type_size, 64)).astype(np.uint64)).astype(np.int64) - 1
+  return np.where(ok, slice_types, np.nan)
+
+def hevc_index_data(dat: bytes, allow_corrupt: bool=False) -> tuple[list, int, bytes]:
+  """hevc_index of a whole file in memory. All NAL units are found and classified with numpy,
+  only the few headers that don't fit get_hevc_slice_types are parsed bit by bit"""
+  if len(dat) < NAL_UNIT_START_CODE_SIZE + 1:
+    raise VideoFileInvalid("data is too short")
+
+  if dat[0] != 0x00:
+    raise VideoFileInvalid("first byte must be 0x00")
+
+  starts = find_nal_units(dat)
+  starts = starts[starts >= 1]
+  ends = np.append(starts[1:], len(dat))
+
+  # the first NAL unit that fails to parse, everything from there on is dropped
+  error: tuple[int, Exception] | None = None
+  if len(starts) == 0 or starts[0] != 1:
+    error = (1, VideoFileInvalid("data must begin with start code"))
+    starts = starts[:0]
+  elif starts[-1] + NAL_UNIT_START_CODE_SIZE + NAL_UNIT_HEADER_SIZE > len(dat):
+    error = (int(starts[-1]), VideoFileInvalid("data to short to contain nal unit header"))
+    starts, ends = starts[:-1], ends[:-1]
+
+  arr = np.frombuffer(dat, dtype=np.uint8)
+  types = (arr[starts + NAL_UNIT_START_CODE_SIZE] >> 1) & 0x3F
+  is_slice = np.isin(types, HEVC_CODED_SLICE_SEGMENT_NAL_UNITS)
+  rbsp_starts = starts + NAL_UNIT_START_CODE_SIZE + NAL_UNIT_HEADER_SIZE
+  if is_slice.any() and rbsp_starts[is_slice][-1] >= len(dat):
+    # only the last NAL unit can end right after its header
+    first_error = int(np.flatnonzero(is_slice)[-1])
+    error = (int(starts[first_error]), IndexError("index out of range"))
+    starts, ends, types, is_slice = starts[:first_error], ends[:first_error], types[:first_error], is_slice[:first_error]
+    rbsp_starts = rbsp_starts[:first_error]
+
+  is_first_slice = is_slice & (arr[np.minimum(rbsp_starts, len(arr) - 1)] >> 7 == 1)
+  first_slices = np.flatnonzero(is_first_slice)
+  slice_types = get_hevc_slice_types(dat, starts[first_slices], types[first_slices])
+  for j in np.flatnonzero(np.isnan(slice_types)):
+    start = int(starts[first_slices[j]])
+    try:
+      slice_types[j], _ = get_hevc_slice_type(dat, start, HevcNalUnitType(int(types[first_slices[j]])))
+    except Exception as e:
+      slice_types[j] = -1
+      if error is None or start < error[0]:
+        error = (start, e)
+  invalid = np.flatnonzero(slice_types > 2)
+  if len(invalid) and (error is None or starts[first_slices[invalid[0]]] < error[0]):
+    error = (int(starts[first_slices[invalid[0]]]), VideoFileInvalid("slice_type must be 0, 1, or 2"))
+
+  if error is not None:
+    if not allow_corrupt:
+      raise error[1]
+    print(f"ERROR: NAL unit skipped @ {error[0]}\n", str(error[1]))
+    keep = starts < error[0]
+    first_slices, slice_types = first_slices[keep[first_slices]], slice_types[keep[first_slices]]
+    starts, ends, types = starts[keep], ends[keep], types[keep]
+
+  parameter_sets = np.flatnonzero(np.isin(types, HEVC_PARAMETER_SET_NAL_UNITS))
+  prefix_dat = b"".join(dat[starts[i]:ends[i]] for i in parameter_sets)
+  frame_types = list(zip(slice_types.astype(int).tolist(), starts[first_slices].tolist(), strict=True))
+  return frame_types, len(dat), prefix_dat
+
 def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, int, bytes]:
   with FileReader(hevc_file_name) as f:
     dat = f.read()
+  return hevc_index_data(dat, allow_corrupt)
 
+def hevc_index_reference(dat: bytes, allow_corrupt: bool=False) -> tuple[list, int, bytes]:
+  """Walks the NAL units one by one, hevc_index_data is checked and benchmarked against this"""
   if len(dat) < NAL_UNIT_START_CODE_SIZE + 1:
     raise VideoFileInvalid("data is too short")
 